@@ -0,0 +1,136 @@
+"""
+Доставка апдейтов polling против webhook (services/telegram_webhook.py) на локальной заглушке Bot API
+(benchmarks/telegram_standin.py, сеть до Telegram --rtt с): пользователи пишут боту с заданной частотой,
+хэндлер "работает" --work с и отвечает. Печатает задержку от сообщения до ответа (p50/p95/p99) и пропускную способность;
+проверяет секрет webhook и что апдейты, накопившиеся за перезапуск, не выбрасываются.
+
+    python -m benchmarks.bench_bot_delivery [--updates 3000] [--rate 300] [--work 0.05] [--rtt 0.06]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+import aiohttp  # noqa: E402
+from aiogram import Bot, Dispatcher, Router, types  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+from benchmarks.telegram_standin import TelegramStandIn  # noqa: E402
+from services.telegram_webhook import TelegramWebhook  # noqa: E402
+
+TOKEN = "42:standin"
+
+
+def make_bot(standin: TelegramStandIn) -> Bot:
+    return Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(standin.url)))
+
+
+def make_dispatcher(work: float) -> Dispatcher:
+    router = Router()
+
+    @router.message()
+    async def echo(message: types.Message):
+        await asyncio.sleep(work)  # БД, кэш, WB - чем обычно занят хэндлер
+        await message.answer(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def load(standin: TelegramStandIn, updates: int, rate: float, offset: int = 0) -> float:
+    """Сообщения равномерно с частотой rate; время до последнего ответа"""
+    standin.expect(updates)
+    started = time.perf_counter()
+    for n in range(updates):
+        delay = started + n / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        standin.inject(offset + n)
+    await asyncio.wait_for(standin.replied.wait(), 120)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(standin.rtt + 0.1)  # ответы Bot API на последние sendMessage
+    return elapsed
+
+
+def report(name: str, standin: TelegramStandIn, elapsed: float) -> None:
+    lat = sorted(standin.latencies)
+    p = lambda q: lat[min(int(len(lat) * q), len(lat) - 1)] * 1000  # noqa: E731
+    print(f"{name:>8}: p50 {p(0.5):6.1f} мс  p95 {p(0.95):6.1f} мс  p99 {p(0.99):6.1f} мс  "
+          f"{len(lat) / elapsed:5.0f} апдейтов/с")
+
+
+async def polling(args) -> None:
+    standin = await TelegramStandIn(rtt=args.rtt).start()
+    bot, dp = make_bot(standin), make_dispatcher(args.work)
+    task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=10))
+    await asyncio.sleep(0.2)
+    report("polling", standin, await load(standin, args.updates, args.rate))
+    await dp.stop_polling()
+    await task
+    await bot.session.close()
+    await standin.stop()
+
+
+async def webhook(args) -> None:
+    standin = await TelegramStandIn(rtt=args.rtt).start()
+    bot, dp = make_bot(standin), make_dispatcher(args.work)
+    port = free_port()
+    receiver = TelegramWebhook(base_url=f"http://127.0.0.1:{port}", host="127.0.0.1", port=port, secret="s3cret")
+    await receiver.start(dp, bot)
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"http://127.0.0.1:{port}{receiver.path}", json={"update_id": 1}) as response:
+            assert response.status == 401, response.status
+    report("webhook", standin, await load(standin, args.updates, args.rate))
+    await receiver.stop()
+    await standin.stop()
+
+
+async def restart(args) -> None:
+    """Апдейты пришли, пока бот лежал: polling по умолчанию (drop_pending_updates=True) против DROP_PENDING_UPDATES=0"""
+    for drop in (True, False):
+        standin = await TelegramStandIn().start()
+        standin.expect(50)
+        for n in range(50):
+            standin.inject(n)
+        bot, dp = make_bot(standin), make_dispatcher(0)
+        await bot.delete_webhook(drop_pending_updates=drop)
+        task = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+        await asyncio.sleep(1.5)
+        await dp.stop_polling()
+        await task
+        await bot.session.close()
+        print(f"перезапуск, drop_pending_updates={drop}: обработано {len(standin.latencies)} из 50 апдейтов")
+        await standin.stop()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=300)
+    parser.add_argument("--work", type=float, default=0.05)
+    parser.add_argument("--rtt", type=float, default=0.06)
+    args = parser.parse_args()
+
+    await polling(args)
+    await webhook(args)
+    await restart(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
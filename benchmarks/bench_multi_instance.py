@@ -0,0 +1,185 @@
+"""
+Несколько экземпляров бота на одной БД (SQLite WAL, у каждого экземпляра свой движок и пул соединений):
+- очередь отчётов: все задания ставит один экземпляр, остальные забирают их атомарным UPDATE с арендой;
+  время на пакет для 1/2/3 экземпляров и проверка, что каждое задание выполнено ровно один раз;
+- падение экземпляра посреди генерации: его задания после конца аренды доделывает другой;
+- FSM в таблице fsm_state: состояние, записанное одним экземпляром, видно другому; задержка операций
+  против MemoryStorage.
+
+    python -m benchmarks.bench_multi_instance [--jobs 240] [--work 0.1] [--workers 3]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+from aiogram.fsm.state import State, StatesGroup  # noqa: E402
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from sqlalchemy import func, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker  # noqa: E402
+
+from database.engine import make_engine  # noqa: E402
+from database.models import Base, Report, ReportJob, Store, User  # noqa: E402
+from services.fsm_storage import DBStorage  # noqa: E402
+from services.report_generator import get_weeks_range  # noqa: E402
+from services.report_jobs import ReportJobQueue  # noqa: E402
+
+PERIOD = get_weeks_range(1)[0]
+
+
+class Period(StatesGroup):
+    Period = State()
+
+
+class BenchQueue(ReportJobQueue):
+    """Генерация - пауза work и пустой файл; кто что выполнил - в общий счётчик"""
+
+    def __init__(self, *args, work: float, folder: Path, done: Counter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.work, self.folder, self.done = work, folder, done
+
+    async def _generate(self, job, store) -> str:
+        await asyncio.sleep(self.work)
+        path = self.folder / f"report_{job.id}.xlsx"
+        path.write_bytes(b"")
+        self.done[job.id] += 1
+        return str(path)
+
+    async def _report_row(self, job, store, file_path: str) -> Report:
+        """Детализации WB в бенчмарке нет - отчёт считаем непустым"""
+        return Report(tg_id=job.tg_id, date_of_week=date(2025, 1, 6), report_path=file_path, store_id=store.id,
+                      content_hash="bench")
+
+
+def instance_pool(path: Path) -> async_sessionmaker:
+    engine = make_engine(f"sqlite+aiosqlite:///{path}", echo=False)
+    return async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def fresh_db(folder: Path) -> Path:
+    path = folder / "bot.sqlite3"
+    path.unlink(missing_ok=True)
+    pool = instance_pool(path)
+    async with pool.kw["bind"].begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with pool() as session:
+        session.add(User(tg_id=1, phone=1, first_name="user"))
+        await session.flush()
+        session.add(Store(tg_id=1, name="store", token="token"))
+        await session.commit()
+    await pool.kw["bind"].dispose()
+    return path
+
+
+async def wait_done(pool: async_sessionmaker, jobs: int, timeout: float = 300) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        async with pool() as session:
+            if await session.scalar(select(func.count()).where(ReportJob.status == "done")) >= jobs:
+                return
+        await asyncio.sleep(0.05)
+    raise TimeoutError("задания не выполнены")
+
+
+async def queues(folder: Path, instances: int, args, lease: float = 60) -> None:
+    path = await fresh_db(folder)
+    done = Counter()
+    pools = [instance_pool(path) for _ in range(instances)]
+    queues = [BenchQueue(pool, args.workers, instance_id=f"bot-{n}", lease=lease, poll_interval=0.2,
+                         work=args.work, folder=folder, done=done) for n, pool in enumerate(pools)]
+    for queue in queues:
+        await queue.start(None)
+    started = time.perf_counter()
+    async with pools[0]() as session:
+        for _ in range(args.jobs):
+            await queues[0].enqueue(session, 1, None, 1, PERIOD, "123")
+    await wait_done(pools[0], args.jobs)
+    elapsed = time.perf_counter() - started
+    for queue in queues:
+        await queue.stop()
+    async with pools[0]() as session:
+        by_instance = dict((await session.execute(
+            select(ReportJob.locked_by, func.count()).group_by(ReportJob.locked_by))).all())
+    twice = sum(count > 1 for count in done.values())
+    async with pools[0]() as session:
+        reports = await session.scalar(select(func.count()).select_from(Report))
+    print(f"{instances} экз. x {args.workers} воркеров: {args.jobs} заданий за {elapsed:.1f} с "
+          f"({args.jobs / elapsed:.1f}/с), по экземплярам {by_instance}, выполнено дважды {twice}, отчётов {reports}")
+    assert len(done) == args.jobs and twice == 0 and reports == args.jobs
+    for pool in pools:
+        await pool.kw["bind"].dispose()
+
+
+async def crash(folder: Path, args) -> None:
+    path = await fresh_db(folder)
+    done = Counter()
+    lease = 1.0
+    pool_a, pool_b = instance_pool(path), instance_pool(path)
+    a = BenchQueue(pool_a, args.workers, instance_id="bot-a", lease=lease, poll_interval=0.2, work=5, folder=folder, done=done)
+    await a.start(None)
+    async with pool_a() as session:
+        for _ in range(args.workers):
+            await a.enqueue(session, 1, None, 1, PERIOD, "123")
+    await asyncio.sleep(0.5)
+    await a.stop()  # экземпляр "упал" посреди генерации: задания остались running за bot-a
+    crashed = time.perf_counter()
+    b = BenchQueue(pool_b, args.workers, instance_id="bot-b", lease=lease, poll_interval=0.2, work=args.work, folder=folder, done=done)
+    await b.start(None)
+    await wait_done(pool_b, args.workers)
+    print(f"падение экземпляра: {args.workers} заданий доделаны другим через {time.perf_counter() - crashed:.1f} с "
+          f"(аренда {lease:.0f} с)")
+    await b.stop()
+    for pool in (pool_a, pool_b):
+        await pool.kw["bind"].dispose()
+
+
+async def fsm(folder: Path, ops: int) -> None:
+    path = await fresh_db(folder)
+    pool_a, pool_b = instance_pool(path), instance_pool(path)
+    a, b = DBStorage(pool_a), DBStorage(pool_b)
+    key = StorageKey(bot_id=42, chat_id=1, user_id=1)
+    await a.set_state(key, Period.Period)
+    await a.update_data(key, {"token": "token", "store_id": 1})
+    assert await b.get_state(key) == Period.Period.state and (await b.get_data(key))["store_id"] == 1
+    await b.set_state(key, None)
+    await b.set_data(key, {})
+    assert await a.get_state(key) is None
+
+    for name, storage in (("memory", MemoryStorage()), ("db", a)):
+        started = time.perf_counter()
+        for n in range(ops):
+            key = StorageKey(bot_id=42, chat_id=n, user_id=n)
+            await storage.set_state(key, Period.Period)
+            await storage.update_data(key, {"token": "token"})
+            await storage.get_state(key)
+        print(f"FSM {name:>6}: {(time.perf_counter() - started) / ops / 4 * 1000:.3f} мс на операцию")
+    print("FSM: состояние и данные, записанные одним экземпляром, видны другому")
+    for pool in (pool_a, pool_b):
+        await pool.kw["bind"].dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=240)
+    parser.add_argument("--work", type=float, default=0.1)
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp())
+    for instances in (1, 2, 3):
+        await queues(folder, instances, args)
+    await crash(folder, args)
+    await fsm(folder, 1000)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+Зачисление платежей: прежняя цепочка (проверка yoo_id + orm_add_bonus + orm_add_generations + orm_add_payment,
+три коммита) против orm_settle_payment (одна транзакция, уникальный yoo_id).
+Одновременно зачисляются разные платежи (платежей в секунду, коммитов) и один платёж
+много раз сразу (кнопка + повторы уведомлений): сколько раз он зачислился.
+
+    python -m benchmarks.bench_payment_settlement [--payments 500] [--concurrency 20] [--duplicates 20]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+from sqlalchemy import event, func, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker  # noqa: E402
+
+from database.engine import make_engine  # noqa: E402
+from database.models import Base, Payment, Ref, User  # noqa: E402
+from services.payment import orm_add_generations, orm_add_payment, orm_check_payment_exists, orm_settle_payment  # noqa: E402
+from services.refs import orm_add_bonus, orm_get_referrer  # noqa: E402
+
+USERS = 100
+AMOUNT, GENERATIONS = 490, 3
+
+
+async def legacy_settle(session: AsyncSession, yoo_id: str, tg_id: int, amount: int, generations_num: int) -> bool:
+    """Как было в cb_check_payment до единой транзакции"""
+    if await orm_check_payment_exists(session, yoo_id):
+        return False
+    referrer = await orm_get_referrer(session, tg_id)
+    if referrer is not None:
+        await orm_add_bonus(session, referrer, amount)
+    await orm_add_generations(session, tg_id, generations_num)
+    await orm_add_payment(session, tg_id, amount, generations_num, yoo_id)
+    return True
+
+
+async def setup(path: Path, unique: bool):
+    engine = make_engine(f"sqlite+aiosqlite:///{path}", echo=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        if not unique:  # схема до миграции 4
+            await conn.exec_driver_sql('DROP INDEX uq_payment_yoo_id')
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_pool() as session:
+        session.add_all(User(tg_id=n, phone=n, first_name=f"user{n}") for n in range(1, USERS + 1))
+        await session.flush()
+        session.add_all(Ref(referral_id=n, referrer_id=1) for n in range(2, USERS + 1))  # у всех один реферер
+        await session.commit()
+    return engine, session_pool
+
+
+async def settle_all(session_pool, settle, jobs, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(yoo_id: str, tg_id: int) -> bool:
+        async with semaphore, session_pool() as session:
+            return await settle(session, yoo_id, tg_id, AMOUNT, GENERATIONS)
+
+    return await asyncio.gather(*(one(yoo_id, tg_id) for yoo_id, tg_id in jobs), return_exceptions=True)
+
+
+async def run(name: str, settle, unique: bool, args) -> None:
+    engine, session_pool = await setup(Path(tempfile.mkdtemp()) / "settle.sqlite3", unique)
+    commits = 0
+
+    @event.listens_for(engine.sync_engine, "commit")
+    def count_commit(*a):
+        nonlocal commits
+        commits += 1
+
+    jobs = [(f"pay-{n}", 2 + n % (USERS - 1)) for n in range(args.payments)]
+    started = time.perf_counter()
+    results = await settle_all(session_pool, settle, jobs, args.concurrency)
+    elapsed = time.perf_counter() - started
+    errors = sum(isinstance(r, Exception) for r in results)
+    print(f"{name}: разные платежи {len(jobs) / elapsed:>5.0f}/с, коммитов на платёж {commits / len(jobs):.1f}, ошибок {errors}")
+
+    dup = [("pay-dup", 2)] * args.duplicates
+    results = await settle_all(session_pool, settle, dup, args.duplicates)
+    async with session_pool() as session:
+        rows = await session.scalar(select(func.count()).where(Payment.yoo_id == "pay-dup"))
+        bonus = await session.scalar(select(User.bonus_total).where(User.tg_id == 1))
+    errors = [r for r in results if isinstance(r, Exception)]
+    print(f"{' ' * len(name)}  один платёж x{args.duplicates}: зачислен {sum(r is True for r in results)} раз, "
+          f"записей Payment {rows}, ошибок {len(errors)}, бонус реферера {bonus} "
+          f"(ожидается {(args.payments + 1) * (AMOUNT // 10)})")
+    await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duplicates", type=int, default=20)
+    args = parser.parse_args()
+
+    await run("три коммита", legacy_settle, False, args)
+    await run("одна транзакция", orm_settle_payment, True, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
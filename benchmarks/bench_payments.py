@@ -0,0 +1,121 @@
+"""
+Платежи против локальной заглушки ЮKassa (benchmarks/yookassa_standin.py):
+- одновременные нажатия "Оплатить": прямой вызов синхронного SDK из хэндлера против create_payment_async,
+  время на всех и блокировка loop по LoopMonitor;
+- время от оплаты до зачисления через webhook и однократность зачисления, когда уведомление
+  приходит дважды одновременно с нажатием "Проверить оплату".
+
+    python -m benchmarks.bench_payments [--users 50] [--latency 0.2]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+from benchmarks.yookassa_standin import YooKassaStandIn  # noqa: E402
+
+STANDIN = YooKassaStandIn().start()
+os.environ["YOOKASSA_API_URL"] = STANDIN.api_url
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker  # noqa: E402
+
+from database.engine import make_engine  # noqa: E402
+from database.models import Base, User  # noqa: E402
+from services.auth_service import orm_get_user  # noqa: E402
+from services.loop_monitor import LoopMonitor  # noqa: E402
+from services.payment import check_payment_async, create_payment, create_payment_async, credit_payment  # noqa: E402
+from services.payment_webhook import PaymentWebhook  # noqa: E402
+from services.ttl_cache import user_cache  # noqa: E402
+
+
+async def legacy_pay(tg_id, generations_num, amount):
+    """Как было: синхронный SDK прямо в хэндлере"""
+    return create_payment(tg_id, generations_num, amount)
+
+
+async def clicks(pay, users: int) -> dict:
+    monitor = LoopMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(pay(n, "3", "490.00") for n in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(monitor.interval * 2)  # монитор должен проснуться после последней блокировки
+    await monitor.stop()
+    return {"seconds": elapsed, **monitor.snapshot()}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def webhook(users: int) -> None:
+    engine = make_engine(f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'payments.sqlite3'}", echo=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with session_pool() as session:
+        session.add_all(User(tg_id=n, phone=n, first_name=f"user{n}") for n in range(1, users + 1))
+        await session.commit()
+    receiver = PaymentWebhook(port=free_port())
+    await receiver.start(None, session_pool)
+    url = f"http://{receiver.host}:{receiver.port}{receiver.path}"
+    user_cache.ttl = 0
+
+    delays = []
+    for tg_id in range(1, users + 1):
+        _, payment_id = await create_payment_async(tg_id, "3", "490.00")
+        STANDIN.pay(payment_id)
+        started = time.perf_counter()
+        assert await asyncio.to_thread(STANDIN.notify, url, payment_id) == 200
+        delays.append(time.perf_counter() - started)
+    delays.sort()
+    print(f"webhook: от оплаты до зачисления медиана {delays[len(delays) // 2] * 1000:.0f} мс, "
+          f"максимум {delays[-1] * 1000:.0f} мс (из них 1 запрос find_one к ЮKassa)")
+
+    # повторное уведомление, ещё одно параллельно и нажатие кнопки - генерации начисляются один раз
+    _, payment_id = await create_payment_async(1, "3", "490.00")
+    STANDIN.pay(payment_id)
+    async with session_pool() as session:
+        before = (await orm_get_user(session, 1)).generations_left
+
+    async def button():
+        async with session_pool() as session:
+            return await credit_payment(session, payment_id, await check_payment_async(payment_id))
+
+    results = await asyncio.gather(
+        asyncio.to_thread(STANDIN.notify, url, payment_id), asyncio.to_thread(STANDIN.notify, url, payment_id), button()
+    )
+    async with session_pool() as session:
+        after = (await orm_get_user(session, 1)).generations_left
+    assert after == before + 3, (before, after, results)
+    print(f"дубли: 2 уведомления + кнопка -> генераций {before} -> {after}")
+    await receiver.stop()
+    await engine.dispose()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+    STANDIN.latency = args.latency
+
+    for name, pay in (("SDK в loop", legacy_pay), ("async", create_payment_async)):
+        result = await clicks(pay, args.users)
+        print(f"{name:>10}: {args.users} оплат за {result['seconds']:.2f} с, loop заблокирован "
+              f"{result['blocked_seconds']:.2f} с (макс. {result['max_lag_seconds']:.2f} с)")
+    await webhook(min(args.users, 20))
+    STANDIN.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
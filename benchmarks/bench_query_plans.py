@@ -0,0 +1,147 @@
+"""
+Планы и время горячих запросов на базе с 1M отчётов и 1M платежей до и после миграции
+с индексами (database/migrations.py): orm_check_payment_exists, orm_get_user_stores, orm_get_refs
+и выборка отчётов пользователя по магазину и неделе.
+
+    python -m benchmarks.bench_query_plans [--rows 1000000] [--calls 50]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+from sqlalchemy import create_engine, select  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker  # noqa: E402
+
+from database.engine import make_engine  # noqa: E402
+from database.migrations import MIGRATIONS, run_migrations  # noqa: E402
+from database.models import Base, Payment, Ref, Report, Store, User  # noqa: E402
+from services.manage_stores import orm_get_user_stores  # noqa: E402
+from services.payment import orm_check_payment_exists  # noqa: E402
+from services.refs import orm_get_refs  # noqa: E402
+from services.ttl_cache import stores_cache  # noqa: E402
+
+
+NEW_INDEXES = ["idx_store_tg_id", "idx_report_user_store_week", "idx_payment_yoo_id", "uq_payment_yoo_id", "idx_ref_referrer_id"]
+WEEK0 = date(2024, 1, 1)
+
+
+def build(path: Path, rows: int) -> None:
+    """База в состоянии до миграции 3: схема моделей без новых индексов"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        run_migrations(conn, [m for m in MIGRATIONS if m[0] < 3])
+    engine.dispose()
+    users, stores = max(rows // 20, 100), max(rows // 15, 100)
+    rng = random.Random(0)
+    now = "2025-01-01 00:00:00"
+    conn = sqlite3.connect(path)
+    for name in NEW_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+    conn.executemany(
+        'INSERT INTO user (id, tg_id, phone, first_name, role, generations_left, bonus_total, bonus_left, created, updated) '
+        'VALUES (?, ?, ?, ?, "user", 4, 0, 0, ?, ?)',
+        ((n, 10 ** 9 + n, 79 * 10 ** 9 + n, f"user{n}", now, now) for n in range(1, users + 1)))
+    conn.executemany(
+        'INSERT INTO store (id, tg_id, name, token, pregenerate, created, updated) VALUES (?, ?, ?, ?, 0, ?, ?)',
+        ((n, 10 ** 9 + rng.randint(1, users), f"store{n}", f"token-{n}", now, now) for n in range(1, stores + 1)))
+    conn.executemany(
+        'INSERT INTO report (tg_id, date_of_week, report_path, store_id, created, updated) VALUES (?, ?, ?, ?, ?, ?)',
+        ((10 ** 9 + rng.randint(1, users), (WEEK0 + timedelta(weeks=rng.randint(0, 100))).isoformat(),
+          "data/reports/report.xlsx", rng.randint(1, stores), now, now) for _ in range(rows)))
+    conn.executemany(
+        'INSERT INTO payment (tg_id, amount, generations_num, yoo_id, created, updated) VALUES (?, 490, 1, ?, ?, ?)',
+        ((10 ** 9 + rng.randint(1, users), f"2f{n:030x}", now, now) for n in range(rows)))
+    conn.executemany(
+        'INSERT INTO ref (referral_id, referrer_id, created, updated) VALUES (?, ?, ?, ?)',
+        ((10 ** 9 + n, 10 ** 9 + rng.randint(1, users), now, now) for n in range(1, users + 1)))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def statements(rows: int) -> dict:
+    users = max(rows // 20, 100)
+    tg_id = 10 ** 9 + users // 2
+    return {
+        "payment exists": select(Payment.id).where(Payment.yoo_id == f"2f{rows // 2:030x}"),
+        "user stores": select(Store).where(Store.tg_id == tg_id),
+        "refs": select(User.phone, User.first_name).join(Ref, User.tg_id == Ref.referral_id).where(Ref.referrer_id == tg_id),
+        "report history": select(Report).where(Report.tg_id == tg_id, Report.store_id == 1, Report.date_of_week == WEEK0),
+    }
+
+
+def plans(path: Path, rows: int) -> dict:
+    engine = create_engine(f"sqlite:///{path}")
+    result = {}
+    with engine.connect() as conn:
+        for name, stmt in statements(rows).items():
+            sql = str(stmt.compile(engine, compile_kwargs={"literal_binds": True}))
+            result[name] = "; ".join(r[-1] for r in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}"))
+    engine.dispose()
+    return result
+
+
+async def latencies(path: Path, rows: int, calls: int) -> dict:
+    engine = make_engine(f"sqlite+aiosqlite:///{path}", echo=False)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    users = max(rows // 20, 100)
+    stores_cache.ttl = 0  # меряем запрос, а не кэш
+    rng = random.Random(1)
+    helpers = {
+        "payment exists": lambda s: orm_check_payment_exists(s, f"2f{rng.randrange(rows):030x}"),
+        "user stores": lambda s: orm_get_user_stores(s, 10 ** 9 + rng.randint(1, users)),
+        "refs": lambda s: orm_get_refs(s, 10 ** 9 + rng.randint(1, users)),
+        "report history": lambda s: s.execute(select(Report).where(
+            Report.tg_id == 10 ** 9 + rng.randint(1, users), Report.store_id == rng.randint(1, users),
+            Report.date_of_week == WEEK0)),
+    }
+    result = {}
+    async with session_pool() as session:
+        for name, helper in helpers.items():
+            started = time.perf_counter()
+            for _ in range(calls):
+                await helper(session)
+            result[name] = (time.perf_counter() - started) / calls * 1000
+    await engine.dispose()
+    return result
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--calls", type=int, default=50)
+    args = parser.parse_args()
+
+    path = Path(tempfile.mkdtemp()) / "plans.sqlite3"
+    started = time.perf_counter()
+    build(path, args.rows)
+    print(f"база: {args.rows} отчётов и платежей, {time.perf_counter() - started:.0f} с")
+
+    before_plans, before_ms = plans(path, args.rows), await latencies(path, args.rows, args.calls)
+    engine = create_engine(f"sqlite:///{path}")
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        applied = run_migrations(conn)
+    engine.dispose()
+    print(f"миграции {applied}: {time.perf_counter() - started:.1f} с")
+    after_plans, after_ms = plans(path, args.rows), await latencies(path, args.rows, args.calls)
+
+    for name in before_plans:
+        print(f"\n{name}: {before_ms[name]:.2f} мс -> {after_ms[name]:.3f} мс")
+        print(f"  до:    {before_plans[name]}")
+        print(f"  после: {after_plans[name]}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
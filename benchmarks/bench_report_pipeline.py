@@ -0,0 +1,163 @@
+"""
+Офлайн-бенчмарк генерации отчёта целиком: generate_report_with_params против подменённого WB
+(benchmarks/wb_standin.py) на синтетических данных от 1k до 1M строк детализации.
+
+Каждый размер считается в отдельном процессе: время всей генерации, время по этапам
+(продажи, приёмка, хранение, реклама, сборка файла), пиковая память процесса бота и пула процессов.
+"cold" - пустые кэши WB и хранилище продаж, "warm" - повторная генерация того же закрытого периода.
+Лимиты WB и паузы опроса задач отключены - меряется только работа бота.
+
+    python -m benchmarks.bench_report_pipeline [--sizes 1000 10000 100000 1000000]
+    python -m benchmarks.bench_report_pipeline --save          # записать baseline
+    python -m benchmarks.bench_report_pipeline --tolerance 0.3 # сравнить с baseline, код 1 при регрессии
+
+Baseline зависит от машины: сравнивайте прогоны на одном и том же железе.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baselines" / "report_pipeline.json"
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+STAGES = ["sales", "acceptance", "storage", "advert", "build_file"]
+METRICS = ["cold_s", "warm_s", "rss_mb", "pool_rss_mb"]
+
+
+def configure_env(workdir: Path) -> None:
+    """Все файлы бота - во временном каталоге; лимиты WB и паузы опроса не мешают замеру"""
+    os.environ.update({
+        "DB_URL": f"sqlite+aiosqlite:///{workdir / 'bot.db'}",
+        "WB_CACHE_PATH": str(workdir / "cache" / "wb_cache.sqlite3"),
+        "SALES_STORE_PATH": str(workdir / "cache" / "sales.sqlite3"),
+        "WB_POLL_FIRST": "0.01",
+        "WB_HOST_RATE": "100000",
+        "WB_HOST_BURST": "100000",
+    })
+
+
+def timed(stages: dict, name: str, func):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
+    return wrapper
+
+
+async def run_child(rows: int, workdir: Path) -> dict:
+    from benchmarks.wb_standin import DOC_NUMBER, Payload, WBStandIn
+    import services.report_generator as rg
+    import services.wb_client as wc
+    from database.engine import create_db
+    from services.cpu_pool import shutdown_cpu_pool
+
+    period = rg.get_weeks_range(1)[0]
+    start_date, end_date = rg.get_dates_from_str(period)
+    standin = WBStandIn(Payload.for_rows(rows, start_date, end_date), workdir / "wb")
+
+    wc.RATE_LIMITS = []
+    wc.DEFAULT_LIMIT = wc.RateLimit("default", "*", ".*", 100_000, 100_000)
+    wc.wb_client._client = wc.httpx.AsyncClient(transport=standin.transport())
+
+    stages: dict = {}
+    rg.aggregate_sales_async = timed(stages, "sales", rg.aggregate_sales_async)
+    rg.get_acceptance_rows = timed(stages, "acceptance", rg.get_acceptance_rows)
+    rg.get_storage_report = timed(stages, "storage", rg.get_storage_report)
+    rg.get_ad_expenses_report = timed(stages, "advert", rg.get_ad_expenses_report)
+    run_cpu = rg.run_cpu
+
+    async def run_cpu_timed(func, *args):
+        if func.__name__ != "build_report_file":
+            return await run_cpu(func, *args)
+        return await timed(stages, "build_file", run_cpu)(func, *args)
+    rg.run_cpu = run_cpu_timed
+
+    os.chdir(workdir)  # data/reports - относительный путь, пул должен стартовать уже отсюда
+    await create_db()
+    await run_cpu(len, [])  # пул процессов бота запущен заранее, его старт в замер не входит
+    result = {"rows": rows, "skus": standin.payload.skus}
+    for run in ("cold", "warm"):
+        stages.clear()
+        standin.calls.clear()
+        started = time.perf_counter()
+        path = await rg.generate_report_with_params(period, DOC_NUMBER, "benchmark-token", "Бенчмарк", 1, 1)
+        result[f"{run}_s"] = round(time.perf_counter() - started, 3)
+        result[f"{run}_stages"] = {name: round(stages.get(name, 0.0), 3) for name in STAGES}
+        result[f"{run}_wb_calls"] = sum(standin.calls.values())
+    result["file_mb"] = round(Path(path).stat().st_size / 2 ** 20, 2)
+    shutdown_cpu_pool()
+    result["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    result["pool_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return result
+
+
+def measure(rows: int) -> dict:
+    """Один размер - в отдельном процессе, чтобы пиковая память не смешивалась между размерами"""
+    with tempfile.TemporaryDirectory() as workdir:
+        out = subprocess.run(
+            [sys.executable, "-m", "benchmarks.bench_report_pipeline", "--child", str(rows), "--workdir", workdir],
+            cwd=Path(__file__).resolve().parent.parent, capture_output=True, text=True, check=True,
+        )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """Метрики, выросшие относительно baseline больше чем на tolerance"""
+    regressions = []
+    for metric in METRICS:
+        before, after = baseline.get(metric), result[metric]
+        if before and after > before * (1 + tolerance):
+            regressions.append(f"{result['rows']} строк: {metric} {before} -> {after} (+{after / before - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--save", action="store_true", help="записать результаты как baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        workdir = Path(args.workdir)
+        configure_env(workdir)
+        logging.disable(logging.WARNING)
+        print(json.dumps(asyncio.run(run_child(args.child, workdir))))
+        return
+
+    baselines = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    regressions = []
+    print(f"{'строк':>9} {'SKU':>6} {'cold, с':>8} {'warm, с':>8} {'RSS, МБ':>8} {'пул, МБ':>8}  этапы cold, с")
+    for rows in args.sizes:
+        result = measure(rows)
+        stages = " ".join(f"{name}={sec}" for name, sec in result["cold_stages"].items())
+        print(f"{rows:>9} {result['skus']:>6} {result['cold_s']:>8} {result['warm_s']:>8} "
+              f"{result['rss_mb']:>8} {result['pool_rss_mb']:>8}  {stages}")
+        if str(rows) in baselines:
+            regressions += compare(result, baselines[str(rows)], args.tolerance)
+        baselines[str(rows)] = result if args.save else baselines.get(str(rows), result)
+
+    if args.save:
+        BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        BASELINE_PATH.write_text(json.dumps(baselines, indent=2, ensure_ascii=False) + "\n")
+        print(f"baseline записан в {BASELINE_PATH}")
+    elif regressions:
+        print("Регрессии относительно baseline:", *regressions, sep="\n  ")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Сравнение записи итогового xlsx: старый способ (pd.ExcelWriter + обход ws.columns)
+и потоковый services.report_writer на 10k и 100k SKU.
+
+    python -m benchmarks.bench_report_writer [--sizes 10000 100000]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.report_writer import write_report_xlsx  # noqa: E402
+
+
+COLUMNS = [
+    "Артикул WB", "Артикул поставщика", "Кол-во продаж", "Общая выручка",
+    "К Перечислению", "Логистика, шт", "Логистика, руб", "Штрафы", "Доплаты",
+    "Возвраты", "Хранение", "ВБ.Продвижение", "Подписка «Джем»",
+    "Платная приемка", "Утилизация", "Списание за отзывы", "Прочие удержания", "На расчетный счет",
+]
+
+
+def make_frame(skus: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    data = {
+        "Артикул WB": (10_000_000 + np.arange(skus)).astype(str),
+        "Артикул поставщика": [f"ART-{i:07d}" for i in range(skus)],
+        "Кол-во продаж": rng.integers(0, 500, skus),
+        "Логистика, шт": rng.integers(0, 500, skus),
+    }
+    for col in COLUMNS:
+        if col not in data:
+            data[col] = rng.uniform(0, 100_000, skus).round(2)
+    return pd.DataFrame(data)[COLUMNS]
+
+
+def legacy_write(df: pd.DataFrame, path: str, store_name: str, start_date: str, end_date: str) -> str:
+    """Запись отчёта как до потокового writer'а"""
+    yellow = PatternFill(fill_type="solid", start_color="FFFF00", end_color="FFFF00")
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        df.to_excel(writer, index=False, startrow=2)
+        ws = writer.sheets["Sheet1"]
+        ws.cell(row=1, column=1, value=f"Магазин: {store_name}")
+        ws.cell(row=2, column=1, value=f"Период: {start_date} – {end_date}")
+        for cell in ws[3]:
+            cell.font = Font(bold=True)
+        for col in ws.columns:
+            length = max(len(str(c.value)) for c in col)
+            ws.column_dimensions[col[0].column_letter].width = length + 2
+        summary = ws.max_row + 1
+        ws.cell(row=summary, column=1, value="Итого").font = Font(bold=True)
+        for idx in range(3, len(df.columns) + 1):
+            letter = get_column_letter(idx)
+            c = ws.cell(row=summary, column=idx, value=f"=SUM({letter}4:{letter}{summary-1})")
+            c.font = Font(color="FF0000"); c.fill = yellow
+    return path
+
+
+def _run(func, skus: int, path: str, out) -> None:
+    df = make_frame(skus)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    func(df, path, "Бенчмарк", "2025-01-06", "2025-01-12")
+    elapsed = time.perf_counter() - started
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    out.send((elapsed, grown / 1024))
+
+
+def measure(func, skus: int, path: str):
+    """Каждый замер в отдельном процессе, чтобы пиковый RSS одного writer'а не влиял на другой"""
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_run, args=(func, skus, path, child))
+    proc.start()
+    elapsed, grown = parent.recv()
+    proc.join()
+    return elapsed, grown, os.path.getsize(path) / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    args = parser.parse_args()
+
+    print(f"{'SKU':>8} {'writer':>10} {'сек':>8} {'+RSS МБ':>8} {'файл МБ':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for skus in args.sizes:
+            for name, func in [("legacy", legacy_write), ("streaming", write_report_xlsx)]:
+                elapsed, grown, size = measure(func, skus, os.path.join(tmp, f"{name}_{skus}.xlsx"))
+                print(f"{skus:>8} {name:>10} {elapsed:>8.2f} {grown:>8.1f} {size:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+SalesAggregator.add_frame: прежняя свёртка страницы (str.contains по каждой строке, группировка
+по строковому артикулу) против текущей (factorize + группировка по категориям) на синтетической
+детализации, сложенной страницами. Проверяет совпадение результата и печатает время.
+
+    python -m benchmarks.bench_sales_fold [--rows 1000000] [--page 100000] [--repeat 3]
+"""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services.report_builder import (  # noqa: E402
+    OTHER_DEDUCTIONS_EXCLUDE, PROMOTION_DOC_PATTERN, SALES_SUM_COLUMNS, SalesAggregator,
+)
+
+
+BONUS_TYPES = [
+    None, "", "Логистика", "Оказание услуг «ВБ.Продвижение» по документу 232411108 от 05.01.2025",
+    "Списание за отзыв товар 1234", "Списание за отзыв товар 55aB", "Акт утилизации товара",
+    "Подписка «Джем»", "Платная приёмка",
+]
+
+
+def make_records(rows: int, skus: int = 20_000, seed: int = 0) -> pd.DataFrame:
+    """Детализация в виде, как её отдаёт reportDetailByPeriod (только нужные колонки)"""
+    rng = np.random.default_rng(seed)
+    nm = rng.integers(0, skus, rows)
+    nm[rng.random(rows) < 0.02] = 0  # служебные строки без товара
+    vendor = np.array([f" art-{i} " for i in range(skus)] + ["", None], dtype=object)
+    return pd.DataFrame({
+        "nm_id": 10_000_000 + nm * (nm != 0) - 10_000_000 * (nm == 0),
+        "sa_name": vendor[np.where(rng.random(rows) < 0.01, skus + rng.integers(0, 2, rows), nm)],
+        "doc_type_name": np.where(rng.random(rows) < 0.1, "Возврат", "Продажа"),
+        "bonus_type_name": np.array(BONUS_TYPES, dtype=object)[rng.integers(0, len(BONUS_TYPES), rows)],
+        "quantity": rng.integers(0, 3, rows),
+        "retail_amount": rng.uniform(0, 5000, rows).round(2),
+        "ppvz_for_pay": rng.uniform(0, 4000, rows).round(2),
+        "delivery_amount": rng.integers(0, 2, rows),
+        "delivery_rub": rng.uniform(0, 200, rows).round(2),
+        "penalty": np.where(rng.random(rows) < 0.01, 100.0, 0.0),
+        "additional_payment": 0.0,
+        "deduction": np.where(rng.random(rows) < 0.05, rng.uniform(0, 300, rows).round(2), 0.0),
+    })
+
+
+class LegacySalesAggregator(SalesAggregator):
+    """Прежняя свёртка страницы, для сравнения. Всё остальное - из SalesAggregator"""
+
+    def add_frame(self, df: pd.DataFrame) -> None:
+        self.rows += len(df)
+        ded = df.loc[df["deduction"] != 0, ["deduction", "bonus_type_name"]]
+        if not ded.empty:
+            bonus = ded["bonus_type_name"]
+            self.total_util += ded.loc[bonus.str.contains("утилизации", case=False, na=False), "deduction"].sum()
+            self.total_jam += ded.loc[bonus.str.contains("джем", case=False, na=False), "deduction"].sum()
+            self.acceptance_deduction += ded.loc[bonus.str.contains("при[её]м", case=False, na=False), "deduction"].sum()
+            self.total_other += ded.loc[~bonus.str.contains(OTHER_DEDUCTIONS_EXCLUDE, case=False, na=False), "deduction"].sum()
+            revs = ded[bonus.str.contains("списание за отзыв", case=False, na=False)]
+            if not revs.empty:
+                article = revs["bonus_type_name"].str.extract(r"товар\s+(\d+)")[0].str.upper()
+                self.reviews = self.reviews.add(revs["deduction"].groupby(article).sum(), fill_value=0)
+            self.promotion_docs.update(bonus.str.extract(PROMOTION_DOC_PATTERN, flags=re.IGNORECASE)[0].dropna())
+        self.total_other += df.loc[(df["nm_id"] == 0) & (df["penalty"] != 0), "penalty"].sum()
+        items = df[df["nm_id"] != 0]
+        if items.empty:
+            return
+        name = items["sa_name"].fillna("").astype(str).str.strip().str.upper()
+        name = name.mask(name.isin(["", "NAN"]), "НЕОПОЗНАННЫЙ ТОВАР")
+        grouped = (items[list(SALES_SUM_COLUMNS)].assign(rows=1)
+                   .groupby([items["nm_id"], name.rename("name"), (items["doc_type_name"] == "Возврат").rename("is_return")])
+                   .sum().unstack("is_return", fill_value=0))
+        self.items = grouped if self.items is None else self.items.add(grouped, fill_value=0)
+
+
+def fold(cls, df: pd.DataFrame, page: int) -> SalesAggregator:
+    agg = cls()
+    for start in range(0, len(df), page):
+        agg.add_frame(df.iloc[start:start + page])
+    return agg
+
+
+def check_equal(df: pd.DataFrame, page: int) -> None:
+    new, old = fold(SalesAggregator, df, page), fold(LegacySalesAggregator, df, page)
+    pd.testing.assert_frame_equal(new.sales_frame(), old.sales_frame(), check_dtype=False)
+    pd.testing.assert_frame_equal(new.reviews_frame(), old.reviews_frame(), check_dtype=False)
+    assert new.promotion_docs == old.promotion_docs
+    for attr in ("rows", "total_util", "total_jam", "acceptance_deduction", "total_other"):
+        assert np.isclose(getattr(new, attr), getattr(old, attr)), attr
+
+
+def timed(cls, df: pd.DataFrame, page: int, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fold(cls, df, page).sales_frame()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # совпадение результата, в том числе на краевых случаях
+    small = make_records(5_000, skus=300, seed=1)
+    check_equal(small, 1_000)
+    check_equal(small[small["doc_type_name"] != "Возврат"], 1_000)
+    check_equal(small[small["nm_id"] < 10_000_100].assign(doc_type_name="Возврат"), 1_000)
+    check_equal(small.assign(deduction=0.0), 1_000)
+    check_equal(small.assign(nm_id=0), 1_000)
+
+    df = make_records(args.rows)
+    check_equal(df, args.page)
+    legacy = timed(LegacySalesAggregator, df, args.page, args.repeat)
+    current = timed(SalesAggregator, df, args.page, args.repeat)
+    print(f"{args.rows} строк страницами по {args.page}: прежняя {legacy:.3f} с, "
+          f"текущая {current:.3f} с, ускорение x{legacy / current:.1f}")
+
+
+if __name__ == "__main__":
+    main()
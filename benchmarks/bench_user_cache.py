@@ -0,0 +1,108 @@
+"""
+Горячая навигация по меню (профиль, управление магазинами, генерация отчёта) с кэшем
+пользователей/магазинов (services/ttl_cache.py) и без него. Печатает апдейтов в секунду,
+число SQL-запросов и долю попаданий; проверяет, что списание генерации сбрасывает кэш.
+
+    python -m benchmarks.bench_user_cache [--updates 20000] [--users 500]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{Path(tempfile.gettempdir()) / 'bench_db_unused.sqlite3'}")
+
+from sqlalchemy import event, update  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker  # noqa: E402
+
+from database.engine import make_engine  # noqa: E402
+from database.models import Base, Store, User  # noqa: E402
+from middlewares.db import DataBaseSession  # noqa: E402
+from services.auth_service import orm_get_user  # noqa: E402
+from services.manage_stores import orm_get_user_stores  # noqa: E402
+from services.payment import orm_reduce_generations  # noqa: E402
+from services.ttl_cache import stores_cache, user_cache  # noqa: E402
+
+
+async def profile(event, data):
+    return (await orm_get_user(data['session'], event, fresh=True)).generations_left
+
+
+async def manage_stores(event, data):
+    return [store.name for store in await orm_get_user_stores(data['session'], event)]
+
+
+async def generate_report(event, data):
+    user = await orm_get_user(data['session'], event, fresh=True)
+    return user.selected_store.token if user.selected_store_id else None
+
+
+async def seed(session_pool: async_sessionmaker, users: int) -> None:
+    async with session_pool() as session:
+        session.add_all(User(tg_id=n, phone=n, first_name=f"user{n}") for n in range(1, users + 1))
+        await session.flush()
+        session.add_all(Store(tg_id=n, name=f"store{n}", token=f"token-{n}") for n in range(1, users + 1))
+        await session.flush()
+        await session.execute(update(User).values(selected_store_id=User.tg_id))  # у каждого свой магазин, id совпадает
+        await session.commit()
+
+
+async def run(session_pool: async_sessionmaker, updates: int, users: int, ttl: float) -> dict:
+    for cache in (user_cache, stores_cache):
+        cache.ttl, cache.hits, cache.misses = ttl, 0, 0
+        cache.clear()
+    middleware = DataBaseSession(session_pool=session_pool)
+    rng = random.Random(0)
+    # навигация сосредоточена на активных пользователях
+    hot = [rng.randint(1, max(users // 10, 1)) for _ in range(updates)]
+    handlers = [rng.choice((profile, manage_stores, generate_report)) for _ in range(updates)]
+    started = time.perf_counter()
+    for tg_id, handler in zip(hot, handlers):
+        await middleware(handler, tg_id, {})
+    elapsed = time.perf_counter() - started
+    hits, misses = user_cache.hits + stores_cache.hits, user_cache.misses + stores_cache.misses
+    return {"updates_per_s": round(updates / elapsed), "hit_rate": hits / (hits + misses)}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=20_000)
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+
+    engine = make_engine(f"sqlite+aiosqlite:///{Path(tempfile.mkdtemp()) / 'cache.sqlite3'}", echo=False)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    await seed(session_pool, args.users)
+    queries = 0
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count_query(*a):
+        nonlocal queries
+        queries += 1
+
+    for name, ttl in (("без кэша", 0), ("кэш 60 с", 60)):
+        queries = 0
+        result = await run(session_pool, args.updates, args.users, ttl)
+        print(f"{name:>9}: {result['updates_per_s']:>6} апдейтов/с  SQL-запросов {queries:>6}  "
+              f"попаданий {result['hit_rate']:.0%}")
+
+    # запись сбрасывает кэш: профиль сразу показывает новое число генераций
+    async with session_pool() as session:
+        before = (await orm_get_user(session, 1)).generations_left
+        await orm_reduce_generations(session, 1)
+    async with session_pool() as session:
+        after = (await orm_get_user(session, 1)).generations_left
+    assert after == before - 1, (before, after)
+    print(f"инвалидация: генераций {before} -> {after}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
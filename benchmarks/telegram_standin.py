@@ -0,0 +1,157 @@
+"""
+Локальная заглушка Bot API Telegram для нагрузочных бенчмарков доставки апдейтов:
+getUpdates (long polling), setWebhook/deleteWebhook с доставкой POST-ами в max_connections потоков,
+drop_pending_updates, sendMessage. Апдейт - сообщение "ping <n>"; время от его появления
+до ответа бота ("ping <n>" в sendMessage) копится в latencies. Сеть до Telegram эмулируется задержкой rtt:
+половина - на запрос, половина - на ответ, и rtt / 2 на каждый POST webhook.
+Бот подключается через AiohttpSession(api=TelegramAPIServer.from_base(standin.url)).
+"""
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+
+class TelegramStandIn:
+    def __init__(self, users: int = 1000, rtt: float = 0.0):
+        self.users = users
+        self.rtt = rtt
+        self.pending: List[dict] = []
+        self.latencies: List[float] = []
+        self.replied = asyncio.Event()
+        self.expected = 0
+        self.rejected = 0
+        self._injected: Dict[int, float] = {}
+        self._next_id = 1
+        self._new_update = asyncio.Event()
+        self._webhook: Optional[dict] = None
+        self._deliver_task: Optional[asyncio.Task] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    async def start(self) -> "TelegramStandIn":
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def stop(self) -> None:
+        await self._stop_delivery()
+        await self._runner.cleanup()
+
+    def inject(self, n: int) -> None:
+        """Пользователь написал боту"""
+        user = {"id": 10_000 + n % self.users, "is_bot": False, "first_name": "user"}
+        self.pending.append({
+            "update_id": self._next_id,
+            "message": {"message_id": n, "date": int(time.time()), "chat": {"id": user["id"], "type": "private"},
+                        "from": user, "text": f"ping {n}"},
+        })
+        self._next_id += 1
+        self._injected[n] = time.perf_counter()
+        self._new_update.set()
+
+    def expect(self, count: int) -> None:
+        self.expected, self.latencies = count, []
+        self.replied.clear()
+
+    # --- Bot API ---
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        form = await request.post()
+        await asyncio.sleep(self.rtt / 2)
+        result = await getattr(self, f'_{method}', self._default)(form)
+        await asyncio.sleep(self.rtt / 2)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _default(self, form) -> bool:
+        return True
+
+    async def _getme(self, form) -> dict:
+        return {"id": 42, "is_bot": True, "first_name": "standin", "username": "standin_bot"}
+
+    async def _getupdates(self, form) -> list:
+        offset, limit = int(form.get('offset', 0)), int(form.get('limit', 100))
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(form.get('timeout', 0)))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:limit]
+
+    async def _sendmessage(self, form) -> dict:
+        text = form['text']
+        n = int(text.split()[1])
+        self.latencies.append(time.perf_counter() - self._injected.pop(n))
+        if len(self.latencies) >= self.expected:
+            self.replied.set()
+        return {"message_id": n, "date": int(time.time()), "chat": {"id": int(form['chat_id']), "type": "private"}, "text": text}
+
+    async def _deletewebhook(self, form) -> bool:
+        await self._stop_delivery()
+        if form.get('drop_pending_updates') == 'true':
+            self.pending.clear()
+        return True
+
+    async def _setwebhook(self, form) -> bool:
+        await self._stop_delivery()
+        if form.get('drop_pending_updates') == 'true':
+            self.pending.clear()
+        self._webhook = {"url": form['url'], "secret": form.get('secret_token', ''),
+                         "max_connections": int(form.get('max_connections', 40))}
+        self._deliver_task = asyncio.create_task(self._deliver())
+        return True
+
+    # --- доставка webhook ---
+
+    async def _stop_delivery(self) -> None:
+        self._webhook = None
+        if self._deliver_task is not None:
+            self._deliver_task.cancel()
+            await asyncio.gather(self._deliver_task, return_exceptions=True)
+            self._deliver_task = None
+
+    async def _deliver(self) -> None:
+        """Как Telegram: до max_connections запросов одновременно, неуспешные повторяются"""
+        webhook = self._webhook
+        slots = asyncio.Semaphore(webhook["max_connections"])
+        headers = {"X-Telegram-Bot-Api-Secret-Token": webhook["secret"], "Content-Type": "application/json"}
+
+        async def post(session: aiohttp.ClientSession, update: dict) -> None:
+            await asyncio.sleep(self.rtt / 2)
+            try:
+                async with session.post(webhook["url"], data=json.dumps(update), headers=headers) as response:
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if not ok:
+                self.rejected += 1
+                await asyncio.sleep(0.1)
+                self.pending.insert(0, update)
+                self._new_update.set()
+            slots.release()
+
+        posting = set()
+        async with aiohttp.ClientSession() as session:
+            while True:
+                if not self.pending:
+                    self._new_update.clear()
+                    await self._new_update.wait()
+                    continue
+                await slots.acquire()
+                if not self.pending:
+                    slots.release()
+                    continue
+                task = asyncio.create_task(post(session, self.pending.pop(0)))
+                posting.add(task)
+                task.add_done_callback(posting.discard)
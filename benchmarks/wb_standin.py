@@ -0,0 +1,183 @@
+"""
+Синтетические ответы WB и подмена транспорта wb_client для офлайн-бенчмарков.
+Объёмы масштабируются от числа строк детализации продаж: SKU, хранение, приёмка,
+карточки и статистика рекламы растут вместе с ней.
+"""
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+import numpy as np
+import pandas as pd
+
+
+SALES_PAGE_ROWS = 100_000  # столько WB отдаёт за один запрос reportDetailByPeriod
+DOC_NUMBER = "7"           # номер документа ВБ.Продвижения, который "вводит пользователь"
+
+BONUS_TYPES = [
+    "", "Логистика", "Платная приёмка", "Списание за отзыв товар 1234", "Акт утилизации товара",
+    "Подписка «Джем»", f"Оказание услуг «ВБ.Продвижение» по документу {DOC_NUMBER} от 05.01.2025",
+]
+
+
+@dataclass
+class Payload:
+    rows: int
+    skus: int
+    start_date: str
+    end_date: str
+
+    @classmethod
+    def for_rows(cls, rows: int, start_date: str, end_date: str) -> "Payload":
+        return cls(rows, int(np.clip(rows // 20, 50, 20_000)), start_date, end_date)
+
+    @property
+    def nm_ids(self) -> np.ndarray:
+        return 10_000_000 + np.arange(self.skus)
+
+    @property
+    def days(self) -> List[str]:
+        return [d.date().isoformat() for d in pd.date_range(self.start_date, self.end_date)]
+
+
+def sales_pages(payload: Payload, folder: Path, seed: int = 0) -> List[Path]:
+    """
+    Детализация продаж страницами по SALES_PAGE_ROWS строк, сразу на диск:
+    в памяти процесса во время замера живёт только отдаваемая страница, как при сетевой загрузке.
+    """
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    days = payload.days
+    paths = []
+    for start in range(0, payload.rows, SALES_PAGE_ROWS):
+        n = min(SALES_PAGE_ROWS, payload.rows - start)
+        nm = payload.nm_ids[rng.integers(0, payload.skus, n)]
+        is_return = rng.random(n) < 0.08
+        bonus = rng.integers(0, len(BONUS_TYPES), n)
+        deduction = np.where(bonus >= 2, rng.uniform(1, 300, n).round(2), 0.0)
+        page = [
+            {
+                "rrd_id": start + i + 1,
+                "nm_id": int(nm[i]),
+                "sa_name": f"ART-{nm[i] - 10_000_000:07d}",
+                "doc_type_name": "Возврат" if is_return[i] else "Продажа",
+                "bonus_type_name": BONUS_TYPES[bonus[i]],
+                "rr_dt": days[i % len(days)],
+                "quantity": 1,
+                "retail_amount": float(price),
+                "ppvz_for_pay": round(float(price) * 0.8, 2),
+                "delivery_amount": int(bonus[i] == 1),
+                "delivery_rub": 50.0 if bonus[i] == 1 else 0.0,
+                "penalty": 0.0,
+                "additional_payment": 0.0,
+                "deduction": float(deduction[i]),
+            }
+            for i, price in enumerate(rng.uniform(100, 5000, n).round(2))
+        ]
+        path = folder / f"sales_{len(paths):04d}.json"
+        path.write_text(json.dumps(page, ensure_ascii=False), encoding="utf-8")
+        paths.append(path)
+    return paths
+
+
+def storage_rows(payload: Payload, seed: int = 1) -> List[dict]:
+    rng = np.random.default_rng(seed)
+    return [
+        {"date": day, "nmId": int(nm), "warehouse": "Коледино", "warehousePrice": float(price)}
+        for day in payload.days
+        for nm, price in zip(payload.nm_ids, rng.uniform(0, 20, payload.skus).round(2))
+    ]
+
+
+def acceptance_rows(payload: Payload, seed: int = 2) -> List[dict]:
+    rng = np.random.default_rng(seed)
+    n = max(payload.rows // 10, 1)
+    days = pd.date_range(pd.Timestamp(payload.start_date) - pd.Timedelta(days=2), payload.end_date).strftime("%Y-%m-%dT10:00:00")
+    return [
+        {"nmID": int(nm), "total": float(total), "shkCreateDate": days[i % len(days)]}
+        for i, (nm, total) in enumerate(zip(payload.nm_ids[rng.integers(0, payload.skus, n)], rng.uniform(1, 50, n).round(2)))
+    ]
+
+
+def card_rows(payload: Payload) -> List[dict]:
+    return [
+        {"nmID": int(nm), "vendorCode": f"ART-{nm - 10_000_000:07d}", "name": f"Товар {nm}", "updatedAt": f"2025-01-01T00:00:{n:09d}"}
+        for n, nm in enumerate(payload.nm_ids)
+    ]
+
+
+def campaign_ids(payload: Payload) -> List[int]:
+    return list(range(1, max(payload.skus // 100, 1) + 1))
+
+
+def fullstats(payload: Payload, ids: List[int]) -> List[dict]:
+    rng = np.random.default_rng(ids[0])
+    per_campaign = min(payload.skus, 20)
+    result = []
+    for cid in ids:
+        nms = payload.nm_ids[rng.integers(0, payload.skus, per_campaign)]
+        result.append({"advertId": cid, "days": [
+            {"date": day, "apps": [{"appType": 1, "nm": [{"nmId": int(nm), "name": f"Товар {nm}", "sum": 10.0} for nm in nms]}]}
+            for day in payload.days
+        ]})
+    return result
+
+
+class WBStandIn:
+    """
+    Обработчик httpx.MockTransport для эндпоинтов, которые использует services/report_generator.py.
+    Считает запросы по путям - видно, сколько обращений к WB сделала генерация.
+    """
+
+    def __init__(self, payload: Payload, folder: Path):
+        self.payload = payload
+        self.pages = sales_pages(payload, folder)
+        self.storage = json.dumps(storage_rows(payload)).encode()
+        self.acceptance = json.dumps(acceptance_rows(payload)).encode()
+        self.cards = card_rows(payload)
+        self.calls: Dict[str, int] = {}
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        self.calls[path] = self.calls.get(path, 0) + 1
+        if path.endswith("reportDetailByPeriod"):
+            page = -(-int(request.url.params.get("rrdid", 0)) // SALES_PAGE_ROWS)  # rrdid - последняя отданная строка
+            if page >= len(self.pages):
+                return httpx.Response(200, content=b"[]")
+            return httpx.Response(200, content=self.pages[page].read_bytes())
+        if path.endswith("/status"):
+            return httpx.Response(200, json={"data": {"id": "task", "status": "done"}})
+        if path.endswith("paid_storage/tasks/storage/download"):
+            return httpx.Response(200, content=self.storage)
+        if path.endswith("acceptance_report/tasks/acceptance/download"):
+            return httpx.Response(200, content=self.acceptance)
+        if path.endswith("paid_storage"):
+            return httpx.Response(200, json={"data": {"taskId": "storage"}})
+        if path.endswith("acceptance_report"):
+            return httpx.Response(200, json={"data": {"taskId": "acceptance"}})
+        if path.endswith("cards/list"):
+            return self._cards(json.loads(request.content))
+        if path.endswith("adv/v1/upd"):
+            return httpx.Response(200, json=[
+                {"updNum": int(DOC_NUMBER), "advertId": cid, "updSum": 1000.0} for cid in campaign_ids(self.payload)
+            ])
+        if path.endswith("adv/v2/fullstats"):
+            return httpx.Response(200, json=fullstats(self.payload, [item["id"] for item in json.loads(request.content)]))
+        return httpx.Response(404)
+
+    def _cards(self, body: dict) -> httpx.Response:
+        cursor = body["settings"]["cursor"]
+        start = 0
+        if cursor.get("nmID"):
+            start = int(np.searchsorted(self.payload.nm_ids, cursor["nmID"], side="right"))
+        cards = self.cards[start:start + cursor["limit"]]
+        last = cards[-1] if cards else {}
+        return httpx.Response(200, json={
+            "cards": cards,
+            "cursor": {"updatedAt": last.get("updatedAt"), "nmID": last.get("nmID"), "total": len(cards)},
+        })
@@ -0,0 +1,107 @@
+"""
+Локальная заглушка API ЮKassa для офлайн-бенчмарков платежей: POST /v3/payments, GET /v3/payments/<id>
+с заданной задержкой ответа и отправка уведомлений payment.succeeded на webhook бота.
+Работает в своём потоке (ThreadingHTTPServer), чтобы блокирующий SDK в loop бота не блокировал и её.
+Бот подключается через YOOKASSA_API_URL=<standin.api_url>.
+"""
+import json
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+
+class YooKassaStandIn:
+    def __init__(self, latency: float = 0.2):
+        self.latency = latency
+        self.payments: Dict[str, dict] = {}
+        self.calls: Dict[str, int] = {"create": 0, "find_one": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v3"
+
+    def start(self) -> "YooKassaStandIn":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _create(self, body: dict) -> dict:
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "test": True,
+            "amount": body["amount"],
+            "description": body.get("description"),
+            "metadata": body.get("metadata", {}),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"},
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+            "refundable": False,
+        }
+        with self._lock:
+            self.payments[payment_id] = payment
+        return payment
+
+    def pay(self, payment_id: str) -> dict:
+        """Пользователь оплатил: платёж переходит в succeeded"""
+        with self._lock:
+            payment = self.payments[payment_id]
+            payment.update(status="succeeded", paid=True, captured_at=datetime.now(timezone.utc).isoformat())
+            return dict(payment)
+
+    def notify(self, webhook_url: str, payment_id: str) -> int:
+        """Уведомление payment.succeeded, как его шлёт ЮKassa; код ответа бота"""
+        body = json.dumps({"type": "notification", "event": "payment.succeeded", "object": self.payments[payment_id]})
+        request = urllib.request.Request(webhook_url, body.encode(), {"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, payload: dict) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                time.sleep(standin.latency)
+                if self.path.rstrip("/") != "/v3/payments":
+                    return self._reply(404, {"type": "error", "code": "not_found"})
+                standin.calls["create"] += 1
+                self._reply(200, standin._create(body))
+
+            def do_GET(self):
+                time.sleep(standin.latency)
+                payment = standin.payments.get(self.path.rsplit("/", 1)[-1])
+                if not self.path.startswith("/v3/payments/") or payment is None:
+                    return self._reply(404, {"type": "error", "code": "not_found"})
+                standin.calls["find_one"] += 1
+                self._reply(200, payment)
+
+        return Handler
@@ -0,0 +1,158 @@
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table, false, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from services.logging import logger
+
+
+# Версионные миграции схемы. create_all создаёт только новые таблицы, всё, что меняет
+# существующие (колонки, индексы, типы), идёт сюда: новая миграция - новая запись в конце MIGRATIONS,
+# применённые записи не меняются. Каждая версия описывает свои изменения явно, без моделей; ошибка миграции
+# не глотается - create_db падает, транзакция откатывается.
+# Применённые версии хранятся в schema_version, каждая миграция выполняется один раз,
+# в той же транзакции, что и запись о ней (на SQLite и Postgres DDL транзакционен).
+
+schema_version = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String(128), nullable=False),
+    Column('applied', DateTime, nullable=False),
+)
+
+
+Step = Callable[[Connection], None]
+
+
+def add_column(table: str, column: Column) -> Step:
+    """
+    Миграция: добавить колонку. Колонка описывается здесь явно, а не берётся из моделей, - миграция
+    не меняет смысла, когда модели меняются дальше. NOT NULL без server_default на таблице с данными
+    не добавить - такая миграция падает сразу, при импорте
+    """
+    if not column.nullable and column.server_default is None:
+        raise ValueError(f'Миграция {table}.{column.name}: NOT NULL колонке нужен server_default')
+    Table(table, MetaData(), column)
+
+    def migrate(conn: Connection) -> None:
+        inspector = inspect(conn)
+        if not inspector.has_table(table):
+            raise RuntimeError(f'Миграция: нет таблицы {table}')
+        if column.name in {c['name'] for c in inspector.get_columns(table)}:
+            return  # таблица создана create_all уже с этой колонкой
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}'))
+    return migrate
+
+
+def create_index(name: str, table: str, *columns: str, unique: bool = False) -> Step:
+    """Миграция: индекс с явным списком колонок"""
+    def migrate(conn: Connection) -> None:
+        cols = ', '.join(f'"{c}"' for c in columns)
+        conn.execute(text(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {name} ON "{table}" ({cols})'))
+    return migrate
+
+
+def steps(*migrations: Step) -> Step:
+    def migrate(conn: Connection) -> None:
+        for step in migrations:
+            step(conn)
+    return migrate
+
+
+def unique_payment_yoo_id(conn: Connection) -> None:
+    """Неуникальный idx_payment_yoo_id -> уникальный uq_payment_yoo_id; дубли (двойные зачисления) удаляются, остаётся первая запись"""
+    deleted = conn.execute(text(
+        'DELETE FROM payment WHERE id NOT IN (SELECT MIN(id) FROM payment GROUP BY yoo_id)'
+    )).rowcount
+    if deleted:
+        logger.warning('Удалено %d повторных записей платежей с одинаковым yoo_id', deleted)
+    conn.execute(text('DROP INDEX IF EXISTS idx_payment_yoo_id'))
+    create_index('uq_payment_yoo_id', 'payment', 'yoo_id', unique=True)(conn)
+
+
+def store_pregenerate_not_null(conn: Connection) -> None:
+    """
+    store.pregenerate: NULL -> false. На Postgres колонка становится NOT NULL DEFAULT false;
+    SQLite не меняет ограничения существующих колонок без пересборки таблицы - там только заполнение
+    """
+    conn.execute(text('UPDATE store SET pregenerate = :off WHERE pregenerate IS NULL'), {'off': False})
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE store ALTER COLUMN pregenerate SET DEFAULT false, ALTER COLUMN pregenerate SET NOT NULL'))
+
+
+def report_charged(conn: Connection) -> None:
+    """
+    report.charged. Уже существующие отчёты помечаются списанными: раньше готовый отчёт отдавался бесплатно,
+    задним числом за него не списываем
+    """
+    inspector = inspect(conn)
+    if 'charged' in {c['name'] for c in inspector.get_columns('report')}:
+        return  # таблица создана create_all уже с этой колонкой
+    add_column('report', Column('charged', Boolean, nullable=False, server_default=false()))(conn)
+    conn.execute(text('UPDATE report SET charged = :on'), {'on': True})
+
+
+# id и телефоны Telegram не влезают в int32: колонки, созданные до перехода моделей на BigInteger
+TELEGRAM_ID_COLUMNS = [
+    ('store', 'tg_id'), ('report', 'tg_id'), ('ref', 'referrer_id'), ('payment', 'tg_id'), ('report_job', 'tg_id'),
+    ('ref', 'referral_id'), ('user', 'phone'), ('user', 'tg_id'),
+]
+
+
+def bigint_telegram_ids(conn: Connection) -> None:
+    """Postgres: INTEGER -> BIGINT (ссылки на user.tg_id - до самой колонки). В SQLite INTEGER уже 64-битный"""
+    if conn.dialect.name != 'postgresql':
+        return
+    inspector = inspect(conn)
+    for table, column in TELEGRAM_ID_COLUMNS:
+        current = {c['name']: c['type'] for c in inspector.get_columns(table)}[column]
+        if not isinstance(current, BigInteger):
+            conn.execute(text(f'ALTER TABLE "{table}" ALTER COLUMN "{column}" TYPE BIGINT'))
+            logger.info('Миграция: %s.%s -> BIGINT', table, column)
+
+
+MIGRATIONS: List[Tuple[int, str, Step]] = [
+    (1, 'report_artifact_columns', steps(
+        add_column('report', Column('doc_num', String(256))),
+        add_column('report', Column('token_hash', String(64))),
+        add_column('report', Column('content_hash', String(64))),
+        add_column('store', Column('pregenerate', Boolean)),
+    )),
+    (2, 'report_artifact_index', create_index('idx_report_artifact', 'report', 'store_id', 'date_of_week', 'doc_num', 'token_hash')),
+    (3, 'hot_lookup_indexes', steps(
+        create_index('idx_store_tg_id', 'store', 'tg_id'),
+        create_index('idx_report_user_store_week', 'report', 'tg_id', 'store_id', 'date_of_week'),
+        create_index('idx_payment_yoo_id', 'payment', 'yoo_id'),
+        create_index('idx_ref_referrer_id', 'ref', 'referrer_id'),
+    )),
+    (4, 'unique_payment_yoo_id', unique_payment_yoo_id),
+    (5, 'report_job_lease', steps(
+        add_column('report_job', Column('locked_by', String(128))),
+        add_column('report_job', Column('locked_until', DateTime)),
+    )),
+    (6, 'store_pregenerate_not_null', store_pregenerate_not_null),
+    (7, 'bigint_telegram_ids', bigint_telegram_ids),
+    (8, 'report_job_delivered', add_column('report_job', Column('delivered', Boolean, nullable=False, server_default=false()))),
+    (9, 'report_charged', report_charged),
+]
+
+
+def applied_versions(conn: Connection) -> set:
+    schema_version.create(conn, checkfirst=True)
+    return set(conn.execute(select(schema_version.c.version)).scalars())
+
+
+def run_migrations(conn: Connection, migrations=MIGRATIONS) -> List[int]:
+    """Применяет недостающие миграции по порядку, возвращает применённые версии"""
+    done = applied_versions(conn)
+    applied = []
+    for version, name, migrate in sorted(migrations):
+        if version in done:
+            continue
+        migrate(conn)
+        conn.execute(schema_version.insert().values(version=version, name=name, applied=datetime.now()))
+        logger.info('Миграция БД %d (%s) применена', version, name)
+        applied.append(version)
+    return applied
@@ -1,6 +1,6 @@
 from typing import Optional
 
-from sqlalchemy import DateTime, Date, String, Text, Integer, Boolean, func, ForeignKey, Index
+from sqlalchemy import DateTime, Date, String, Text, Integer, BigInteger, Boolean, false, func, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 
@@ -12,8 +12,8 @@ class User(Base):
     __tablename__ = 'user'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    tg_id: Mapped[int] = mapped_column(Integer, nullable=False, unique=True)
-    phone: Mapped[int] = mapped_column(Integer, nullable=False)
+    tg_id: Mapped[int] = mapped_column(BigInteger, nullable=False, unique=True)  # id Telegram и телефон не влезают в int32 Postgres
+    phone: Mapped[int] = mapped_column(BigInteger, nullable=False)
     first_name: Mapped[str] = mapped_column(String(64), nullable=False)
     user_name: Mapped[Optional[str]] = mapped_column(String(64))
     role: Mapped[str] = mapped_column(String(16), default='user', nullable=False)
@@ -43,10 +43,15 @@ class Store(Base):
     tg_id: Mapped[int] = mapped_column(ForeignKey("user.tg_id"), nullable=False)
     name: Mapped[str] = mapped_column(String(64), nullable=False)
     token: Mapped[str] = mapped_column(String(512), nullable=False)
+    pregenerate: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false(), nullable=False)  # ночная генерация отчёта за прошлую неделю
 
     reports: Mapped[list["Report"]] = relationship("Report")
     user: Mapped["User"] = relationship("User", back_populates="stores", foreign_keys=[tg_id])
 
+    __table_args__ = (
+        Index('idx_store_tg_id', 'tg_id'),
+    )
+
 
 class Report(Base):
     __tablename__ = 'report'
@@ -56,17 +61,28 @@ class Report(Base):
     date_of_week: Mapped[Date] = mapped_column(Date, nullable=False)
     report_path: Mapped[str] = mapped_column(String, nullable=False)
     store_id: Mapped[int] = mapped_column(ForeignKey("store.id"), nullable=False)
+    doc_num: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+    token_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)  # sha256 файла, только для закрытых недель
+    # генерация за отчёт списана; заранее сформированный отчёт списывается при первой выдаче пользователю
+    charged: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false(), nullable=False)
+
+    __table_args__ = (
+        Index('idx_report_artifact', 'store_id', 'date_of_week', 'doc_num', 'token_hash'),
+        Index('idx_report_user_store_week', 'tg_id', 'store_id', 'date_of_week'),
+    )
 
 
 class Ref(Base):
     __tablename__ = 'ref'
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    referral_id: Mapped[int] = mapped_column(nullable=False, unique=True)
+    referral_id: Mapped[int] = mapped_column(BigInteger, nullable=False, unique=True)
     referrer_id: Mapped[int] = mapped_column(ForeignKey("user.tg_id"), nullable=False)
 
     __table_args__ = (
         Index('idx_referral_unique', 'referral_id', unique=True),  # явное указание индекса
+        Index('idx_ref_referrer_id', 'referrer_id'),
     )
 
 
@@ -78,3 +94,71 @@ class Payment(Base):
     amount: Mapped[int] = mapped_column(Integer, nullable=False)
     generations_num: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
     yoo_id: Mapped[str] = mapped_column(String(64), nullable=False)
+
+    __table_args__ = (
+        Index('uq_payment_yoo_id', 'yoo_id', unique=True),  # платёж ЮKassa зачисляется один раз
+    )
+
+
+class CardCatalog(Base):
+    __tablename__ = 'card_catalog'
+
+    token_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    cursor_updated_at: Mapped[Optional[str]] = mapped_column(String(64))
+    cursor_nm_id: Mapped[Optional[int]] = mapped_column(Integer)
+
+
+class ProductCard(Base):
+    __tablename__ = 'product_card'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    token_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    nm_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    vendor_code: Mapped[str] = mapped_column(String(128), default='', nullable=False)
+    nm_name: Mapped[str] = mapped_column(String(256), default='', nullable=False)
+
+    __table_args__ = (
+        Index('idx_product_card_token_nm', 'token_hash', 'nm_id', unique=True),
+    )
+
+
+class ReportJob(Base):
+    __tablename__ = 'report_job'
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    tg_id: Mapped[int] = mapped_column(ForeignKey("user.tg_id"), nullable=False)
+    chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    store_id: Mapped[int] = mapped_column(ForeignKey("store.id"), nullable=False)
+    period: Mapped[str] = mapped_column(String(32), nullable=False)
+    doc_num: Mapped[str] = mapped_column(String(256), default='', nullable=False)
+    status: Mapped[str] = mapped_column(String(16), default='queued', nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    report_path: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # аренда задания экземпляром бота: пока locked_until не прошло, другие экземпляры его не берут
+    locked_by: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    locked_until: Mapped[Optional[DateTime]] = mapped_column(DateTime, nullable=True)
+    # отчёт сохранён и генерация списана - ставится в одной транзакции со списанием, повтор задания её не трогает
+    delivered: Mapped[bool] = mapped_column(Boolean, default=False, server_default=false(), nullable=False)
+
+    __table_args__ = (
+        Index('idx_report_job_status', 'status', 'id'),
+    )
+
+
+class FSMState(Base):
+    """Состояния FSM (services/fsm_storage.py), общие для всех экземпляров бота"""
+    __tablename__ = 'fsm_state'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    data: Mapped[str] = mapped_column(Text, default='{}', nullable=False)
+
+
+class AppLock(Base):
+    """Именованные блокировки с арендой между экземплярами бота (services/db_lock.py)"""
+    __tablename__ = 'app_lock'
+
+    name: Mapped[str] = mapped_column(String(128), primary_key=True)
+    owner: Mapped[str] = mapped_column(String(128), nullable=False)
+    locked_until: Mapped[DateTime] = mapped_column(DateTime, nullable=False)
@@ -1,4 +1,3 @@
-from datetime import datetime
 from aiogram import Router, types, F
 from aiogram.filters import Command, or_f
 from aiogram.fsm.context import FSMContext
@@ -8,9 +7,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from services.auth_service import orm_get_user
 from keyboards.user_keyboards import get_period_kb, get_main_kb, get_manage_kb, get_menu_kb
-from services.manage_stores import orm_add_store, orm_set_store, orm_edit_store
-from services.payment import orm_reduce_generations
-from services.report_generator import generate_report_with_params, run_with_progress, orm_add_report
+from services.manage_stores import orm_add_store, orm_set_store, orm_edit_store, orm_toggle_pregenerate
+from services.pregenerate import orm_observe_ready_report
+from services.report_generator import orm_charge_ready_report, orm_get_ready_report
+from services.report_jobs import report_queue
 
 reports_router = Router(name="reports_router")
 
@@ -82,6 +82,19 @@ async def cb_set_store(callback: types.CallbackQuery, session: AsyncSession, sta
     await handle_generate_report(callback.message, callback.from_user.id, session, state)
 
 
+@reports_router.callback_query(F.data.startswith('pregen_'))
+async def cb_toggle_pregenerate(callback: types.CallbackQuery, session: AsyncSession) -> None:
+    """Callback toggle store night pre-generation"""
+    store_id = int(callback.data.split('_', 1)[1])
+    enabled = await orm_toggle_pregenerate(session, callback.from_user.id, store_id)
+    if enabled:
+        reply_text = 'Отчет за прошлую неделю будет готовиться ночью - в понедельник он придет сразу, без ожидания'
+    else:
+        reply_text = 'Ночная подготовка отчета выключена'
+    await callback.message.edit_reply_markup(reply_markup=await get_manage_kb(session, callback.from_user.id))
+    await callback.answer(reply_text, show_alert=True)
+
+
 class EditStore(StatesGroup):
     Name = State()
     Token = State()
@@ -138,7 +151,7 @@ async def cb_generate_report(callback: types.CallbackQuery, session: AsyncSessio
 
 
 async def handle_generate_report(msg: types.Message, tg_id, session: AsyncSession, state: FSMContext) -> None:
-    user = await orm_get_user(session, tg_id)
+    user = await orm_get_user(session, tg_id, fresh=True)
     if user.generations_left <= 0 and user.role not in {'admin', 'whitelist'}:
         reply_text = f'{user.first_name}, у Вас кончились генерации отчетов, оплатите бота'
         await msg.answer(
@@ -191,26 +204,27 @@ async def cmd_set_doc_num(msg: types.Message, state: FSMContext, session: AsyncS
     await msg.answer(reply_text)
     await state.clear()
 
-    dates = data['period']
-    doc_num = data['doc_num']
-    store_name = data['name']
-    store_token = data['token']
-    tg_id = data['user_id']
-    store_id = data['store_id']
-    date = datetime.strptime(dates.split('-')[0], "%d.%m.%Y").date()
-
-    try:
-        file_path = await run_with_progress(
-            msg,
-            "Формируется отчет, пожалуйста, подождите",
-            generate_report_with_params,
-            dates, doc_num, store_token, store_name, tg_id, store_id
-        )
-        await msg.answer_document(FSInputFile(file_path))
-        await orm_add_report(session, tg_id, date, file_path, store_id)
-        await orm_reduce_generations(session, tg_id)
-    except Exception as e:
-        await msg.answer(
-            text=f"Ошибка при формировании отчета:\n\n{e}",
-            reply_markup=get_menu_kb()
-        )
+    ready = await orm_get_ready_report(session, data['store_id'], data['period'], data['doc_num'], data['token'])
+    await orm_observe_ready_report(session, data['store_id'], data['period'], data['doc_num'], hit=ready is not None)
+    if ready:
+        # заранее сформированный отчёт списывается при первой выдаче, повторная выдача бесплатна
+        if await orm_charge_ready_report(session, ready.id, data['user_id']):
+            await msg.answer('Отчет за этот период уже сформирован - отправляем готовый файл.')
+        else:
+            await msg.answer('Отчет за этот период уже сформирован - отправляем готовый файл, генерация не списывается.')
+        await msg.answer_document(FSInputFile(ready.report_path), reply_markup=get_menu_kb())
+        return
+
+    _, position = await report_queue.enqueue(
+        session,
+        tg_id=data['user_id'],
+        chat_id=msg.chat.id,
+        store_id=data['store_id'],
+        period=data['period'],
+        doc_num=data['doc_num'],
+    )
+    reply_text = 'Отчет поставлен в очередь на формирование.\n'
+    if position:
+        reply_text += f'Ваше место в очереди: {position}\n'
+    reply_text += 'Мы пришлем файл, как только он будет готов.'
+    await msg.answer(reply_text)
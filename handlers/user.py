@@ -5,9 +5,9 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from keyboards.user_keyboards import get_main_kb, get_payment_kb, get_payment_check_kb
 from services.auth_service import orm_get_user
-from services.payment import create_payment, check_payment, orm_check_payment_exists, orm_add_payment, \
-    orm_add_generations
-from services.refs import generate_referral_link, orm_get_refs, orm_get_referrer, orm_add_bonus
+from services.payment import create_payment_async, check_payment_async, credit_payment, PaymentTimeout
+from services.payment_webhook import payment_webhook
+from services.refs import generate_referral_link, orm_get_refs
 
 user_router = Router(name="user_router")
 
@@ -28,7 +28,7 @@ async def cb_profile(callback: types.CallbackQuery, session: AsyncSession) -> No
 
 
 async def handle_profile(msg: types.Message, tg_id:int, session: AsyncSession) -> None:
-    user = await orm_get_user(session, tg_id)
+    user = await orm_get_user(session, tg_id, fresh=True)
     reply_text = 'Профиль!\n\n'
     reply_text += f'Генераций осталось: {user.generations_left}'
     await msg.answer(
@@ -41,7 +41,7 @@ async def handle_profile(msg: types.Message, tg_id:int, session: AsyncSession) -
 async def cb_refs(callback: types.CallbackQuery, session: AsyncSession) -> None:
     """Command refs"""
     user_id = int(callback.from_user.id)
-    user = await orm_get_user(session, user_id)
+    user = await orm_get_user(session, user_id, fresh=True)
     ref_link = await generate_referral_link(user_id)
     referrals = await orm_get_refs(session, user_id)
     reply_text = f'{callback.from_user.first_name}, ваша реферальная ссылка:\n'
@@ -98,10 +98,17 @@ async def cb_pay_for(callback: CallbackQuery):
     data = callback.data.split('_', 2)
     generations_num = data[1]
     amount = data[2]
-    payment_url, payment_id = create_payment(callback.from_user.id, generations_num, amount)
+    try:
+        payment_url, payment_id = await create_payment_async(callback.from_user.id, generations_num, amount)
+    except PaymentTimeout:
+        await callback.message.answer(text='Платежный сервис не отвечает, попробуйте чуть позже')
+        return
     reply_text = 'Ваша ссылка на оплату:\n'
     reply_text += f'{payment_url}\n\n'
-    reply_text += 'После того как проведете оплату нажмите на кнопку, чтобы проверить платеж'
+    if payment_webhook.port:
+        reply_text += 'Генерации начислятся автоматически после оплаты. Если этого не произошло, нажмите на кнопку'
+    else:
+        reply_text += 'После того как проведете оплату нажмите на кнопку, чтобы проверить платеж'
     await callback.message.answer(
         text=reply_text,
         reply_markup=get_payment_check_kb(payment_id)
@@ -111,19 +118,17 @@ async def cb_pay_for(callback: CallbackQuery):
 @user_router.callback_query(F.data.startswith('checkpayment_'))
 async def cb_check_payment(callback: CallbackQuery, session: AsyncSession):
     payment_id = callback.data.split('_', 1)[1]
-    result = check_payment(payment_id)
-    if await orm_check_payment_exists(session, payment_id):
-        reply_text = 'Вы уже получили генерации за этот платеж'
-    elif result:
-        generations_num = int(result['generations_num'])
-        tg_id = int(result['user_id'])
-        amount = int(result['amount'])
-        referrer = await orm_get_referrer(session, tg_id)
-        if referrer is not None:
-            await orm_add_bonus(session, referrer, amount)
-        await orm_add_generations(session, tg_id, generations_num)
-        await orm_add_payment(session, tg_id, amount, generations_num, payment_id)
+    try:
+        result = await check_payment_async(payment_id)
+    except PaymentTimeout:
+        result = None
+    generations_num = await credit_payment(session, payment_id, result) if result else None
+    if result is None:
+        reply_text = 'Платежный сервис не отвечает, попробуйте проверить оплату чуть позже'
+    elif generations_num is not None:
         reply_text = f'Оплата прошла успешно, Вам добавлено {generations_num} генераций\n\n'
+    elif result:
+        reply_text = 'Вы уже получили генерации за этот платеж'
     else:
         reply_text = 'Платеж еще не прошел'
     await callback.message.answer(
@@ -3,6 +3,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from services.manage_stores import orm_get_user_stores
 from services.report_generator import get_weeks_range
+from services.pregenerate import PREGENERATE_ENABLED
 
 
 def get_main_kb() -> InlineKeyboardMarkup:
@@ -66,11 +67,13 @@ async def get_manage_kb(session, tg_id) -> InlineKeyboardMarkup:
     ikb = InlineKeyboardBuilder()
     stores = await orm_get_user_stores(session=session, tg_id=tg_id)
     for store in stores:
-        ikb.add(
+        ikb.row(
             InlineKeyboardButton(text=f'Выбрать {store.name}', callback_data=f'setstore_{store.id}'),
             InlineKeyboardButton(text=f'Изменить {store.name}', callback_data=f'editstore_{store.id}'),
         )
-    ikb.adjust(2)
+        if PREGENERATE_ENABLED:
+            mark = 'вкл' if store.pregenerate else 'выкл'
+            ikb.row(InlineKeyboardButton(text=f'Отчет к понедельнику ({mark}) {store.name}', callback_data=f'pregen_{store.id}'))
     ikb.row(InlineKeyboardButton(text="Добавить магазин", callback_data='cb_btn_add_store'), )
 
     return ikb.as_markup()
@@ -20,6 +20,15 @@ from handlers.admin import admin_router
 from handlers.partners import partners_router
 from handlers.common import common_router
 
+from services.report_jobs import report_queue
+from services.cpu_pool import shutdown_cpu_pool
+from services.loop_monitor import loop_monitor
+from services.metrics import metrics_server
+from services.fsm_storage import make_fsm_storage
+from services.payment_webhook import payment_webhook
+from services.telegram_webhook import BOT_MODE, DROP_PENDING_UPDATES, telegram_webhook
+from services.pregenerate import PREGENERATE_ENABLED, pregenerator
+
 from common.bot_commands_list import user_commands
 
 # logging settings
@@ -31,7 +40,7 @@ logging.basicConfig(
 # Init bot and Dispatcher
 bot = Bot(token=os.getenv('TOKEN'))
 bot.admins_list = [205569815]
-dp = Dispatcher()
+dp = Dispatcher(storage=make_fsm_storage(session_maker))
 
 # Register routers
 dp.include_router(user_router)
@@ -48,9 +57,21 @@ async def on_startup(bot):
         await drop_db()
 
     await create_db()
+    loop_monitor.start()
+    await metrics_server.start()
+    await payment_webhook.start(bot, session_maker)
+    await report_queue.start(bot)
+    if PREGENERATE_ENABLED:
+        pregenerator.start(report_queue)
 
 
 async def on_shutdown(bot):
+    await payment_webhook.stop()
+    await pregenerator.stop()
+    await report_queue.stop()
+    await loop_monitor.stop()
+    await metrics_server.stop()
+    shutdown_cpu_pool()
     print('бот выключился')
 
 
@@ -64,9 +85,12 @@ async def main() -> None:
 
         dp.update.middleware(DataBaseSession(session_pool=session_maker))
 
-        await bot.delete_webhook(drop_pending_updates=True)
         await bot.set_my_commands(commands=user_commands, scope=types.BotCommandScopeAllPrivateChats())
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if BOT_MODE == 'webhook':
+            await telegram_webhook.run(dp, bot, allowed_updates=dp.resolve_used_update_types())
+        else:
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     except Exception as ex:
         logger.error(f"Bot stopped with error: {ex}")
     finally:
@@ -1,14 +1,31 @@
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import joinedload
 
 from database.models import User
+from services.ttl_cache import MISSING, USER_CACHE_SHARED, user_cache
 
 
-async def orm_get_user(session: AsyncSession, tg_id: int):
-    query = select(User).options(selectinload(User.selected_store)).where(User.tg_id == tg_id)
+async def orm_get_user(session: AsyncSession, tg_id: int, fresh: bool = False):
+    """
+    Пользователь с выбранным магазином; горячие обращения (меню, профиль) - из кэша.
+    Кэш у каждого экземпляра бота свой и не знает об изменениях, сделанных другими экземплярами
+    (списание генерации, оплата, выбор магазина): при USER_CACHE_SHARED баланс и генерации (fresh=True)
+    читаются мимо кэша. С одним экземпляром все изменения сбрасывают кэш сами (invalidate_user)
+    """
+    if not (fresh and USER_CACHE_SHARED):
+        user = user_cache.get(tg_id)
+        if user is not MISSING:
+            return user
+    query = select(User).options(joinedload(User.selected_store)).where(User.tg_id == tg_id)
     result = await session.execute(query)
-    return result.scalar_one_or_none()
+    user = result.scalar_one_or_none()
+    if user is not None:
+        if user.selected_store is not None:
+            session.expunge(user.selected_store)
+        session.expunge(user)
+        user_cache.set(tg_id, user)
+    return user
 
 async def orm_check_user_reg(session: AsyncSession, tg_id: int):
     user = await orm_get_user(session, tg_id)
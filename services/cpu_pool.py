@@ -0,0 +1,37 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from services.logging import logger
+
+
+# 0 - выполнять прямо в event loop (старое поведение, удобно для сравнения задержек loop)
+CPU_WORKERS = int(os.getenv('REPORT_CPU_WORKERS', 2))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def get_executor() -> Optional[ProcessPoolExecutor]:
+    global _executor
+    if _executor is None and CPU_WORKERS > 0:
+        # spawn: дочерние процессы не наследуют потоки/сокеты бота
+        _executor = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        logger.info('Пул процессов для отчётов: %d', CPU_WORKERS)
+    return _executor
+
+
+async def run_cpu(func: Callable[..., Any], *args) -> Any:
+    """Выполняет CPU-bound функцию в пуле процессов, не блокируя event loop"""
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def shutdown_cpu_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
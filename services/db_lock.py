@@ -0,0 +1,37 @@
+import os
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.models import AppLock
+
+
+# Имя экземпляра бота в блокировках и аренде заданий. Постоянное INSTANCE_ID (например, имя сервиса)
+# позволяет после перезапуска сразу забрать свои задания, не дожидаясь конца аренды
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f'{socket.gethostname()}:{os.getpid()}'
+
+
+async def orm_try_lock(session: AsyncSession, name: str, ttl: float, owner: str = INSTANCE_ID) -> bool:
+    """Берёт или продлевает блокировку name на ttl секунд. False - её держит другой экземпляр"""
+    now = datetime.now()
+    until = now + timedelta(seconds=ttl)
+    query = update(AppLock).where(
+        AppLock.name == name, or_(AppLock.owner == owner, AppLock.locked_until < now)
+    ).values(owner=owner, locked_until=until)
+    if (await session.execute(query)).rowcount == 0:
+        try:
+            session.add(AppLock(name=name, owner=owner, locked_until=until))
+            await session.flush()
+        except IntegrityError:
+            await session.rollback()
+            return False
+    await session.commit()
+    return True
+
+
+async def orm_release_lock(session: AsyncSession, name: str, owner: str = INSTANCE_ID):
+    await session.execute(delete(AppLock).where(AppLock.name == name, AppLock.owner == owner))
+    await session.commit()
@@ -0,0 +1,72 @@
+import json
+import os
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.models import FSMState
+from services.logging import logger
+
+
+# Где живут состояния FSM (AddStore, EditStore, Report, Registration) и их данные:
+# memory - в процессе, только для одного экземпляра бота; db - таблица fsm_state в общей БД (DB_URL),
+# несколько экземпляров бота видят одно и то же состояние пользователя
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+
+
+class DBStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_state: одна строка на ключ (бот, чат, пользователь), data - JSON"""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    @staticmethod
+    def _upsert(session: AsyncSession, key: str, **values):
+        insert = postgresql.insert if session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+        return insert(FSMState).values(key=key, **values).on_conflict_do_update(
+            index_elements=['key'], set_={**values, 'updated': func.now()}
+        )
+
+    async def _write(self, key: StorageKey, **values) -> None:
+        db_key = self.key_builder.build(key)
+        async with self.session_pool() as session:
+            await session.execute(self._upsert(session, db_key, **values))
+            # пустое состояние без данных (state.clear()) не храним
+            await session.execute(delete(FSMState).where(
+                FSMState.key == db_key, FSMState.state.is_(None), FSMState.data == '{}'
+            ))
+            await session.commit()
+
+    async def _read(self, key: StorageKey) -> Optional[FSMState]:
+        async with self.session_pool() as session:
+            return await session.scalar(select(FSMState).where(FSMState.key == self.key_builder.build(key)))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._read(key)
+        return row.state if row is not None else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._write(key, data=json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._read(key)
+        return json.loads(row.data) if row is not None else {}
+
+    async def close(self) -> None:
+        pass
+
+
+def make_fsm_storage(session_pool: async_sessionmaker) -> BaseStorage:
+    if FSM_STORAGE == 'db':
+        logger.info('Состояния FSM хранятся в БД (fsm_state)')
+        return DBStorage(session_pool)
+    return MemoryStorage()
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional
+
+from services.logging import logger
+from services.metrics import LOOP_LAG
+
+
+LOOP_MONITOR_INTERVAL = 0.1
+LOOP_BLOCKED_THRESHOLD = float(os.getenv('LOOP_BLOCKED_THRESHOLD', 0.1))
+LOOP_REPORT_EVERY = 60
+
+
+class LoopMonitor:
+    """
+    Измеряет, насколько event loop не успевает просыпаться вовремя (lag); каждый замер - в гистограмму
+    event_loop_lag_seconds (/metrics). Любой lag выше порога считается блокировкой loop: копим их число,
+    суммарное и максимальное время.
+    """
+
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL, threshold: float = LOOP_BLOCKED_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked_count = 0
+        self.blocked_total = 0.0
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            'blocked_count': self.blocked_count,
+            'blocked_seconds': round(self.blocked_total, 3),
+            'max_lag_seconds': round(self.max_lag, 3),
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        last_report = time.monotonic()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - started - self.interval, 0.0)
+            LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.blocked_count += 1
+                self.blocked_total += lag
+                logger.warning('Event loop заблокирован на %.3f с', lag)
+            if now - last_report > LOOP_REPORT_EVERY:
+                logger.info('Event loop: %s', self.snapshot())
+                last_report = now
+
+
+loop_monitor = LoopMonitor()
@@ -1,7 +1,8 @@
 from sqlalchemy import select, update, delete
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import Store, User
+from database.models import Report, Store, User
+from services.ttl_cache import MISSING, invalidate_user, stores_cache
 
 
 async def orm_add_store(session: AsyncSession, store_data: dict):
@@ -16,12 +17,20 @@ async def orm_add_store(session: AsyncSession, store_data: dict):
     query = update(User).where(User.tg_id == store_data['tg_id']).values(selected_store_id = store_id)
     await session.execute(query)
     await session.commit()
+    invalidate_user(store_data['tg_id'])
 
 
 async def orm_get_user_stores(session: AsyncSession, tg_id: int):
+    stores = stores_cache.get(tg_id)
+    if stores is not MISSING:
+        return stores
     query = select(Store).where(Store.tg_id == tg_id)
     result = await session.execute(query)
-    return result.scalars().all()
+    stores = result.scalars().all()
+    for store in stores:
+        session.expunge(store)
+    stores_cache.set(tg_id, stores)
+    return stores
 
 
 async def orm_get_store(session: AsyncSession, id: int):
@@ -31,12 +40,36 @@ async def orm_get_store(session: AsyncSession, id: int):
 
 
 async def orm_edit_store(session: AsyncSession, store_data: dict):
+    store = await session.get(Store, store_data['store_id'])
+    if store is not None and store.token != store_data['token']:
+        # отчёты по старому токену больше не отдаём из кэша
+        query = update(Report).where(Report.store_id == store.id).values(content_hash = None)
+        await session.execute(query)
     query = update(Store).where(Store.id == store_data['store_id']).values(name = store_data['name'], token = store_data['token'])
     await session.execute(query)
     await session.commit()
+    if store is not None:
+        invalidate_user(store.tg_id)
+
+
+async def orm_toggle_pregenerate(session: AsyncSession, tg_id: int, store_id: int) -> bool:
+    store = await session.get(Store, store_id)
+    if store is None or store.tg_id != tg_id:
+        return False
+    store.pregenerate = not store.pregenerate
+    await session.commit()
+    invalidate_user(tg_id)
+    return store.pregenerate
+
+
+async def orm_get_pregenerate_stores(session: AsyncSession):
+    query = select(Store).where(Store.pregenerate.is_(True)).order_by(Store.id)
+    result = await session.execute(query)
+    return result.scalars().all()
 
 
 async def orm_set_store(session: AsyncSession, tg_id: int, store_id: int):
     query = update(User).where(User.tg_id == tg_id).values(selected_store_id = store_id)
     await session.execute(query)
     await session.commit()
+    invalidate_user(tg_id)
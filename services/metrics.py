@@ -0,0 +1,230 @@
+import contextvars
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+
+from services.logging import logger
+from services.wb_cache import hash_token
+
+
+# Метрики генерации отчётов в формате Prometheus (text exposition) на локальном порту.
+# METRICS_PORT=0 - эндпоинт не поднимается, метрики всё равно копятся и пишутся в лог.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+WB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def store_tag(token: str) -> str:
+    """Метка магазина в метриках и логах - короткий хэш токена, не сам токен"""
+    return hash_token(token)[:12]
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, value: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels(self.labelnames, k)} {v:g}' for k, v in sorted(self.values.items())]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = STAGE_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.values: Dict[Tuple[str, ...], List[float]] = {}  # счётчики по бакетам и +Inf + [sum, count]
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0.0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1  # последний бакет - +Inf
+        counts[-2] += value
+        counts[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0.0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative:g}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {counts[-2]:.6g}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {counts[-1]:g}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('report_stage_seconds', 'Длительность этапа генерации отчёта', ('stage', 'store'))
+STAGE_ERRORS = registry.counter('report_stage_errors_total', 'Этапы, завершившиеся ошибкой', ('stage', 'store'))
+STAGE_ROWS = registry.counter('report_stage_rows_total', 'Строк обработано на этапе', ('stage', 'store'))
+STAGE_BYTES = registry.counter('report_stage_wb_bytes_total', 'Байт получено от WB на этапе', ('stage', 'store'))
+WB_SECONDS = registry.histogram('wb_request_seconds', 'Запрос к WB вместе с повторами и ожиданием лимитов',
+                                ('endpoint', 'store'), WB_BUCKETS)
+WB_RESPONSES = registry.counter('wb_responses_total', 'Ответы WB по кодам', ('endpoint', 'status'))
+WB_BYTES = registry.counter('wb_response_bytes_total', 'Байт получено от WB', ('endpoint', 'store'))
+WB_RETRIES = registry.counter('wb_retries_total', 'Повторы запросов к WB', ('endpoint', 'store'))
+WB_THROTTLED = registry.counter('wb_throttled_total', 'Ответы 429 от WB', ('endpoint', 'store'))
+CACHE_REQUESTS = registry.counter('cache_requests_total', 'Обращения к кэшу записей БД', ('cache', 'result'))
+LOOP_LAG = registry.histogram('event_loop_lag_seconds', 'Запаздывание пробуждения event loop (services/loop_monitor.py)',
+                              buckets=LOOP_BUCKETS)
+PAYMENT_SECONDS = registry.histogram('payment_api_seconds', 'Вызов API ЮKassa', ('method',), WB_BUCKETS)
+PAYMENT_NOTIFICATIONS = registry.counter('payment_notifications_total', 'Уведомления ЮKassa по результату', ('result',))
+READY_REPORTS = registry.counter('ready_reports_total', 'Запросы отчёта за закрытую неделю: готовый файл отдан, '
+                                 'есть только с другими номерами документов, нет', ('result',))
+
+
+class StageTrace:
+    """
+    Замер одного этапа генерации: время, строки, байты/запросы/повторы/429 от WB.
+    Пока этап выполняется, он текущий (contextvar) - wb_client дописывает в него свои запросы.
+
+        with StageTrace('sales', store) as trace:
+            agg = await aggregate_sales_async(...)
+            trace.rows = agg.rows
+    """
+
+    def __init__(self, stage: str, store: str):
+        self.stage = stage
+        self.store = store
+        self.rows = 0
+        self.wb_bytes = 0
+        self.wb_calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.seconds = 0.0
+        self._started = 0.0
+        self._token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> 'StageTrace':
+        self._started = time.perf_counter()
+        self._token = current_stage.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        current_stage.reset(self._token)
+        self.record(time.perf_counter() - self._started, error=exc_type is not None)
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        self.seconds = seconds
+        STAGE_SECONDS.observe(seconds, self.stage, self.store)
+        STAGE_ROWS.inc(self.stage, self.store, value=self.rows)
+        STAGE_BYTES.inc(self.stage, self.store, value=self.wb_bytes)
+        if error:
+            STAGE_ERRORS.inc(self.stage, self.store)
+        logger.info(
+            'stage=%s store=%s status=%s seconds=%.3f rows=%d wb_calls=%d wb_bytes=%d retries=%d throttled=%d',
+            self.stage, self.store, 'error' if error else 'ok', seconds,
+            self.rows, self.wb_calls, self.wb_bytes, self.retries, self.throttled
+        )
+
+
+current_stage: contextvars.ContextVar[Optional[StageTrace]] = contextvars.ContextVar('current_stage', default=None)
+
+
+async def traced(stage: str, store: str, coro: Awaitable, rows: Callable[[Any], int] = len) -> Any:
+    """Выполняет coro как этап отчёта; rows - сколько строк в результате"""
+    with StageTrace(stage, store) as trace:
+        result = await coro
+        trace.rows = rows(result)
+        return result
+
+
+def observe_stage(stage: str, store: str, seconds: float, rows: int = 0) -> None:
+    """Этап, замеренный не здесь (например, в пуле процессов)"""
+    trace = StageTrace(stage, store)
+    trace.rows = rows
+    trace.record(seconds)
+
+
+def observe_wb_call(endpoint: str, token: str, seconds: float, status: Optional[int], size: int,
+                    retries: int, throttled: int) -> None:
+    """Один запрос wb_client (со всеми его повторами)"""
+    store = store_tag(token)
+    WB_SECONDS.observe(seconds, endpoint, store)
+    WB_RESPONSES.inc(endpoint, str(status or 'error'))
+    WB_BYTES.inc(endpoint, store, value=size)
+    if retries:
+        WB_RETRIES.inc(endpoint, store, value=retries)
+    if throttled:
+        WB_THROTTLED.inc(endpoint, store, value=throttled)
+    trace = current_stage.get()
+    if trace is not None:
+        trace.wb_calls += 1
+        trace.wb_bytes += size
+        trace.retries += retries
+        trace.throttled += throttled
+    logger.debug('wb endpoint=%s store=%s status=%s seconds=%.3f bytes=%d retries=%d throttled=%d stage=%s',
+                 endpoint, store, status, seconds, size, retries, throttled, trace.stage if trace else '-')
+
+
+class MetricsServer:
+    """GET /metrics на METRICS_HOST:METRICS_PORT"""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def start(self) -> None:
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info('Метрики: http://%s:%d/metrics', self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
@@ -1,20 +1,45 @@
+import asyncio
+import time
 import yookassa
 import uuid
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
 
 from sqlalchemy import update, select, exists
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database.models import User, Payment
+from services.logging import logger
+from services.metrics import PAYMENT_SECONDS
+from services.refs import orm_get_referrer, bonus_update
+from services.ttl_cache import invalidate_user
 
 
-yookassa.Configuration.configure(f'{os.getenv("UKASSA_ACCOUNT_ID")}', f'{os.getenv("UKASSA_SECRET_KEY")}')
+# YOOKASSA_API_URL меняют только для стенда с локальной заглушкой ЮKassa
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+PAYMENT_TIMEOUT = float(os.getenv('PAYMENT_TIMEOUT', 15))
+PAYMENT_THREADS = int(os.getenv('PAYMENT_THREADS', 4))
+
+yookassa.Configuration.configure(
+    f'{os.getenv("UKASSA_ACCOUNT_ID")}', f'{os.getenv("UKASSA_SECRET_KEY")}', api_url=YOOKASSA_API_URL
+)
+
+# SDK ЮKassa синхронный (requests) и без таймаута на сокет: вызовы идут в свой пул потоков,
+# чтобы зависший запрос к ЮKassa не занимал потоки asyncio.to_thread (кэш WB, хранилище продаж)
+_executor = ThreadPoolExecutor(max_workers=PAYMENT_THREADS, thread_name_prefix='yookassa')
+
+
+class PaymentTimeout(TimeoutError):
+    pass
 
 
 async def orm_reduce_generations(session: AsyncSession, tg_id:int):
     query = update(User).where(User.tg_id == tg_id).values(generations_left=User.generations_left - 1)
     await session.execute(query)
     await session.commit()
+    invalidate_user(tg_id)
 
 
 def create_payment(tg_id, generations_num, amount):
@@ -50,16 +75,43 @@ def check_payment(payment_id):
         return False
 
 
+async def _call_sdk(method: str, func, *args):
+    """Вызов SDK в пуле потоков с таймаутом PAYMENT_TIMEOUT; loop в это время обслуживает других"""
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(_executor, func, *args), PAYMENT_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning('ЮKassa: %s не ответил за %.0f с', method, PAYMENT_TIMEOUT)
+        raise PaymentTimeout(method) from None
+    finally:
+        PAYMENT_SECONDS.observe(time.monotonic() - started, method)
+
+
+async def create_payment_async(tg_id, generations_num, amount) -> Tuple[str, str]:
+    """create_payment без блокировки loop: (ссылка на оплату, id платежа)"""
+    return await _call_sdk('create', create_payment, tg_id, generations_num, amount)
+
+
+async def check_payment_async(payment_id: str):
+    """check_payment без блокировки loop: metadata успешного платежа или False"""
+    return await _call_sdk('find_one', check_payment, payment_id)
+
+
 async def orm_check_payment_exists(session: AsyncSession, yoo_id: str) -> bool:
     query = select(exists().where(Payment.yoo_id == yoo_id))
     result = await session.execute(query)
     return result.scalar()
 
 
+def generations_update(tg_id: int, generations_num: int):
+    return update(User).where(User.tg_id == tg_id).values(generations_left=User.generations_left + generations_num)
+
+
 async def orm_add_generations(session: AsyncSession, tg_id: int, generations_num: int):
-    query = update(User).where(User.tg_id == tg_id).values(generations_left=User.generations_left + generations_num)
-    await session.execute(query)
+    await session.execute(generations_update(tg_id, generations_num))
     await session.commit()
+    invalidate_user(tg_id)
 
 
 async def orm_add_payment(session: AsyncSession, tg_id: int, amount: int, generations_num: int, yoo_id: str):
@@ -70,4 +122,42 @@ async def orm_add_payment(session: AsyncSession, tg_id: int, amount: int, genera
         yoo_id=yoo_id
     )
     session.add(obj)
-    await session.commit()
\ No newline at end of file
+    await session.commit()
+
+
+async def orm_settle_payment(session: AsyncSession, yoo_id: str, tg_id: int, amount: int, generations_num: int) -> bool:
+    """
+    Зачисление платежа одной транзакцией: запись Payment, генерации пользователю, бонус рефереру.
+    Повтор по уникальному yoo_id (uq_payment_yoo_id) откатывается целиком - False, платёж уже зачислен.
+    INSERT идёт первым: транзакция сразу берёт блокировку на запись, параллельный повтор ждёт её и упирается в индекс
+    """
+    try:
+        session.add(Payment(tg_id=tg_id, amount=amount, generations_num=generations_num, yoo_id=yoo_id))
+        await session.flush()
+        await session.execute(generations_update(tg_id, generations_num))
+        referrer = await orm_get_referrer(session, tg_id)
+        if referrer is not None:
+            await session.execute(bonus_update(referrer, amount))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        if not await orm_check_payment_exists(session, yoo_id):
+            raise  # не дубль, а, например, нет такого пользователя
+        return False
+    invalidate_user(tg_id)
+    if referrer is not None:
+        invalidate_user(referrer)
+    return True
+
+
+async def credit_payment(session: AsyncSession, payment_id: str, metadata: Dict[str, Any]) -> Optional[int]:
+    """
+    Зачисляет успешный платёж (metadata из check_payment).
+    Возвращает число зачисленных генераций или None, если платёж уже был зачислен
+    """
+    generations_num = int(metadata['generations_num'])
+    tg_id = int(metadata['user_id'])
+    if not await orm_settle_payment(session, payment_id, tg_id, int(metadata['amount']), generations_num):
+        return None
+    logger.info('Платёж %s: пользователю %d зачислено %d генераций', payment_id, tg_id, generations_num)
+    return generations_num
@@ -0,0 +1,98 @@
+import os
+from typing import Optional
+
+from aiogram import Bot
+from aiohttp import web
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from keyboards.user_keyboards import get_main_kb
+from services.logging import logger
+from services.metrics import PAYMENT_NOTIFICATIONS
+from services.payment import check_payment_async, credit_payment
+
+
+# Приём HTTP-уведомлений ЮKassa (payment.succeeded): генерации зачисляются сразу после оплаты,
+# кнопка "Проверить оплату" остаётся запасным путём. Снаружи endpoint публикуется через reverse proxy (HTTPS),
+# в личном кабинете ЮKassa указывается https://<домен><PAYMENT_WEBHOOK_PATH>
+PAYMENT_WEBHOOK_HOST = os.getenv('PAYMENT_WEBHOOK_HOST', '127.0.0.1')
+PAYMENT_WEBHOOK_PORT = int(os.getenv('PAYMENT_WEBHOOK_PORT', 0))  # 0 - выключено
+PAYMENT_WEBHOOK_PATH = os.getenv('PAYMENT_WEBHOOK_PATH', '/yookassa/webhook')
+
+
+class PaymentWebhook:
+    """
+    POST PAYMENT_WEBHOOK_PATH на PAYMENT_WEBHOOK_HOST:PAYMENT_WEBHOOK_PORT.
+    Телу уведомления не доверяем: статус и metadata платежа перечитываются из API ЮKassa.
+    На любой ответ кроме 200 ЮKassa повторяет уведомление, поэтому 200 - только когда платёж обработан
+    """
+
+    def __init__(self, host: str = PAYMENT_WEBHOOK_HOST, port: int = PAYMENT_WEBHOOK_PORT, path: str = PAYMENT_WEBHOOK_PATH):
+        self.host = host
+        self.port = port
+        self.path = path
+        self._bot: Optional[Bot] = None
+        self._session_pool: Optional[async_sessionmaker] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _notify(self, tg_id: int, generations_num: int) -> None:
+        if self._bot is None:
+            return
+        try:
+            await self._bot.send_message(
+                chat_id=tg_id,
+                text=f'Оплата прошла успешно, Вам добавлено {generations_num} генераций\n\n',
+                reply_markup=get_main_kb()
+            )
+        except Exception as e:
+            logger.warning('Не удалось сообщить пользователю %d о зачислении: %s', tg_id, e)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            event, payment_id = body['event'], body['object']['id']
+        except (ValueError, KeyError, TypeError):
+            PAYMENT_NOTIFICATIONS.inc('bad_request')
+            return web.Response(status=400)
+        if event != 'payment.succeeded':
+            PAYMENT_NOTIFICATIONS.inc('ignored')
+            return web.Response()
+        try:
+            metadata = await check_payment_async(payment_id)
+        except Exception as e:
+            logger.warning('Уведомление ЮKassa %s: не удалось проверить платёж: %s', payment_id, e)
+            PAYMENT_NOTIFICATIONS.inc('error')
+            return web.Response(status=503)
+        if not metadata:
+            PAYMENT_NOTIFICATIONS.inc('not_succeeded')
+            return web.Response()
+        async with self._session_pool() as session:
+            generations_num = await credit_payment(session, payment_id, metadata)
+        if generations_num is None:
+            PAYMENT_NOTIFICATIONS.inc('duplicate')
+            return web.Response()
+        PAYMENT_NOTIFICATIONS.inc('credited')
+        await self._notify(int(metadata['user_id']), generations_num)
+        return web.Response()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        return app
+
+    async def start(self, bot: Optional[Bot], session_pool: async_sessionmaker) -> None:
+        self._bot = bot
+        self._session_pool = session_pool
+        if not self.port or self._runner is not None:
+            return
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info('Уведомления ЮKassa: http://%s:%d%s', self.host, self.port, self.path)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+payment_webhook = PaymentWebhook()
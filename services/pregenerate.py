@@ -0,0 +1,152 @@
+import asyncio
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.engine import session_maker
+from database.models import Report, Store
+from services.db_lock import orm_try_lock
+from services.logging import logger
+from services.manage_stores import orm_get_pregenerate_stores
+from services.metrics import READY_REPORTS
+from services.report_generator import (
+    aggregate_sales_async, get_dates_from_str, get_weeks_range, normalize_doc_number, orm_get_ready_report
+)
+from services.wb_cache import is_closed_period
+
+
+# Включается явно: PREGENERATE=1. Окно - локальное время сервера, может переходить через полночь
+PREGENERATE_ENABLED = os.getenv('PREGENERATE', '0') == '1'
+PREGENERATE_WINDOW = os.getenv('PREGENERATE_WINDOW', '01:00-06:00')
+# В какие ночи (день недели начала окна, 0 - понедельник) генерируем: WB публикует финотчёт за неделю
+# в понедельник, поэтому первая попытка - в ночь на вторник; в ночь на среду - магазины, по которым
+# детализация ещё была пустой. Уже сформированные отчёты повторно не ставятся
+PREGENERATE_DAYS = {int(day) for day in os.getenv('PREGENERATE_DAYS', '1,2').split(',')}
+# "Если у Вас такого нету введите 123" - что вводит пользователь без документов ВБ.Продвижения
+NO_PROMOTION_DOCS = '123'
+
+
+async def orm_observe_ready_report(session: AsyncSession, store_id: int, period: str, doc_num: str, hit: bool) -> None:
+    """
+    Доля запросов, закрытых готовым отчётом. Промах при наличии отчёта за ту же неделю с другими номерами
+    документов - номера, выведенные из детализации, не совпали с тем, что ввёл пользователь
+    """
+    start_date, end_date = get_dates_from_str(period)
+    if not is_closed_period(end_date):
+        return  # за текущую неделю готовых отчётов не бывает
+    if hit:
+        READY_REPORTS.inc('hit')
+        return
+    query = select(Report.doc_num).where(
+        Report.store_id == store_id,
+        Report.date_of_week == date.fromisoformat(start_date),
+        Report.content_hash.is_not(None),
+    ).order_by(Report.id.desc()).limit(1)
+    ready_doc_num = await session.scalar(query)
+    if ready_doc_num is None:
+        READY_REPORTS.inc('miss')
+        return
+    READY_REPORTS.inc('doc_mismatch')
+    logger.info('Готовый отчёт не подошёл: магазин %d, неделя %s, введено "%s", сформирован для "%s"',
+                store_id, period, normalize_doc_number(doc_num or ''), ready_doc_num)
+
+
+def next_window(now: datetime, window: str = PREGENERATE_WINDOW) -> Tuple[datetime, datetime]:
+    """Текущее или ближайшее окно ночной генерации: начало и конец"""
+    start_str, end_str = window.split('-')
+    start_t, end_t = time.fromisoformat(start_str.strip()), time.fromisoformat(end_str.strip())
+    duration = (datetime.combine(now.date(), end_t) - datetime.combine(now.date(), start_t)) % timedelta(days=1)
+    for days in (-1, 0, 1):
+        start = datetime.combine(now.date() + timedelta(days=days), start_t)
+        if start + duration > now:
+            return start, start + duration
+    raise ValueError(f'Некорректное окно генерации: {window}')
+
+
+class WeeklyPreGenerator:
+    """
+    Ночная генерация отчёта за прошлую неделю для магазинов с включённым pregenerate - в ночи PREGENERATE_DAYS,
+    после публикации недели на WB. Магазины равномерно разнесены по окну PREGENERATE_WINDOW, чтобы не упираться
+    в лимиты WB и не создавать пик нагрузки. Отчёт ставится в общую очередь без чата и без списания генерации,
+    попадает в data/reports и таблицу report - утром пользователь получает его сразу (orm_get_ready_report);
+    генерация списывается при первой выдаче (orm_charge_ready_report).
+    """
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+        self.queue = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, queue) -> None:
+        self.queue = queue
+        self._task = asyncio.create_task(self._run())
+        logger.info('Ночная генерация отчётов включена, окно %s', PREGENERATE_WINDOW)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            start, end = next_window(datetime.now())
+            wait = (start - datetime.now()).total_seconds()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if start.weekday() not in PREGENERATE_DAYS:
+                await asyncio.sleep(max((end - datetime.now()).total_seconds(), 0) + 1)
+                continue
+            try:
+                # при нескольких экземплярах бота окно обслуживает тот, кто первым взял блокировку
+                async with self.session_pool() as session:
+                    acquired = await orm_try_lock(session, 'pregenerate', (end - datetime.now()).total_seconds())
+                if acquired:
+                    await self.run_window(end)
+                else:
+                    logger.info('Ночная генерация: окно обслуживает другой экземпляр бота')
+            except Exception as e:
+                logger.error('Ночная генерация: ошибка: %s', e)
+            await asyncio.sleep(max((end - datetime.now()).total_seconds(), 0) + 1)
+
+    async def run_window(self, until: datetime) -> None:
+        period = get_weeks_range(1)[0]
+        async with self.session_pool() as session:
+            stores = await orm_get_pregenerate_stores(session)
+        if not stores:
+            return
+        started = datetime.now()
+        step = max((until - started).total_seconds(), 0) / len(stores)
+        logger.info('Ночная генерация за %s: %d магазинов, шаг %.0f с', period, len(stores), step)
+        for n, store in enumerate(stores):
+            delay = (started + timedelta(seconds=n * step) - datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.prepare(store, period)
+            except Exception as e:
+                logger.warning('Ночная генерация: магазин %d пропущен: %s', store.id, e)
+
+    async def prepare(self, store: Store, period: str) -> None:
+        """
+        Номера документов ВБ.Продвижения берём из детализации (их же пользователь видит в финотчёте).
+        Детализация при этом попадает в кэш WB и повторно не запрашивается.
+        """
+        start_date, end_date = get_dates_from_str(period)
+        sales = await aggregate_sales_async(f"{start_date}T00:00:00", f"{end_date}T23:59:59", store.token)
+        if not sales.rows:
+            logger.info('Ночная генерация: магазин %d, детализация за %s ещё пуста - повторим в следующую ночь',
+                        store.id, period)
+            return
+        doc_num = normalize_doc_number(" ".join(sales.promotion_docs)) or NO_PROMOTION_DOCS
+        async with self.session_pool() as session:
+            if await orm_get_ready_report(session, store.id, period, doc_num, store.token):
+                return
+            job_id, _ = await self.queue.enqueue(session, store.tg_id, None, store.id, period, doc_num)
+        logger.info('Ночная генерация: магазин %d, документы "%s" - задание %d', store.id, doc_num, job_id)
+
+
+pregenerator = WeeklyPreGenerator(session_maker)
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, delete
+
+from database.engine import session_maker
+from database.models import CardCatalog, ProductCard
+from services.logging import logger
+from services.wb_cache import hash_token
+from services.wb_client import wb_client
+
+
+CARDS_URL = "https://content-api.wildberries.ru/content/v2/get/cards/list"
+CARDS_PAGE_LIMIT = 100
+CARDS_TTL = int(os.getenv('CARDS_TTL', 6 * 3600))
+
+
+class CardCatalogue:
+    """
+    Справочник карточек магазина: отсортированный массив nmID + параллельные массивы
+    артикулов продавца и названий. Поиск - бинарный (np.searchsorted), без словаря словарей.
+    """
+
+    def __init__(self, nm_ids: np.ndarray, vendor_codes: np.ndarray, names: np.ndarray):
+        order = np.argsort(nm_ids, kind='stable')
+        self.nm_ids = nm_ids[order]
+        self.vendor_codes = vendor_codes[order]
+        self.names = names[order]
+        self.loaded_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.nm_ids)
+
+    def lookup(self, nm_ids: pd.Series) -> Tuple[pd.Series, pd.Series]:
+        """Артикулы продавца и названия для серии nmID, NaN - если карточки нет"""
+        if not len(self):
+            missing = pd.Series(None, index=nm_ids.index, dtype=object)
+            return missing, missing.copy()
+        keys = pd.to_numeric(nm_ids, errors='coerce').fillna(-1).astype('int64').to_numpy()
+        pos = np.searchsorted(self.nm_ids, keys).clip(max=len(self) - 1)
+        found = self.nm_ids[pos] == keys
+        vendor = pd.Series(np.where(found, self.vendor_codes[pos], None), index=nm_ids.index)
+        name = pd.Series(np.where(found, self.names[pos], None), index=nm_ids.index)
+        return vendor, name
+
+
+_catalogues: Dict[str, CardCatalogue] = {}
+_locks: Dict[str, asyncio.Lock] = {}
+
+
+async def fetch_cards_since(token: str, cursor: Optional[dict]) -> Tuple[List[tuple], Optional[dict]]:
+    """
+    Карточки, изменённые после курсора (updatedAt, nmID), по возрастанию updatedAt.
+    Возвращает строки (nm_id, vendor_code, name) и новый курсор.
+    """
+    headers = {"Content-Type": "application/json"}
+    page_cursor = {"limit": CARDS_PAGE_LIMIT, **(cursor or {})}
+    rows: List[tuple] = []
+    while True:
+        payload = {"settings": {
+            "sort": {"ascending": True},
+            "cursor": page_cursor,
+            "filter": {"withPhoto": -1},
+        }}
+        resp = await wb_client.post(CARDS_URL, token, headers=headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+        cards = data.get("cards", [])
+        for c in cards:
+            nm_id = c.get("nmID") or c.get("nmId")
+            if not nm_id:
+                continue
+            rows.append((
+                int(nm_id),
+                (c.get("vendorCode") or "").strip(),
+                (c.get("name") or c.get("nmName") or "").strip(),
+            ))
+        next_cursor = data.get("cursor") or {}
+        if next_cursor.get("updatedAt") and next_cursor.get("nmID"):
+            cursor = {"updatedAt": next_cursor["updatedAt"], "nmID": next_cursor["nmID"]}
+            page_cursor = {"limit": CARDS_PAGE_LIMIT, **cursor}
+        if len(cards) < CARDS_PAGE_LIMIT:
+            break
+    return rows, cursor
+
+
+async def orm_refresh_cards(token: str) -> CardCatalogue:
+    """Догружает изменённые карточки в БД по сохранённому курсору и собирает справочник"""
+    key = hash_token(token)
+    async with session_maker() as session:
+        state = await session.get(CardCatalog, key)
+        cursor = None
+        if state is not None and state.cursor_updated_at:
+            cursor = {"updatedAt": state.cursor_updated_at, "nmID": state.cursor_nm_id}
+        rows, new_cursor = await fetch_cards_since(token, cursor)
+        if rows:
+            latest = {nm_id: (vendor, name) for nm_id, vendor, name in rows}
+            ids = list(latest)
+            for i in range(0, len(ids), 500):
+                await session.execute(delete(ProductCard).where(
+                    ProductCard.token_hash == key, ProductCard.nm_id.in_(ids[i:i + 500])
+                ))
+            session.add_all([
+                ProductCard(token_hash=key, nm_id=nm_id, vendor_code=vendor, nm_name=name)
+                for nm_id, (vendor, name) in latest.items()
+            ])
+        if state is None:
+            state = CardCatalog(token_hash=key)
+            session.add(state)
+        if new_cursor:
+            state.cursor_updated_at = new_cursor["updatedAt"]
+            state.cursor_nm_id = new_cursor["nmID"]
+        await session.commit()
+
+        result = await session.execute(
+            select(ProductCard.nm_id, ProductCard.vendor_code, ProductCard.nm_name)
+            .where(ProductCard.token_hash == key)
+        )
+        stored = result.all()
+    logger.info("Справочник карточек обновлён: +%d изменённых, всего %d", len(rows), len(stored))
+    return CardCatalogue(
+        np.fromiter((r[0] for r in stored), dtype='int64', count=len(stored)),
+        np.array([r[1] for r in stored], dtype=object),
+        np.array([r[2] for r in stored], dtype=object),
+    )
+
+
+async def get_card_catalogue(token: str) -> CardCatalogue:
+    """Справочник карточек по токену; в памяти живёт CARDS_TTL секунд, затем обновляется инкрементально"""
+    key = hash_token(token)
+    catalogue = _catalogues.get(key)
+    if catalogue is not None and time.monotonic() - catalogue.loaded_at < CARDS_TTL:
+        return catalogue
+    lock = _locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        catalogue = _catalogues.get(key)
+        if catalogue is not None and time.monotonic() - catalogue.loaded_at < CARDS_TTL:
+            return catalogue
+        catalogue = await orm_refresh_cards(token)
+        _catalogues[key] = catalogue
+        return catalogue
@@ -3,6 +3,7 @@ from sqlalchemy import select, update, exists
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from database.models import Ref, User
+from services.ttl_cache import invalidate_user
 
 
 async def generate_referral_link(user_id: int) -> str:
@@ -39,11 +40,16 @@ async def orm_get_referrer(session: AsyncSession, referral_id: int):
     return result.scalar_one_or_none()
 
 
-async def orm_add_bonus(session: AsyncSession, tg_id: int, amount: int):
+def bonus_update(tg_id: int, amount: int):
+    """Бонус рефереру - 10% суммы платежа реферала"""
     bonus = amount // 10
-    query = update(User).where(User.tg_id == tg_id).values(
+    return update(User).where(User.tg_id == tg_id).values(
         bonus_left=User.bonus_left+bonus,
         bonus_total=User.bonus_total+bonus
     )
-    await session.execute(query)
-    await session.commit()
\ No newline at end of file
+
+
+async def orm_add_bonus(session: AsyncSession, tg_id: int, amount: int):
+    await session.execute(bonus_update(tg_id, amount))
+    await session.commit()
+    invalidate_user(tg_id)
\ No newline at end of file
@@ -0,0 +1,243 @@
+import json
+import re
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from services.report_writer import write_report_xlsx
+
+
+# CPU-bound часть генерации отчёта. Модуль не тянет aiogram/БД, чтобы его быстро
+# импортировали процессы пула (services/cpu_pool.py).
+
+
+# колонки детализации, которые нужны отчёту, и их типы
+SALES_NUMERIC_COLUMNS = {
+    "quantity": "int64", "retail_amount": "float64", "ppvz_for_pay": "float64",
+    "delivery_amount": "int64", "delivery_rub": "float64", "penalty": "float64",
+    "additional_payment": "float64", "deduction": "float64",
+}
+SALES_TEXT_COLUMNS = ["sa_name", "doc_type_name", "bonus_type_name"]
+SALES_SUM_COLUMNS = {
+    "quantity": "SUM из Кол-во", "retail_amount": "SUM из Сумма продаж",
+    "ppvz_for_pay": "SUM из К перечислению продавцу", "delivery_amount": "SUM из Кол-во доставок",
+    "delivery_rub": "SUM из Стоимость доставки", "penalty": "SUM из Штрафы",
+    "additional_payment": "SUM из Дополнительный платеж",
+}
+RETURNS_SUM_COLUMNS = {
+    "quantity": "Возвраты (Кол-во)", "retail_amount": "Возвраты (Сумма продаж)",
+    "ppvz_for_pay": "Возвраты (К перечислению продавцу)",
+}
+OTHER_DEDUCTIONS_EXCLUDE = r"подписке «Джем»|Списание за отзыв|ВБ\.?Продвижение|Акт утилизации товара"
+# "Оказание услуг «ВБ.Продвижение» по документу 232411108 от ..." - номер документа, который вводит пользователь
+PROMOTION_DOC_PATTERN = r"ВБ\.?Продвижение.*?документу?\D*?(\d+)"
+
+
+def project_sales_page(page: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Страница детализации -> компактный типизированный DataFrame только с нужными колонками"""
+    if page and "bonus_type_name" not in page[0] and "bonusTypeName" in page[0]:
+        page = [{**r, "bonus_type_name": r.get("bonusTypeName")} for r in page]
+    df = pd.DataFrame(page, columns=["nm_id", *SALES_TEXT_COLUMNS, *SALES_NUMERIC_COLUMNS])
+    df["nm_id"] = pd.to_numeric(df["nm_id"], errors="coerce").fillna(0).astype("int64")
+    for col in SALES_TEXT_COLUMNS:
+        df[col] = df[col].astype("object")
+    for col, dtype in SALES_NUMERIC_COLUMNS.items():
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0).astype(dtype)
+    return df
+
+
+UNKNOWN_ITEM = "НЕОПОЗНАННЫЙ ТОВАР"
+
+
+def _contains_mask(codes: np.ndarray, uniques: np.ndarray, pattern: str) -> np.ndarray:
+    """str.contains по уникальным значениям (результат pd.factorize), размноженный на строки; -1 (NaN) -> False"""
+    found = pd.Series(uniques, dtype=object).str.contains(pattern, case=False, na=False).to_numpy(dtype=bool)
+    return np.append(found, False)[codes]
+
+
+def _item_names(values: pd.Series) -> pd.Categorical:
+    """Нормализованные названия товаров категориями (по алфавиту): strip/upper только для уникальных значений"""
+    codes, uniques = pd.factorize(values)
+    names = pd.Series(uniques, dtype=object).fillna("").astype(str).str.strip().str.upper()
+    names = names.mask(names.isin(["", "NAN"]), UNKNOWN_ITEM)
+    names = np.append(names.to_numpy(dtype=object), UNKNOWN_ITEM)  # код -1 (NaN) -> UNKNOWN_ITEM
+    categories = pd.Index(sorted(set(names)))
+    return pd.Categorical.from_codes(categories.get_indexer(names)[codes], categories=categories)
+
+
+class SalesAggregator:
+    """
+    Складывает страницы детализации в накопительные суммы по (nm_id, артикул поставщика)
+    отдельно для продаж и возвратов, плюс итоговые удержания.
+    Память зависит от количества SKU, а не от количества строк детализации.
+    """
+
+    def __init__(self):
+        self.items: pd.DataFrame | None = None
+        self.rows = 0
+        self.total_util = 0.0
+        self.total_jam = 0.0
+        self.acceptance_deduction = 0.0
+        self.total_other = 0.0
+        self.reviews = pd.Series(dtype="float64")
+        self.promotion_docs: set = set()
+
+    def add_page(self, page: List[Dict[str, Any]]) -> None:
+        self.add_frame(project_sales_page(page))
+
+    def merge(self, other: "SalesAggregator") -> None:
+        """Добавляет суммы другого агрегатора (например, свёрнутой в отдельном процессе страницы)"""
+        self.rows += other.rows
+        self.total_util += other.total_util
+        self.total_jam += other.total_jam
+        self.acceptance_deduction += other.acceptance_deduction
+        self.total_other += other.total_other
+        self.reviews = self.reviews.add(other.reviews, fill_value=0)
+        self.promotion_docs |= other.promotion_docs
+        if other.items is not None:
+            self.items = other.items if self.items is None else self.items.add(other.items, fill_value=0)
+
+    def add_frame(self, df: pd.DataFrame) -> None:
+        self.rows += len(df)
+
+        # удержания - только строки с ненулевым deduction; str.contains/extract - по уникальным обоснованиям
+        ded = df.loc[df["deduction"] != 0, ["deduction", "bonus_type_name"]]
+        if not ded.empty:
+            deduction = ded["deduction"]
+            codes, uniques = pd.factorize(ded["bonus_type_name"])
+            self.total_util += deduction[_contains_mask(codes, uniques, "утилизации")].sum()
+            self.total_jam += deduction[_contains_mask(codes, uniques, "джем")].sum()
+            self.acceptance_deduction += deduction[_contains_mask(codes, uniques, "при[её]м")].sum()
+            self.total_other += deduction[~_contains_mask(codes, uniques, OTHER_DEDUCTIONS_EXCLUDE)].sum()
+            reviews = _contains_mask(codes, uniques, "списание за отзыв")
+            if reviews.any():
+                articles = pd.Series(uniques, dtype=object).str.extract(r"товар\s+(\d+)")[0].str.upper()
+                article = np.append(articles.to_numpy(dtype=object), None)[codes[reviews]]
+                self.reviews = self.reviews.add(deduction[reviews].groupby(article).sum(), fill_value=0)
+            self.promotion_docs.update(
+                pd.Series(uniques, dtype=object).str.extract(PROMOTION_DOC_PATTERN, flags=re.IGNORECASE)[0].dropna()
+            )
+        self.total_other += df.loc[(df["nm_id"] == 0) & (df["penalty"] != 0), "penalty"].sum()
+
+        # продажи / возвраты по товарам
+        items = df[df["nm_id"] != 0]
+        if items.empty:
+            return
+        # группировка по кодам категорий названий; в накопительных суммах уровень name - обычные строки
+        name = pd.Series(_item_names(items["sa_name"]), index=items.index, name="name")
+        grouped = (
+            items[list(SALES_SUM_COLUMNS)]
+            .assign(rows=1)
+            .groupby([items["nm_id"], name, (items["doc_type_name"] == "Возврат").rename("is_return")], observed=True)
+            .sum()
+            .unstack("is_return", fill_value=0)
+        )
+        grouped.index = grouped.index.set_levels(grouped.index.levels[1].astype(object), level="name")
+        self.items = grouped if self.items is None else self.items.add(grouped, fill_value=0)
+
+    def sales_frame(self) -> pd.DataFrame:
+        """Продажи и возвраты по товарам - колонки листа продаж итогового отчёта"""
+        columns = [
+            "Артикул WB", "Короткое название товара", *SALES_SUM_COLUMNS.values(),
+            "Утилизация", "Подписка «Джем»", *RETURNS_SUM_COLUMNS.values(),
+        ]
+        if self.items is None or ("rows", False) not in self.items.columns:
+            return pd.DataFrame(columns=columns)
+        items = self.items[self.items[("rows", False)] > 0].sort_index()
+        cnt = len(items)
+        res = pd.DataFrame({
+            "Артикул WB": items.index.get_level_values("nm_id"),
+            "Короткое название товара": items.index.get_level_values("name"),
+        })
+        for src, dst in SALES_SUM_COLUMNS.items():
+            res[dst] = items[(src, False)].astype(SALES_NUMERIC_COLUMNS[src]).to_numpy()
+        res["Утилизация"] = round(self.total_util / cnt, 2) if cnt else 0.0
+        res["Подписка «Джем»"] = round(self.total_jam / cnt, 2) if cnt else 0.0
+        for src, dst in RETURNS_SUM_COLUMNS.items():
+            res[dst] = items[(src, True)].astype(SALES_NUMERIC_COLUMNS[src]).to_numpy() if (src, True) in items.columns else 0
+        return res
+
+    def reviews_frame(self) -> pd.DataFrame:
+        return self.reviews.rename("Списание за отзывы").rename_axis("Артикул WB").reset_index()
+
+
+def fold_sales_page(raw: bytes) -> SalesAggregator:
+    """JSON страницы детализации -> свёрнутые суммы. Выполняется в пуле процессов"""
+    agg = SalesAggregator()
+    agg.add_page(json.loads(raw))
+    return agg
+
+
+# ------------------ Итоговый отчёт ------------------
+
+def build_report_file(sales_agg: SalesAggregator, storage_df: pd.DataFrame, adv_df: pd.DataFrame, acceptance_df: pd.DataFrame,
+                      store_name: str, start_date: str, end_date: str, path: str) -> Tuple[str, Dict[str, float]]:
+    """Сборка таблицы и запись xlsx. Возвращает путь и замеры: секунды pandas/excel и число строк отчёта"""
+    started = time.perf_counter()
+    sales_df = sales_agg.sales_frame()
+    reviews_agg = sales_agg.reviews_frame()
+    total_other = sales_agg.total_other
+
+    # объединяем
+    # результаты запросов WB общие для совпавших генераций - не меняем их на месте
+    sales_df, storage_df, adv_df, acceptance_df = (
+        df.assign(**{col: df[col].astype(str).str.upper()})
+        for df, col in [(sales_df,"Артикул WB"),(storage_df,"nmId"),(adv_df,"Артикул WB"),(acceptance_df,"Артикул WB")]
+    )
+
+    merged=pd.merge(sales_df, storage_df.rename(columns={"nmId":"Артикул WB"})[["Артикул WB","vendorCode","totalStorageSum"]],on="Артикул WB",how="outer")
+    merged=pd.merge(merged, adv_df[["Артикул WB","totalAdjustedSum"]],on="Артикул WB",how="outer")
+    merged=pd.merge(merged, acceptance_df[["Артикул WB","Платная приемка"]],on="Артикул WB",how="outer")
+    merged=pd.merge(merged, reviews_agg, on="Артикул WB",how="left").fillna(0)
+    merged.fillna(0,inplace=True)
+    merged.sort_values("Артикул WB",inplace=True)
+
+    # Прочие удержания
+    n=len(merged)
+    per_item=round(total_other/n,2) if n else 0.0
+    merged["Прочие удержания"]=per_item
+
+    # Переименование и порядок
+    merged.rename(columns={
+        "Короткое название товара":"Артикул поставщика",
+        "SUM из Кол-во":"Кол-во продаж",
+        "SUM из Сумма продаж":"Общая выручка",
+        "SUM из К перечислению продавцу":"К Перечислению",
+        "SUM из Кол-во доставок":"Логистика, шт",
+        "SUM из Стоимость доставки":"Логистика, руб",
+        "SUM из Штрафы":"Штрафы",
+        "SUM из Дополнительный платеж":"Доплаты",
+        "Возвраты (К перечислению продавцу)":"Возвраты",
+        "totalStorageSum":"Хранение",
+        "totalAdjustedSum":"ВБ.Продвижение"
+    },inplace=True)
+
+    final_cols=[
+        "Артикул WB","Артикул поставщика","Кол-во продаж","Общая выручка",
+        "К Перечислению","Логистика, шт","Логистика, руб","Штрафы","Доплаты",
+        "Возвраты","Хранение","ВБ.Продвижение","Подписка «Джем»",
+        "Платная приемка","Утилизация","Списание за отзывы","Прочие удержания"
+    ]
+    final_df=merged[final_cols].copy()
+
+    # Добавляем столбец "На расчетный счет"
+    final_df["На расчетный счет"] = (
+        final_df["К Перечислению"]
+        - final_df["Логистика, руб"]
+        - final_df["Штрафы"]
+        + final_df["Доплаты"]
+        - final_df["Возвраты"]
+        - final_df["Хранение"]
+        - final_df["ВБ.Продвижение"]
+        - final_df["Подписка «Джем»"]
+        - final_df["Платная приемка"]
+        - final_df["Утилизация"]
+        - final_df["Списание за отзывы"]
+        - final_df["Прочие удержания"]
+    )
+
+    built = time.perf_counter()
+    write_report_xlsx(final_df, path, store_name, start_date, end_date)
+    return path, {"pandas": built - started, "excel": time.perf_counter() - built, "rows": len(final_df)}
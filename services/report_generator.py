@@ -1,24 +1,29 @@
-import json
+import os
 import re
 import asyncio
+import hashlib
 import pandas as pd
 import httpx
-from openpyxl.styles import Font, PatternFill
-from openpyxl.utils import get_column_letter
-from functools import lru_cache
 from pathlib import Path
 from datetime import date, timedelta, datetime
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List, Optional
 from aiogram.types import Message
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.models import Report
+from database.models import Report, User
+from services.cpu_pool import run_cpu
 from services.logging import logger
-
-
-# ------------------ HTTP‑clients ------------------
-SYNC_CLIENT  = httpx.Client(timeout=30.0)
-ASYNC_CLIENT = httpx.AsyncClient(timeout=30.0)
+from services.metrics import StageTrace, observe_stage, store_tag, traced
+from services.report_builder import SalesAggregator, build_report_file, fold_sales_page
+from services.product_cards import get_card_catalogue
+from services import sales_store
+from services.sales_store import SALES_STORE_PATH
+from services.wb_client import wb_client
+from services.wb_tasks import wb_tasks
+from services.single_flight import reports_flight, wb_legs_flight
+from services.ttl_cache import invalidate_user
+from services.wb_cache import wb_cache, make_key, is_closed_period, hash_token
 
 
 async def run_with_progress(message: Message, title: str, coro, *args):
@@ -82,17 +87,73 @@ def get_weeks_range(count):
     return weeks_range
 
 
-async def orm_add_report(session: AsyncSession, tg_id: int, date_of_week: date, report_path: str, store_id: int):
+async def orm_add_report(session: AsyncSession, tg_id: int, date_of_week: date, report_path: str, store_id: int,
+                         doc_num: Optional[str] = None, token_hash: Optional[str] = None, content_hash: Optional[str] = None):
     obj = Report(
         tg_id=tg_id,
         date_of_week=date_of_week,
         report_path=report_path,
         store_id=store_id,
+        doc_num=doc_num,
+        token_hash=token_hash,
+        content_hash=content_hash,
     )
     session.add(obj)
     await session.commit()
 
 
+def file_hash(path: str) -> Optional[str]:
+    """sha256 файла отчёта, None - если файла нет"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+async def orm_get_ready_report(session: AsyncSession, store_id: int, period: str, doc_num: str, token: str) -> Optional[Report]:
+    """
+    Готовый отчёт за закрытую неделю с теми же номерами документов и токеном магазина.
+    Отдаём только если файл на месте и не изменился (совпадает sha256).
+    """
+    start_date, end_date = get_dates_from_str(period)
+    if not is_closed_period(end_date):
+        return None
+    query = select(Report).where(
+        Report.store_id == store_id,
+        Report.date_of_week == date.fromisoformat(start_date),
+        Report.doc_num == normalize_doc_number(doc_num or ""),
+        Report.token_hash == hash_token(token),
+        Report.content_hash.is_not(None),
+    ).order_by(Report.id.desc()).limit(1)
+    result = await session.execute(query)
+    report = result.scalar()
+    if report is None:
+        return None
+    if await asyncio.to_thread(file_hash, report.report_path) != report.content_hash:
+        logger.info('Готовый отчёт %s изменён или удалён, формируем заново', report.report_path)
+        return None
+    return report
+
+
+async def orm_charge_ready_report(session: AsyncSession, report_id: int, tg_id: int) -> bool:
+    """
+    Первая выдача заранее сформированного отчёта: отметка charged и списание генерации одной транзакцией.
+    False - отчёт уже был списан, повторная выдача бесплатна
+    """
+    query = update(Report).where(Report.id == report_id, Report.charged.is_(False)).values(charged=True)
+    if (await session.execute(query)).rowcount != 1:
+        await session.rollback()
+        return False
+    await session.execute(update(User).where(User.tg_id == tg_id).values(generations_left=User.generations_left - 1))
+    await session.commit()
+    invalidate_user(tg_id)
+    return True
+
+
 def get_dates_from_str(dates):
     """transform dates DD.MM.YYYY-DD.MM.YYYY to YYYY-MM-DD, YYYY-MM-DD"""
     dates = dates.split('-')
@@ -116,168 +177,170 @@ def create_empty_adv_report() -> pd.DataFrame:
     return pd.DataFrame(columns=["Артикул WB", "totalAdjustedSum", "Period"])
 
 
-@lru_cache(maxsize=1)
-def fetch_product_cards_mapping(token: str) -> Dict[str, Dict[str, str]]:
-    logger.info("Загрузка маппинга карточек товара...")
-    url = "https://content-api.wildberries.ru/content/v2/get/cards/list"
-    headers = {"Authorization": token, "Content-Type": "application/json"}
-    payload = {"settings": {"cursor": {"limit": 100}, "filter": {"withPhoto": -1}}}
-    mapping: Dict[str, Dict[str, str]] = {}
-    while True:
-        resp = SYNC_CLIENT.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        cards = data.get("cards", [])
-        for c in cards:
-            key = str(c.get("nmID") or c.get("nmId", "")).strip().upper()
-            mapping[key] = {
-                "vendorCode": c.get("vendorCode", "").strip(),
-                "nmName":     (c.get("name") or c.get("nmName") or "").strip()
-            }
-        cursor = data.get("cursor") or {}
-        if not cursor or len(cards) < 100:
-            break
-        payload["settings"]["cursor"].update({
-            "updatedAt": cursor.get("updatedAt"),
-            "nmID":      cursor.get("nmID")
-        })
-    logger.info("Маппинг карточек загружен: %d записей", len(mapping))
-    return mapping
-
-
 # ------------------ Sales Report ------------------
 
-async def fetch_sales_records_async(date_from: str, date_to: str, token: str) -> List[Dict[str, Any]]:
+async def iter_sales_pages(date_from: str, date_to: str, token: str, cache: bool = True) -> AsyncIterator[bytes]:
+    """
+    Постранично отдаёт детализацию продаж (reportDetailByPeriod) по мере загрузки - сырым JSON,
+    разбор и свёртка страниц делаются в пуле процессов.
+    Закрытые периоды читаются из кэша / пишутся в кэш постранично; cache=False - когда период
+    сохраняет services/sales_store.py, чтобы одни и те же страницы не лежали в двух местах.
+    """
     logger.info("Начинаем загрузку отчёта по продажам с %s по %s", date_from, date_to)
     url = "https://statistics-api.wildberries.ru/api/v5/supplier/reportDetailByPeriod"
     headers = {"Authorization": token, "Content-Type": "application/json"}
-    records, rrdid = [], 0
-    while True:
-        resp = await ASYNC_CLIENT.get(
-            url, headers=headers,
-            params={"dateFrom": date_from, "dateTo": date_to, "rrdid": rrdid, "limit": 100000}
-        )
-        resp.raise_for_status()
-        chunk = resp.json()
-        if not chunk:
-            break
-        records.extend(chunk)
-        last = chunk[-1]
-        new_rrdid = last.get("rrd_id") or last.get("rrdid")
-        if not new_rrdid or new_rrdid == rrdid:
-            break
-        rrdid = new_rrdid
-        await asyncio.sleep(0.1)
-    logger.info("Загрузка отчёта по продажам завершена: %d записей", len(records))
-    return records
-
-def transform_sales_records(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame(columns=[
-            "Артикул WB", "Короткое название товара",
-            "SUM из Кол-во", "SUM из Сумма продаж", "SUM из К перечислению продавцу",
-            "SUM из Кол-во доставок", "SUM из Стоимость доставки",
-            "SUM из Штрафы", "SUM из Дополнительный платеж",
-            "Утилизация", "Подписка «Джем»"
-        ])
-    df = df.copy()
-    if "deduction" in df.columns:
-        df["deduction"] = pd.to_numeric(df["deduction"], errors="coerce").fillna(0)
-    if "bonusTypeName" in df.columns:
-        df.rename(columns={"bonusTypeName": "bonus_type_name"}, inplace=True)
-    total_util = df.loc[
-        df["bonus_type_name"].str.contains("утилизации", case=False, na=False) & (df["deduction"] != 0),
-        "deduction"
-    ].sum()
-    total_jam = df.loc[
-        df["bonus_type_name"].str.contains("джем", case=False, na=False) & (df["deduction"] != 0),
-        "deduction"
-    ].sum()
-    if "vendorCode" not in df.columns:
-        df["vendorCode"] = df.get("sa_name", "")
-    df["Короткое название товара"] = (
-        df["vendorCode"].fillna("").astype(str).str.strip().str.upper()
-    )
-    df.loc[df["Короткое название товара"].isin(["", "NAN"]), "Короткое название товара"] = "НЕОПОЗНАННЫЙ ТОВАР"
-    df = df[df["nm_id"] != 0]
-    sales_df = df[df["doc_type_name"] != "Возврат"].copy()
-    returns_df = df[df["doc_type_name"] == "Возврат"].copy()
-    cols = ["nm_id", "Короткое название товара"]
-    sales_agg = sales_df.groupby(cols, as_index=False).agg({
-        "quantity":"sum","retail_amount":"sum","ppvz_for_pay":"sum",
-        "delivery_amount":"sum","delivery_rub":"sum","penalty":"sum","additional_payment":"sum"
-    })
-    sales_agg.rename(columns={
-        "quantity":"SUM из Кол-во","retail_amount":"SUM из Сумма продаж",
-        "ppvz_for_pay":"SUM из К перечислению продавцу","delivery_amount":"SUM из Кол-во доставок",
-        "delivery_rub":"SUM из Стоимость доставки","penalty":"SUM из Штрафы",
-        "additional_payment":"SUM из Дополнительный платеж"
-    }, inplace=True)
-    cnt = len(sales_agg)
-    sales_agg["Утилизация"] = round(total_util/cnt,2) if cnt else 0.0
-    sales_agg["Подписка «Джем»"] = round(total_jam/cnt,2) if cnt else 0.0
-    returns_agg = returns_df.groupby(cols, as_index=False).agg({
-        "quantity":"sum","retail_amount":"sum","ppvz_for_pay":"sum"
-    })
-    returns_agg.rename(columns={
-        "quantity":"Возвраты (Кол-во)","retail_amount":"Возвраты (Сумма продаж)",
-        "ppvz_for_pay":"Возвраты (К перечислению продавцу)"
-    }, inplace=True)
-    merged = pd.merge(sales_agg, returns_agg, on=cols, how="left")
-    for c in ["Возвраты (Кол-во)","Возвраты (Сумма продаж)","Возвраты (К перечислению продавцу)"]:
-        merged[c] = merged[c].fillna(0)
-    merged.rename(columns={"nm_id":"Артикул WB"}, inplace=True)
-    return merged
+    cache_key = make_key("sales", token, date_from, date_to)
+    cacheable = cache and is_closed_period(date_to)
+    if cacheable:
+        if await wb_cache.lookup(cache_key):
+            async for raw in wb_cache.iter_pages(cache_key):
+                yield raw
+            return
+        await wb_cache.begin(cache_key)
+    rrdid, seq, total = 0, 0, 0
+    try:
+        while True:
+            resp = await wb_client.get(
+                url, token, headers=headers,
+                params={"dateFrom": date_from, "dateTo": date_to, "rrdid": rrdid, "limit": 100000}
+            )
+            resp.raise_for_status()
+            raw = resp.content
+            if raw.strip() in (b"", b"[]", b"null"):
+                break
+            new_rrdid = last_rrd_id(raw)
+            total += len(raw)
+            if cacheable:
+                await wb_cache.write_page(cache_key, seq, raw)
+            seq += 1
+            yield raw
+            del raw
+            if not new_rrdid or new_rrdid == rrdid:
+                break
+            rrdid = new_rrdid
+    except BaseException:
+        if cacheable:
+            await wb_cache.discard(cache_key)
+        raise
+    if cacheable:
+        # пустой ответ - WB ещё не опубликовал детализацию за неделю: не кэшируем, иначе неделя останется пустой на весь TTL
+        if seq:
+            await wb_cache.finish(cache_key)
+        else:
+            await wb_cache.discard(cache_key)
+    logger.info("Загрузка отчёта по продажам завершена: %d страниц, %d байт", seq, total)
+
+
+def last_rrd_id(raw: bytes) -> Optional[int]:
+    """rrd_id последней строки страницы - без полного разбора JSON на event loop"""
+    pos = max(raw.rfind(b'"rrd_id"'), raw.rfind(b'"rrdid"'))
+    match = re.match(rb'"rrd_?id"\s*:\s*(\d+)', raw[pos:pos + 40]) if pos >= 0 else None
+    return int(match.group(1)) if match else None
+
+
+@wb_legs_flight.wrap
+async def aggregate_sales_async(date_from: str, date_to: str, token: str) -> SalesAggregator:
+    """
+    Свёрнутая детализация. Закрытые периоды сохраняются в локальное хранилище (services/sales_store.py)
+    и при следующих генерациях читаются оттуда, без API статистики. Периоды старше SALES_STORE_DAYS
+    хранилище не держит - для них остаётся постраничный кэш WB (wb_cache).
+    """
+    stored = is_closed_period(date_to) and sales_store.in_retention(date_to)
+    period = (hash_token(token), date_from[:10], date_to[:10])
+    if stored:
+        period_id = await asyncio.to_thread(sales_store.find_period, SALES_STORE_PATH, *period)
+        if period_id is not None:
+            agg = await run_cpu(sales_store.fold_stored_sales, SALES_STORE_PATH, period_id)
+            logger.info("Детализация из локального хранилища: %d строк -> %d позиций",
+                        agg.rows, 0 if agg.items is None else len(agg.items))
+            return agg
+        period_id = await asyncio.to_thread(sales_store.begin_period, SALES_STORE_PATH, *period)
+    agg = SalesAggregator()
+    try:
+        async for raw in iter_sales_pages(date_from, date_to, token, cache=not stored):
+            if stored:
+                agg.merge(await run_cpu(sales_store.fold_and_store_sales_page, raw, SALES_STORE_PATH, period_id))
+            else:
+                agg.merge(await run_cpu(fold_sales_page, raw))
+    except BaseException:
+        if stored:
+            await asyncio.to_thread(sales_store.discard_period, SALES_STORE_PATH, period_id)
+        raise
+    if stored:
+        # пустая детализация - WB ещё не опубликовал неделю: не сохраняем, иначе неделя останется пустой
+        if agg.rows:
+            await asyncio.to_thread(sales_store.finish_period, SALES_STORE_PATH, period_id)
+        else:
+            await asyncio.to_thread(sales_store.discard_period, SALES_STORE_PATH, period_id)
+    logger.info("Детализация свёрнута: %d строк -> %d позиций",
+                agg.rows, 0 if agg.items is None else len(agg.items))
+    return agg
+
+
+async def is_sales_stored(start_date: str, end_date: str, token: str) -> bool:
+    """Детализация закрытого периода (YYYY-MM-DD) сохранена - WB её опубликовал, строк больше нуля"""
+    period_id = await asyncio.to_thread(sales_store.find_period, SALES_STORE_PATH, hash_token(token), start_date, end_date)
+    return period_id is not None
+
+
+# ------------------ WB report tasks ------------------
+
+async def fetch_task_report(namespace: str, title: str, base: str, headers: dict,
+                            date_from: str, date_to: str, token: str) -> Optional[Any]:
+    """
+    Отчёт-задача WB (хранение, приёмка): create -> ожидание статуса -> download.
+    None - WB не отдал отчёт (429 после всех повторов, не готов в срок).
+    Отчёт за закрытый период кэшируется целиком - повторные генерации (и ночная) его не запрашивают.
+    """
+    key = make_key(namespace, token, date_from, date_to)
+    closed = is_closed_period(date_to)
+    if closed:
+        cached = await wb_cache.get(key)
+        if cached is not None:
+            return cached[0]
+    # create
+    resp = await wb_client.get(base, token, headers=headers, params={"dateFrom": date_from, "dateTo": date_to})
+    if resp.status_code == 429:
+        logger.warning("429 при создании отчёта по %s, лимит повторов исчерпан", title)
+        return None
+    resp.raise_for_status()
+    task = resp.json()["data"]["taskId"]
+    # poll
+    if not await wb_tasks.wait(f"{base}/tasks/{task}/status", token, headers):
+        logger.warning("Отчёт по %s не готов в срок", title)
+        return None
+    # download
+    dl = await wb_client.get(f"{base}/tasks/{task}/download", token, headers=headers)
+    if dl.status_code == 429:
+        logger.warning("429 при скачивании отчёта по %s, лимит повторов исчерпан", title)
+        return None
+    dl.raise_for_status()
+    data = dl.json()
+    if closed and data:  # пустой отчёт не кэшируем - WB мог ещё не посчитать неделю
+        await wb_cache.put(key, [data])
+    return data
 
 
 # ------------------ Storage Report ------------------
 
+@wb_legs_flight.wrap
 async def get_storage_report(date_from: str, date_to: str, token: str) -> pd.DataFrame:
     logger.info("Запрос отчёта по платному хранению... %s – %s", date_from, date_to)
     base, headers = "https://seller-analytics-api.wildberries.ru/api/v1/paid_storage", {"Authorization":f"Bearer {token}"}
-    # create
-    for backoff in [5,10,20,40,80]:
-        resp = await ASYNC_CLIENT.get(base, headers=headers, params={"dateFrom": date_from, "dateTo": date_to})
-        if resp.status_code != 429:
-            resp.raise_for_status()
-            break
-        logger.warning("429 при создании хранения, жду %s", backoff); await asyncio.sleep(backoff)
-    else:
-        return pd.DataFrame(columns=["nmId","nmName","vendorCode","totalStorageSum","Period"])
-    task = resp.json()["data"]["taskId"]
-    status_url = f"{base}/tasks/{task}/status"
-    # poll
-    for _ in range(12):
-        st = await ASYNC_CLIENT.get(status_url, headers=headers)
-        if st.status_code == 429:
-            await asyncio.sleep(5)
-            continue
-        st.raise_for_status()
-        if st.json()["data"]["status"].lower()=="done":
-            break
-        await asyncio.sleep(5)
-    else:
-        return pd.DataFrame(columns=["nmId","nmName","vendorCode","totalStorageSum","Period"])
-    # download
-    dl_url = f"{base}/tasks/{task}/download"
-    for backoff in [5,10,20,40,80]:
-        dl = await ASYNC_CLIENT.get(dl_url, headers=headers)
-        if dl.status_code != 429:
-            dl.raise_for_status()
-            data = dl.json()
-            break
-        logger.warning("429 при скачивании хранения, жду %s", backoff); await asyncio.sleep(backoff)
-    else:
-        return pd.DataFrame(columns=["nmId","nmName","vendorCode","totalStorageSum","Period"])
+    empty = pd.DataFrame(columns=["nmId","nmName","vendorCode","totalStorageSum","Period"])
+    data = await fetch_task_report("storage", "хранению", base, headers, date_from, date_to, token)
+    if data is None:
+        return empty
     df = pd.DataFrame(data)
     df["Цена склада"] = pd.to_numeric(df.get("warehousePrice",0),errors="coerce").fillna(0)
     grp = df.groupby("nmId",as_index=False)["Цена склада"].sum().rename(columns={"Цена склада":"totalStorageSum"})
     grp["nmId"] = grp["nmId"].astype(str).str.upper()
     grp["totalStorageSum"] = grp["totalStorageSum"].round(2)
-    cards = fetch_product_cards_mapping(token)
+    cards = await get_card_catalogue(token)
+    vendor_codes, names = cards.lookup(grp["nmId"])
     grp = grp.assign(
-        vendorCode=grp["nmId"].map(lambda x: cards.get(x,{}).get("vendorCode",x)),
-        nmName    =grp["nmId"].map(lambda x: cards.get(x,{}).get("nmName",x).upper()),
+        vendorCode=vendor_codes.fillna(grp["nmId"]),
+        nmName    =names.fillna(grp["nmId"]).str.upper(),
         Period    =f"{date_from} - {date_to}"
     )
     logger.info("Отчёт по хранению готов: %d позиций", len(grp))
@@ -286,63 +349,85 @@ async def get_storage_report(date_from: str, date_to: str, token: str) -> pd.Dat
 
 # ------------------ Acceptance report ------------------
 
-async def get_acceptance_report(date_from: str, date_to: str, token: str) -> pd.DataFrame:
+ACCEPTANCE_LOOKBACK_DAYS = 2  # WB списывает приёмку с задержкой - сверяем с окном, начатым на 2 дня раньше
+ACCEPTANCE_DATE_COLUMNS = ["shkCreateDate", "giCreateDate"]
+
+
+@wb_legs_flight.wrap
+async def get_acceptance_rows(date_from: str, date_to: str, token: str) -> pd.DataFrame:
+    """Строки отчёта по платной приёмке: Артикул WB, total и "Дата" (если WB её отдаёт)"""
     logger.info("Запрос отчёта по платной приёмке... %s – %s", date_from, date_to)
     base, headers = "https://seller-analytics-api.wildberries.ru/api/v1/acceptance_report", {"Authorization":token}
-    # create
-    for backoff in [5,10,20,40,80]:
-        resp = await ASYNC_CLIENT.get(base, headers=headers, params={"dateFrom": date_from, "dateTo": date_to})
-        if resp.status_code != 429:
-            resp.raise_for_status()
-            break
-        logger.warning("429 при создании приёмки, жду %s", backoff); await asyncio.sleep(backoff)
-    else:
-        return pd.DataFrame(columns=["Артикул WB","Платная приемка"])
-    task = resp.json()["data"]["taskId"]
-    status_url = f"{base}/tasks/{task}/status"
-    while True:
-        await asyncio.sleep(5)
-        st = await ASYNC_CLIENT.get(status_url, headers=headers)
-        st.raise_for_status()
-        if st.json()["data"]["status"].lower()=="done":
-            break
-    dl = await ASYNC_CLIENT.get(f"{base}/tasks/{task}/download", headers=headers)
-    dl.raise_for_status()
-    data = dl.json()
+    empty = pd.DataFrame(columns=["Артикул WB","total"])
+    data = await fetch_task_report("acceptance", "приёмке", base, headers, date_from, date_to, token)
     if not isinstance(data,list) or not data:
-        return pd.DataFrame(columns=["Артикул WB","Платная приемка"])
+        return empty
     df_ac = pd.DataFrame(data)
     nm_col = next((c for c in df_ac.columns if re.search(r"(?i)nm[_]?id$",c)),None)
     if nm_col is None:
         nm_col = next((c for c in df_ac.columns if re.search(r"(?i)nm.*id",c)),None)
     if nm_col is None:
-        return pd.DataFrame(columns=["Артикул WB","Платная приемка"])
-    df_ac["Артикул WB"] = df_ac[nm_col].astype(str).str.upper()
-    ac = df_ac.groupby("Артикул WB",as_index=False)["total"].sum().rename(columns={"total":"Платная приемка"})
+        return empty
+    rows = pd.DataFrame({"Артикул WB": df_ac[nm_col].astype(str).str.upper(), "total": df_ac["total"]})
+    date_col = next((c for c in ACCEPTANCE_DATE_COLUMNS if c in df_ac.columns), None)
+    if date_col is not None:
+        rows["Дата"] = pd.to_datetime(df_ac[date_col].astype(str).str[:10], errors="coerce")
+    return rows
+
+
+def acceptance_totals(rows: pd.DataFrame, since: Optional[str] = None) -> Optional[pd.DataFrame]:
+    """
+    Платная приёмка по артикулам. since - отфильтровать строки локально начиная с даты;
+    None, если строки без даты и отфильтровать нельзя.
+    """
+    if since is not None and not rows.empty:
+        if "Дата" not in rows.columns:
+            return None
+        rows = rows[rows["Дата"] >= pd.Timestamp(since)]
+    ac = rows.groupby("Артикул WB",as_index=False)["total"].sum().rename(columns={"total":"Платная приемка"})
     logger.info("Отчёт по приёмке готов: %d позиций",len(ac))
     return ac
 
 
+async def get_acceptance_report(date_from: str, date_to: str, token: str) -> pd.DataFrame:
+    return acceptance_totals(await get_acceptance_rows(date_from, date_to, token))
+
+
 # ------------------ Adds report ------------------
 
-def get_ad_expenses_report(token: str, doc_number: str, period_end: str) -> pd.DataFrame:
+ADV_CHUNK_SIZE = 100  # WB принимает до 100 кампаний в одном запросе fullstats
+ADV_CONCURRENCY = int(os.getenv('ADV_CONCURRENCY', 2))
+
+
+async def fetch_fullstats_chunk(campaign_ids: List[int], fr: str, to: str, token: str, semaphore: asyncio.Semaphore) -> List[dict]:
+    """Статистика по одной пачке кампаний. Повторы (429/5xx) - только для этой пачки, внутри wb_client"""
+    payload = [{"id": cid, "interval": {"begin": fr, "end": to}} for cid in campaign_ids]
+    async with semaphore:
+        resp = await wb_client.post(
+            "https://advert-api.wildberries.ru/adv/v2/fullstats", token,
+            headers={"Content-Type": "application/json"},
+            json=payload
+        )
+    resp.raise_for_status()
+    data = resp.json()
+    return data if isinstance(data, list) else []
+
+
+@wb_legs_flight.wrap
+async def get_ad_expenses_report(token: str, doc_number: str, period_end: str) -> pd.DataFrame:
     logger.info("Формирование отчёта по рекламе, updNum=%s", doc_number)
     if not doc_number:
         return create_empty_adv_report()
-    elif ' ' in doc_number:
-        upd = set([int(num) for num in doc_number.split()])
-    else:
-        upd = {int(doc_number)}
+    upd = {int(num) for num in doc_number.split()}
 
     end_date = datetime.strptime(period_end, "%Y-%m-%d").date()
     fr, to = (end_date - timedelta(days=30)).isoformat(), period_end
     period = f"{fr} - {to}"
-    headers = {"Authorization": token}
 
     # Запрос списка рекламных документов
-    upd_list = SYNC_CLIENT.get(
-        f"https://advert-api.wildberries.ru/adv/v1/upd?from={fr}&to={to}",
-        headers=headers
+    upd_list = await wb_client.get(
+        "https://advert-api.wildberries.ru/adv/v1/upd", token,
+        params={"from": fr, "to": to}
     )
     upd_list.raise_for_status()
 
@@ -357,42 +442,32 @@ def get_ad_expenses_report(token: str, doc_number: str, period_end: str) -> pd.D
         cid = it.get("advertId") or it.get("id")
         summary[cid] = summary.get(cid, 0.0) + float(it.get("updSum") or 0)
 
-    # Формируем payload для каждого номера документа
-    payload = []
-    for doc_num in upd:
-        payload.extend([
-            {"id": cid, "updNum": doc_num, "dates": get_dates_in_range(fr, to)}
-            for cid in summary
-        ])
-
-    # Запрос детальной статистики
-    full = SYNC_CLIENT.post(
-        "https://advert-api.wildberries.ru/adv/v2/fullstats",
-        headers={**headers, "Content-Type": "application/json"},
-        content=json.dumps(payload)
-    )
-    full.raise_for_status()
+    # Запрос детальной статистики: каждая кампания один раз, пачками, параллельно
+    campaign_ids = sorted(cid for cid in summary if cid is not None)
+    chunks = [campaign_ids[i:i + ADV_CHUNK_SIZE] for i in range(0, len(campaign_ids), ADV_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(ADV_CONCURRENCY)
+    results = await asyncio.gather(*(fetch_fullstats_chunk(chunk, fr, to, token, semaphore) for chunk in chunks))
 
-    data2 = full.json()
-    if not isinstance(data2, list):
-        return create_empty_adv_report()
+    days_by_campaign: Dict[Any, list] = {}
+    for camp in (camp for data in results for camp in data):
+        cid = camp.get("advertId") or camp.get("id")
+        days_by_campaign.setdefault(cid, []).extend(camp.get("days") or [])
 
     # Агрегация данных по товарам
     agg = {}
-    for camp in data2:
-        cid = camp.get("advertId") or camp.get("id")
+    for cid, days in days_by_campaign.items():
         fact = summary.get(cid, 0.0)
         raw_total = sum(
             float(nm.get("sum") or 0)
-            for day in camp.get("days", [])
-            for app in day.get("apps", [])
-            for nm in app.get("nm", [])
+            for day in days
+            for app in day.get("apps") or []
+            for nm in app.get("nm") or []
         ) or 0.0
         coef = fact / raw_total if raw_total > 0 else 1.0
 
-        for day in camp.get("days", []):
-            for app in day.get("apps", []):
-                for nm in app.get("nm", []):
+        for day in days:
+            for app in day.get("apps") or []:
+                for nm in app.get("nm") or []:
                     nid = nm.get("nmId")
                     name = nm.get("name") or ""
                     val = float(nm.get("sum") or 0) * coef
@@ -410,145 +485,97 @@ def get_ad_expenses_report(token: str, doc_number: str, period_end: str) -> pd.D
         rows,
         columns=["Артикул WB", "totalAdjustedSum", "Period", "Название товара"]
     )
-    logger.info("Отчёт по рекламе готов: %d позиций", len(df_adv))
+    logger.info("Отчёт по рекламе готов: %d позиций (%d кампаний, %d запросов)", len(df_adv), len(campaign_ids), len(chunks))
     return df_adv
 
 
 # ------------------ Генерация отчёта ------------------
 
+def report_file_name(start_date: str, doc_number: str, token: str) -> str:
+    """
+    Файл отчёта на вариант: неделя + короткий хэш токена магазина и номеров документов.
+    Отчёты с другими номерами документов не перезаписывают друг друга (и готовые отчёты в таблице report)
+    """
+    variant = hashlib.sha256(f'{hash_token(token)}|{normalize_doc_number(doc_number or "")}'.encode()).hexdigest()[:12]
+    return f'report{start_date}_{variant}.xlsx'
+
+
+def normalize_doc_number(doc_number: str) -> str:
+    """Номера документов в каноническом виде: без повторов, по возрастанию"""
+    return " ".join(sorted(set(doc_number.split()), key=lambda x: (len(x), x)))
+
+
 async def generate_report_with_params(dates: str, doc_number: str, store_token: str, store_name: str, tg_id: int, store_id: int) -> str:
+    """
+    Одинаковые одновременные запросы (магазин/токен, период, номера документов) не дублируются:
+    все они получают файл из одной генерации.
+    """
+    doc_number = normalize_doc_number(doc_number or "")
+    key = (hash_token(store_token), dates, doc_number)
+    return await reports_flight.do(
+        key, build_report, dates, doc_number, store_token, store_name, tg_id, store_id
+    )
+
+
+async def build_report(dates: str, doc_number: str, store_token: str, store_name: str, tg_id: int, store_id: int) -> str:
+    """Каждый этап замеряется (services/metrics.py): время, строки, запросы/байты/повторы/429 WB"""
     logger.info("Старт отчёта для %s: %s",store_name,dates)
+    with StageTrace("total", store_tag(store_token)):
+        return await build_report_stages(dates, doc_number, store_token, store_name, tg_id, store_id)
+
+
+async def build_report_stages(dates: str, doc_number: str, store_token: str, store_name: str, tg_id: int, store_id: int) -> str:
+    store = store_tag(store_token)
     start_date, end_date = get_dates_from_str(dates)
 
-    sales_task      = fetch_sales_records_async(f"{start_date}T00:00:00",f"{end_date}T23:59:59",store_token)
-    acceptance_task = get_acceptance_report(start_date,end_date,store_token)
-    storage_task    = get_storage_report(start_date,end_date,store_token)
-    advert_task     = asyncio.to_thread(get_ad_expenses_report,store_token,doc_number,end_date)
+    # приёмку сразу берём за расширенное окно одним заданием WB (лимит 1 запрос в минуту),
+    # основное окно отфильтровываем из него локально - сверка не добавляет второго цикла create/poll/download
+    wide_from=(datetime.strptime(start_date,"%Y-%m-%d").date()-timedelta(days=ACCEPTANCE_LOOKBACK_DAYS)).isoformat()
+
+    sales_task      = traced("sales", store, aggregate_sales_async(f"{start_date}T00:00:00",f"{end_date}T23:59:59",store_token),
+                             rows=lambda agg: agg.rows)
+    acceptance_task = traced("acceptance", store, get_acceptance_rows(wide_from,end_date,store_token))
+    storage_task    = traced("storage", store, get_storage_report(start_date,end_date,store_token))
+    advert_task     = traced("advert", store, get_ad_expenses_report(store_token,doc_number,end_date))
 
-    raw_records, acceptance_df, storage_df, adv_df = await asyncio.gather(
+    sales_agg, acceptance_rows, storage_df, adv_df = await asyncio.gather(
         sales_task, acceptance_task, storage_task, advert_task
     )
 
-    df_raw   = pd.DataFrame(raw_records)
-    sales_df = transform_sales_records(df_raw)
+    acceptance_df=acceptance_totals(acceptance_rows, since=start_date)
+    if acceptance_df is None:
+        # WB не отдал дату строки - основное окно запрашиваем отдельно
+        logger.warning("В приёмке нет даты, запрашиваем окно %s – %s отдельно", start_date, end_date)
+        acceptance_df=await traced("acceptance_narrow", store, get_acceptance_report(start_date,end_date,store_token))
 
     # расширяем приёмку
-    sa_sum=0.0
-    if "deduction" in df_raw.columns and "bonusTypeName" in df_raw.columns:
-        df_raw["deduction"]=pd.to_numeric(df_raw["deduction"],errors="coerce").fillna(0)
-        df_raw["bonus_type_name"]=df_raw["bonusTypeName"].astype(str)
-        sa_sum = df_raw.loc[
-            df_raw["bonus_type_name"].str.contains("при[её]м",case=False,na=False)&(df_raw["deduction"]!=0),
-            "deduction"
-        ].sum()
+    sa_sum=sales_agg.acceptance_deduction
     api_sum=acceptance_df["Платная приемка"].sum() if not acceptance_df.empty else 0.0
     if abs(api_sum-sa_sum)>1e-6:
-        prev=(datetime.strptime(start_date,"%Y-%m-%d").date()-timedelta(days=2)).isoformat()
-        try:
-            acceptance_df=await get_acceptance_report(prev,end_date,store_token)
-        except Exception as e:
-            logger.warning("Не удалось расширить приёмку: %s",e)
-
-    # отзывы и прочее
-    reviews_agg=pd.DataFrame(columns=["Артикул WB","Списание за отзывы"])
-    total_other=0.0
-    if "deduction" in df_raw.columns and "bonus_type_name" in df_raw.columns:
-        mask_rev=df_raw["bonus_type_name"].str.contains("списание за отзыв",case=False,na=False)
-        revs=df_raw[mask_rev&(df_raw["deduction"]!=0)].assign(**{
-            "Артикул WB": lambda d: d["bonus_type_name"].str.extract(r"товар\s+(\d+)")[0].str.upper()
-        })
-        if not revs.empty:
-            reviews_agg=revs.groupby("Артикул WB",as_index=False)["deduction"].sum().rename(columns={"deduction":"Списание за отзывы"})
-        mask_other=(df_raw["deduction"]!=0)&~df_raw["bonus_type_name"].str.contains(
-            "подписке «Джем»|Списание за отзыв|ВБ\.?Продвижение|Акт утилизации товара",
-            case=False,na=False
-        )
-        total_other += df_raw.loc[mask_other,"deduction"].sum()
-    if "penalty" in df_raw.columns:
-        total_penalty = df_raw.loc[
-            (df_raw["nm_id"] == 0) & (df_raw["penalty"] != 0),
-            "penalty"
-        ].sum()
-        print(total_penalty)
-        total_other += total_penalty
-
-    # объединяем
-    for df,col in [(sales_df,"Артикул WB"),(storage_df,"nmId"),(adv_df,"Артикул WB"),(acceptance_df,"Артикул WB")]:
-        df[col]=df[col].astype(str).str.upper()
-
-    merged=pd.merge(sales_df, storage_df.rename(columns={"nmId":"Артикул WB"})[["Артикул WB","vendorCode","totalStorageSum"]],on="Артикул WB",how="outer")
-    merged=pd.merge(merged, adv_df[["Артикул WB","totalAdjustedSum"]],on="Артикул WB",how="outer")
-    merged=pd.merge(merged, acceptance_df[["Артикул WB","Платная приемка"]],on="Артикул WB",how="outer")
-    merged=pd.merge(merged, reviews_agg, on="Артикул WB",how="left").fillna(0)
-    merged.fillna(0,inplace=True)
-    merged.sort_values("Артикул WB",inplace=True)
-
-    # Прочие удержания
-    n=len(merged)
-    per_item=round(total_other/n,2) if n else 0.0
-    merged["Прочие удержания"]=per_item
-
-    # Переименование и порядок
-    merged.rename(columns={
-        "Короткое название товара":"Артикул поставщика",
-        "SUM из Кол-во":"Кол-во продаж",
-        "SUM из Сумма продаж":"Общая выручка",
-        "SUM из К перечислению продавцу":"К Перечислению",
-        "SUM из Кол-во доставок":"Логистика, шт",
-        "SUM из Стоимость доставки":"Логистика, руб",
-        "SUM из Штрафы":"Штрафы",
-        "SUM из Дополнительный платеж":"Доплаты",
-        "Возвраты (К перечислению продавцу)":"Возвраты",
-        "totalStorageSum":"Хранение",
-        "totalAdjustedSum":"ВБ.Продвижение"
-    },inplace=True)
-
-    final_cols=[
-        "Артикул WB","Артикул поставщика","Кол-во продаж","Общая выручка",
-        "К Перечислению","Логистика, шт","Логистика, руб","Штрафы","Доплаты",
-        "Возвраты","Хранение","ВБ.Продвижение","Подписка «Джем»",
-        "Платная приемка","Утилизация","Списание за отзывы","Прочие удержания"
-    ]
-    final_df=merged[final_cols]
-
-    # Добавляем столбец "На расчетный счет"
-    final_df["На расчетный счет"] = (
-        final_df["К Перечислению"]
-        - final_df["Логистика, руб"]
-        - final_df["Штрафы"]
-        + final_df["Доплаты"]
-        - final_df["Возвраты"]
-        - final_df["Хранение"]
-        - final_df["ВБ.Продвижение"]
-        - final_df["Подписка «Джем»"]
-        - final_df["Платная приемка"]
-        - final_df["Утилизация"]
-        - final_df["Списание за отзывы"]
-        - final_df["Прочие удержания"]
-    )
-
-    yellow=PatternFill(fill_type="solid",start_color="FFFF00",end_color="FFFF00")
+        logger.info("Приёмка не сходится с удержаниями (%.2f != %.2f), берём окно с %s", api_sum, sa_sum, wide_from)
+        acceptance_df=acceptance_totals(acceptance_rows)
 
     output_folder = Path('data') / 'reports' / str(tg_id) / str(store_id)  # /data on server
     output_folder.mkdir(parents=True, exist_ok=True)
-    path = output_folder / f'report{start_date}.xlsx'
-
-    with pd.ExcelWriter(path,engine="openpyxl") as writer:
-        final_df.to_excel(writer,index=False,startrow=2)
-        ws=writer.sheets["Sheet1"]
-        ws.cell(row=1,column=1,value=f"Магазин: {store_name}")
-        ws.cell(row=2,column=1,value=f"Период: {start_date} – {end_date}")
-        for cell in ws[3]:
-            cell.font=Font(bold=True)
-        for col in ws.columns:
-            length=max(len(str(c.value)) for c in col)
-            ws.column_dimensions[col[0].column_letter].width=length+2
-        summary=ws.max_row+1
-        ws.cell(row=summary,column=1,value="Итого").font=Font(bold=True)
-        for idx in range(3,len(final_cols)+2):
-            letter=get_column_letter(idx)
-            c=ws.cell(row=summary,column=idx,value=f"=SUM({letter}4:{letter}{summary-1})")
-            c.font=Font(color="FF0000"); c.fill=yellow
+    path = output_folder / report_file_name(start_date, doc_number, store_token)
+    # файл пишется во временный и подменяется целиком: отправка или хэш (orm_get_ready_report) не увидят недописанный
+    tmp_path = path.with_name(f'{path.stem}.{os.getpid()}.{id(sales_agg):x}.tmp.xlsx')
+
+    # сборка таблицы и Excel - CPU-bound, уходят в пул процессов; передаём уже свёрнутые данные
+    try:
+        _, stats = await run_cpu(
+            build_report_file,
+            sales_agg,
+            storage_df[["nmId","vendorCode","totalStorageSum"]],
+            adv_df[["Артикул WB","totalAdjustedSum"]],
+            acceptance_df[["Артикул WB","Платная приемка"]],
+            store_name, start_date, end_date, str(tmp_path)
+        )
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    observe_stage("pandas", store, stats["pandas"], stats["rows"])
+    observe_stage("excel", store, stats["excel"], stats["rows"])
 
     logger.info(f'Итоговый отчёт сохранён в "{path}"')
     return str(path)
\ No newline at end of file
@@ -0,0 +1,304 @@
+import asyncio
+import os
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Deque, List, Optional, Tuple
+
+import httpx
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database.engine import session_maker
+from database.models import Report, ReportJob, Store, User
+from keyboards.user_keyboards import get_menu_kb
+from services.db_lock import INSTANCE_ID
+from services.logging import logger
+from services.report_generator import (
+    generate_report_with_params, run_with_progress, file_hash, get_dates_from_str, is_sales_stored,
+    normalize_doc_number
+)
+from services.ttl_cache import invalidate_user
+from services.wb_cache import hash_token, is_closed_period
+from services.wb_client import WBDeadlineExceeded
+
+
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', 3))
+REPORT_JOB_ATTEMPTS = int(os.getenv('REPORT_JOB_ATTEMPTS', 3))
+REPORT_RETRY_DELAY = 30
+# Несколько экземпляров бота делят одну таблицу report_job: задание берётся атомарным UPDATE (аренда на
+# REPORT_JOB_LEASE секунд, продлевается, пока идёт генерация), свободные воркеры раз в REPORT_POLL_INTERVAL
+# забирают задания, поставленные другими экземплярами. Задание упавшего экземпляра возвращается после конца аренды
+REPORT_JOB_LEASE = float(os.getenv('REPORT_JOB_LEASE', 60))
+REPORT_POLL_INTERVAL = float(os.getenv('REPORT_POLL_INTERVAL', 2))
+
+
+def is_transient(error: BaseException) -> bool:
+    """Ошибки, после которых генерацию имеет смысл повторить: сеть, 429, 5xx, дедлайны WB"""
+    if isinstance(error, (httpx.TransportError, WBDeadlineExceeded)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+async def orm_add_report_job(session: AsyncSession, tg_id: int, chat_id: Optional[int], store_id: int, period: str, doc_num: str) -> ReportJob:
+    obj = ReportJob(
+        tg_id=tg_id,
+        chat_id=chat_id,
+        store_id=store_id,
+        period=period,
+        doc_num=doc_num,
+    )
+    session.add(obj)
+    await session.commit()
+    return obj
+
+
+def claimable(owner: Optional[str] = None):
+    """Задание можно взять: в очереди, или его аренда истекла, или (при старте) оно наше с прошлого запуска"""
+    expired = or_(ReportJob.locked_until.is_(None), ReportJob.locked_until < datetime.now())
+    if owner is not None:
+        expired = or_(expired, ReportJob.locked_by == owner)
+    return or_(ReportJob.status == 'queued', and_(ReportJob.status == 'running', expired))
+
+
+async def orm_get_unfinished_jobs(session: AsyncSession, owner: Optional[str] = None, limit: Optional[int] = None) -> List[int]:
+    query = select(ReportJob.id).where(claimable(owner)).order_by(ReportJob.id).limit(limit)
+    result = await session.execute(query)
+    return list(result.scalars().all())
+
+
+async def orm_claim_job(session: AsyncSession, job_id: int, owner: str, lease: float, recovered: bool = False) -> bool:
+    """Атомарно берёт задание в работу; False - уже выполнено или его выполняет другой экземпляр"""
+    query = update(ReportJob).where(ReportJob.id == job_id, claimable(owner if recovered else None)).values(
+        status='running', locked_by=owner, locked_until=datetime.now() + timedelta(seconds=lease)
+    )
+    claimed = (await session.execute(query)).rowcount == 1
+    await session.commit()
+    return claimed
+
+
+async def orm_renew_job(session: AsyncSession, job_id: int, owner: str, lease: float) -> bool:
+    query = update(ReportJob).where(
+        ReportJob.id == job_id, ReportJob.status == 'running', ReportJob.locked_by == owner
+    ).values(locked_until=datetime.now() + timedelta(seconds=lease))
+    renewed = (await session.execute(query)).rowcount == 1
+    await session.commit()
+    return renewed
+
+
+async def orm_update_job(session: AsyncSession, job_id: int, **values):
+    query = update(ReportJob).where(ReportJob.id == job_id).values(**values)
+    await session.execute(query)
+    await session.commit()
+
+
+async def orm_complete_job(session: AsyncSession, job: ReportJob, report: Report, charge: bool) -> bool:
+    """
+    Одной транзакцией: отметка delivered и статус done, отчёт в историю, списание генерации (charge).
+    False - задание уже завершено (другим экземпляром, потерявшим аренду, или до перезапуска): ничего не пишем
+    """
+    query = update(ReportJob).where(ReportJob.id == job.id, ReportJob.delivered.is_(False)).values(
+        status='done', delivered=True, report_path=report.report_path, error=None, locked_until=None
+    )
+    if (await session.execute(query)).rowcount != 1:
+        await session.rollback()
+        return False
+    report.charged = charge
+    session.add(report)
+    if charge:
+        await session.execute(
+            update(User).where(User.tg_id == job.tg_id).values(generations_left=User.generations_left - 1)
+        )
+    await session.commit()
+    if charge:
+        invalidate_user(job.tg_id)
+    return True
+
+
+class ReportJobQueue:
+    """
+    Очередь генерации отчётов: задания хранятся в таблице report_job,
+    выполняются пулом из REPORT_WORKERS воркеров. Хэндлеры только ставят задания в очередь.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker, workers: int = REPORT_WORKERS,
+                 instance_id: str = INSTANCE_ID, lease: float = REPORT_JOB_LEASE, poll_interval: float = REPORT_POLL_INTERVAL):
+        self.session_pool = session_pool
+        self.workers = workers
+        self.instance_id = instance_id
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.bot: Optional[Bot] = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Deque[int] = deque()
+        self._recovered: set = set()
+        self._tasks: List[asyncio.Task] = []
+        self._busy = 0
+
+    async def start(self, bot: Bot) -> None:
+        """Поднимает воркеров и возвращает в очередь задания, не завершённые до перезапуска"""
+        self.bot = bot
+        async with self.session_pool() as session:
+            job_ids = await orm_get_unfinished_jobs(session, owner=self.instance_id)
+        self._recovered = set(job_ids)
+        for job_id in job_ids:
+            self._push(job_id)
+        self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._poll()))
+        logger.info('Очередь отчётов запущена (%s): %d воркеров, %d заданий восстановлено',
+                    self.instance_id, self.workers, len(job_ids))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _poll(self) -> None:
+        """Свободные воркеры забирают задания других экземпляров и задания с истёкшей арендой"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            idle = self.workers - self._busy - self._queue.qsize()
+            if idle <= 0:
+                continue
+            try:
+                async with self.session_pool() as session:
+                    job_ids = await orm_get_unfinished_jobs(session, limit=idle + len(self._pending))
+            except Exception as e:
+                logger.warning('Очередь отчётов: не удалось проверить задания: %s', e)
+                continue
+            for job_id in [j for j in job_ids if j not in self._pending][:idle]:
+                self._push(job_id)
+
+    def _push(self, job_id: int) -> None:
+        self._pending.append(job_id)
+        self._queue.put_nowait(job_id)
+
+    def position(self, job_id: int) -> int:
+        """Место задания в очереди (1 - следующее), 0 - выполняется, сразу будет взято свободным воркером или не в очереди"""
+        try:
+            index = self._pending.index(job_id)
+        except ValueError:
+            return 0
+        return max(index + 1 - (self.workers - self._busy), 0)
+
+    async def enqueue(self, session: AsyncSession, tg_id: int, chat_id: Optional[int], store_id: int, period: str, doc_num: str) -> Tuple[int, int]:
+        job = await orm_add_report_job(session, tg_id, chat_id, store_id, period, doc_num)
+        self._push(job.id)
+        logger.info('Задание %d поставлено в очередь (позиция %d)', job.id, self.position(job.id))
+        return job.id, self.position(job.id)
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                self._pending.remove(job_id)
+            except ValueError:
+                pass
+            self._busy += 1
+            try:
+                await self._process(job_id)
+            except Exception as e:
+                logger.error('Воркер %d: задание %d упало: %s', n, job_id, e)
+            finally:
+                self._busy -= 1
+                self._queue.task_done()
+
+    async def _generate(self, job: ReportJob, store: Store) -> str:
+        for attempt in range(1, REPORT_JOB_ATTEMPTS + 1):
+            try:
+                return await generate_report_with_params(
+                    job.period, job.doc_num, store.token, store.name, job.tg_id, store.id
+                )
+            except Exception as e:
+                if attempt == REPORT_JOB_ATTEMPTS or not is_transient(e):
+                    raise
+                logger.warning('Задание %d: временная ошибка (%s), попытка %d', job.id, e, attempt)
+                async with self.session_pool() as session:
+                    await orm_update_job(session, job.id, attempts=attempt, error=str(e))
+                await asyncio.sleep(REPORT_RETRY_DELAY * attempt)
+
+    async def _heartbeat(self, job_id: int) -> None:
+        """Продлевает аренду, пока идёт генерация"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with self.session_pool() as session:
+                    if not await orm_renew_job(session, job_id, self.instance_id, self.lease):
+                        logger.warning('Задание %d: аренда потеряна', job_id)
+                        return
+            except Exception as e:
+                logger.warning('Задание %d: не удалось продлить аренду: %s', job_id, e)
+
+    async def _process(self, job_id: int) -> None:
+        recovered = job_id in self._recovered
+        self._recovered.discard(job_id)
+        async with self.session_pool() as session:
+            if not await orm_claim_job(session, job_id, self.instance_id, self.lease, recovered):
+                return
+            job = await session.get(ReportJob, job_id)
+            store = await session.get(Store, job.store_id)
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await self._run(job, store)
+        finally:
+            heartbeat.cancel()
+
+    async def _report_row(self, job: ReportJob, store: Store, file_path: str) -> Report:
+        start_date, end_date = get_dates_from_str(job.period)
+        # закрытая неделя больше не меняется - такой файл можно отдавать повторно (см. orm_get_ready_report),
+        # но только если в нём есть продажи: пустая детализация - WB ещё не опубликовал неделю
+        reusable = is_closed_period(end_date) and await is_sales_stored(start_date, end_date, store.token)
+        return Report(
+            tg_id=job.tg_id, date_of_week=date.fromisoformat(start_date), report_path=file_path, store_id=store.id,
+            doc_num=normalize_doc_number(job.doc_num), token_hash=hash_token(store.token),
+            content_hash=await asyncio.to_thread(file_hash, file_path) if reusable else None,
+        )
+
+    async def _run(self, job: ReportJob, store: Store) -> None:
+        job_id = job.id
+        if job.delivered:
+            logger.info('Задание %d уже выполнено, повторно не отправляем', job_id)
+            return
+        try:
+            if job.chat_id is None:
+                file_path = await self._generate(job, store)
+                report = await self._report_row(job, store, file_path)
+            else:
+                anchor = await self.bot.send_message(job.chat_id, f'Отчет по магазину {store.name} за {job.period} взят в работу')
+                file_path = await run_with_progress(
+                    anchor,
+                    "Формируется отчет, пожалуйста, подождите",
+                    self._generate,
+                    job, store
+                )
+                report = await self._report_row(job, store, file_path)
+                await self.bot.send_document(job.chat_id, FSInputFile(file_path))
+        except Exception as e:
+            async with self.session_pool() as session:
+                await orm_update_job(session, job_id, status='failed', error=str(e), locked_until=None)
+            if job.chat_id is not None:
+                await self.bot.send_message(
+                    job.chat_id,
+                    text=f"Ошибка при формировании отчета:\n\n{e}",
+                    reply_markup=get_menu_kb()
+                )
+            return
+
+        if job.chat_id is None and report.content_hash is None:
+            logger.info('Задание %d: детализация за %s пуста, заранее сформированный отчёт не сохраняем', job_id, job.period)
+            async with self.session_pool() as session:
+                await orm_update_job(session, job_id, status='failed', error='Детализация WB пуста', locked_until=None)
+            return
+        # файл уже отправлен: после отправки - только одна транзакция, списание вместе с отметкой delivered,
+        # чтобы повтор задания (потеря аренды, перезапуск) не списал генерацию второй раз
+        async with self.session_pool() as session:
+            if not await orm_complete_job(session, job, report, charge=job.chat_id is not None):
+                logger.warning('Задание %d уже завершено другим воркером, генерацию не списываем', job_id)
+
+
+report_queue = ReportJobQueue(session_maker)
@@ -0,0 +1,84 @@
+from typing import List
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils import get_column_letter
+
+
+# Итоговый xlsx пишется потоково (write_only): строки уходят в файл сразу,
+# объекты ячеек в памяти не копятся. Стили создаются один раз на модуль.
+TITLE_FONT = Font(bold=True)
+TITLE_BORDER = Border(*(Side(style="thin"),) * 4)
+TITLE_ALIGNMENT = Alignment(horizontal="center", vertical="top")
+TOTAL_FONT = Font(color="FF0000")
+TOTAL_FILL = PatternFill(fill_type="solid", start_color="FFFF00", end_color="FFFF00")
+
+HEADER_ROWS = 3  # магазин, период, заголовки колонок
+
+
+def column_widths(df: pd.DataFrame, extra: List[str]) -> List[int]:
+    """
+    Ширины колонок по самому длинному значению (как str(value)) с заголовком, +2.
+    extra - строки шапки в первой колонке (магазин, период).
+    """
+    widths = []
+    for n, col in enumerate(df.columns):
+        values = df[col]
+        longest = int(values.astype(str).str.len().max()) if len(values) else 0
+        longest = max(longest, len(str(col)))
+        if n == 0:
+            longest = max([longest, *map(len, extra)])
+        widths.append(longest + 2)
+    return widths
+
+
+def _title_cell(ws, value) -> WriteOnlyCell:
+    cell = WriteOnlyCell(ws, value=value)
+    cell.font = TITLE_FONT
+    cell.border = TITLE_BORDER
+    cell.alignment = TITLE_ALIGNMENT
+    return cell
+
+
+def write_report_xlsx(df: pd.DataFrame, path: str, store_name: str, start_date: str, end_date: str) -> str:
+    """
+    Пишет итоговый отчёт: магазин и период в шапке, жирные заголовки,
+    строки df и строка "Итого" с формулами =SUM (жёлтая заливка, красный шрифт) по колонкам с 3-й.
+    """
+    store_line = f"Магазин: {store_name}"
+    period_line = f"Период: {start_date} – {end_date}"
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    # в write_only ширины задаются до первой строки
+    for idx, width in enumerate(column_widths(df, [store_line, period_line]), start=1):
+        ws.column_dimensions[get_column_letter(idx)].width = width
+
+    ws.append([store_line])
+    ws.append([period_line])
+    ws.append([_title_cell(ws, str(col)) for col in df.columns])
+
+    # numpy-скаляры -> python, чтобы openpyxl не проверял типы по каждой ячейке
+    columns = [
+        df[col].to_numpy(dtype=object) if df[col].dtype == object else df[col].to_numpy().tolist()
+        for col in df.columns
+    ]
+    for row in zip(*columns):
+        ws.append(row)
+
+    summary = HEADER_ROWS + len(df) + 1
+    total_label = WriteOnlyCell(ws, value="Итого")
+    total_label.font = TITLE_FONT
+    totals = [total_label, None]
+    for idx in range(3, len(df.columns) + 1):
+        letter = get_column_letter(idx)
+        cell = WriteOnlyCell(ws, value=f"=SUM({letter}{HEADER_ROWS + 1}:{letter}{summary - 1})")
+        cell.font = TOTAL_FONT
+        cell.fill = TOTAL_FILL
+        totals.append(cell)
+    ws.append(totals)
+
+    wb.save(path)
+    return path
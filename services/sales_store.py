@@ -0,0 +1,186 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from services.report_builder import SALES_NUMERIC_COLUMNS, SALES_TEXT_COLUMNS, SalesAggregator, project_sales_page
+
+
+# Локальное колоночное хранилище детализации продаж (reportDetailByPeriod) по магазинам и закрытым периодам.
+# Каждая страница детализации хранится по колонкам: только нужные отчёту колонки, числа - сжатым
+# numpy-буфером в уменьшенном типе, строки (артикул, тип документа, обоснование) - кодами словаря страницы.
+# Функции синхронные: пишутся и читаются в пуле процессов (services/cpu_pool.py), рядом со свёрткой страниц.
+
+SALES_STORE_PATH = os.getenv('SALES_STORE_PATH', str(Path('data') / 'cache' / 'sales.sqlite3'))
+SALES_STORE_DAYS = int(os.getenv('SALES_STORE_DAYS', 400))  # периоды старше не храним
+
+# типы при хранении; при чтении колонки приводятся обратно к SALES_NUMERIC_COLUMNS
+STORED_DTYPES = {"nm_id": "int64", "quantity": "int32", "delivery_amount": "int32"}
+
+_connections: Dict[str, sqlite3.Connection] = {}
+_lock = threading.RLock()  # в процессе бота функции вызываются из потоков (asyncio.to_thread)
+
+
+def _retention_cutoff() -> pd.Timestamp:
+    return pd.Timestamp.today().normalize() - pd.Timedelta(days=SALES_STORE_DAYS)
+
+
+def in_retention(date_to: str) -> bool:
+    return pd.Timestamp(date_to[:10]) >= _retention_cutoff()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = _connections.get(path)
+    if conn is None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sales_period (
+                id         INTEGER PRIMARY KEY,
+                store_key  TEXT NOT NULL,
+                date_from  TEXT NOT NULL,
+                date_to    TEXT NOT NULL,
+                rows       INTEGER NOT NULL DEFAULT 0,
+                complete   INTEGER NOT NULL DEFAULT 0,
+                created    REAL NOT NULL,
+                UNIQUE (store_key, date_from, date_to)
+            );
+            CREATE TABLE IF NOT EXISTS sales_column (
+                period_id  INTEGER NOT NULL REFERENCES sales_period(id) ON DELETE CASCADE,
+                seq        INTEGER NOT NULL,
+                name       TEXT NOT NULL,
+                data       BLOB NOT NULL,
+                labels     BLOB,
+                PRIMARY KEY (period_id, seq, name)
+            );
+        ''')
+        conn.execute('PRAGMA foreign_keys=ON')
+        _connections[path] = conn
+    return conn
+
+
+def _encode(df: pd.DataFrame) -> List[Tuple[str, bytes, Optional[bytes]]]:
+    """Колонки страницы -> (имя, сжатый буфер, сжатый словарь строк)"""
+    encoded = []
+    for col in ["nm_id", *SALES_NUMERIC_COLUMNS]:
+        dtype = STORED_DTYPES.get(col, SALES_NUMERIC_COLUMNS.get(col))
+        encoded.append((col, zlib.compress(df[col].to_numpy(dtype=dtype).tobytes(), 6), None))
+    for col in SALES_TEXT_COLUMNS:
+        values = df[col].where(df[col].isna(), df[col].astype(str))
+        codes, labels = pd.factorize(values)  # None/NaN -> -1
+        encoded.append((
+            col,
+            zlib.compress(codes.astype("int32").tobytes(), 6),
+            zlib.compress(json.dumps(labels.tolist(), ensure_ascii=False).encode(), 6),
+        ))
+    return encoded
+
+
+def _decode(name: str, data: bytes, labels: Optional[bytes]) -> np.ndarray:
+    if labels is None:
+        return np.frombuffer(zlib.decompress(data), dtype=STORED_DTYPES.get(name, SALES_NUMERIC_COLUMNS.get(name)))
+    codes = np.frombuffer(zlib.decompress(data), dtype="int32")
+    lookup = np.array([*json.loads(zlib.decompress(labels)), None], dtype=object)  # код -1 -> None
+    return lookup[codes]
+
+
+def begin_period(path: str, store_key: str, date_from: str, date_to: str) -> int:
+    """Начинает запись периода заново, возвращает его id"""
+    with _lock:
+        conn = _connect(path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM sales_period WHERE store_key = ? AND date_from = ? AND date_to = ?',
+                         (store_key, date_from, date_to))
+            period_id = conn.execute(
+                'INSERT INTO sales_period (store_key, date_from, date_to, created) VALUES (?, ?, ?, ?)',
+                (store_key, date_from, date_to, time.time())
+            ).lastrowid
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return period_id
+
+
+def write_frame(path: str, period_id: int, df: pd.DataFrame) -> None:
+    """Дописывает страницу (кадр project_sales_page) в период"""
+    encoded = _encode(df)
+    with _lock:
+        conn = _connect(path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = conn.execute('SELECT COALESCE(MAX(seq) + 1, 0) FROM sales_column WHERE period_id = ?',
+                               (period_id,)).fetchone()[0]
+            conn.executemany('INSERT INTO sales_column (period_id, seq, name, data, labels) VALUES (?, ?, ?, ?, ?)',
+                             ((period_id, seq, *column) for column in encoded))
+            conn.execute('UPDATE sales_period SET rows = rows + ? WHERE id = ?', (len(df), period_id))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+
+def finish_period(path: str, period_id: int) -> None:
+    with _lock:
+        conn = _connect(path)
+        conn.execute('UPDATE sales_period SET complete = 1 WHERE id = ?', (period_id,))
+        conn.execute('DELETE FROM sales_period WHERE date_to < ?', (_retention_cutoff().date().isoformat(),))
+
+
+def discard_period(path: str, period_id: int) -> None:
+    with _lock:
+        _connect(path).execute('DELETE FROM sales_period WHERE id = ?', (period_id,))
+
+
+def find_period(path: str, store_key: str, date_from: str, date_to: str) -> Optional[int]:
+    """id полностью сохранённого периода или None"""
+    with _lock:
+        row = _connect(path).execute(
+            'SELECT id FROM sales_period WHERE store_key = ? AND date_from = ? AND date_to = ? AND complete = 1',
+            (store_key, date_from, date_to)
+        ).fetchone()
+        return row[0] if row else None
+
+
+def iter_frames(path: str, period_id: int) -> Iterator[pd.DataFrame]:
+    """Страницы периода по одной, в том же виде, что даёт project_sales_page"""
+    with _lock:
+        seqs = [row[0] for row in _connect(path).execute(
+            'SELECT DISTINCT seq FROM sales_column WHERE period_id = ? ORDER BY seq', (period_id,)
+        )]
+    for seq in seqs:
+        with _lock:
+            rows = _connect(path).execute(
+                'SELECT name, data, labels FROM sales_column WHERE period_id = ? AND seq = ?', (period_id, seq)
+            ).fetchall()
+        df = pd.DataFrame({name: _decode(name, data, labels) for name, data, labels in rows})
+        yield df[["nm_id", *SALES_TEXT_COLUMNS, *SALES_NUMERIC_COLUMNS]].astype({"nm_id": "int64", **SALES_NUMERIC_COLUMNS})
+
+
+# ------------------ функции для пула процессов ------------------
+
+def fold_and_store_sales_page(raw: bytes, path: str, period_id: int) -> SalesAggregator:
+    """Свёртка страницы детализации (как fold_sales_page) + запись её колонок в хранилище"""
+    df = project_sales_page(json.loads(raw))
+    write_frame(path, period_id, df)
+    agg = SalesAggregator()
+    agg.add_frame(df)
+    return agg
+
+
+def fold_stored_sales(path: str, period_id: int) -> SalesAggregator:
+    """Свёртка сохранённого периода постранично - в памяти не больше одной страницы"""
+    agg = SalesAggregator()
+    for df in iter_frames(path, period_id):
+        agg.add_frame(df)
+    return agg
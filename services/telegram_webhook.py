@@ -0,0 +1,125 @@
+import asyncio
+import os
+import secrets
+import signal
+from contextlib import suppress
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from services.logging import logger
+
+
+# Доставка апдейтов: polling (getUpdates) или webhook (Telegram сам шлёт POST).
+# В режиме webhook сервер слушает WEBHOOK_HOST:WEBHOOK_PORT за reverse proxy (HTTPS),
+# Telegram получает адрес WEBHOOK_BASE_URL + WEBHOOK_PATH
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+# заголовок X-Telegram-Bot-Api-Secret-Token: без него запросы к endpoint отклоняются (401)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # параллельных запросов от Telegram
+WEBHOOK_MAX_UPDATES = int(os.getenv('WEBHOOK_MAX_UPDATES', 100))  # апдейтов в обработке одновременно
+# накопившиеся за время перезапуска апдейты: в режиме polling по умолчанию выбрасываются, как и раньше,
+# в режиме webhook - обрабатываются; DROP_PENDING_UPDATES=1/0 задаёт поведение явно для обоих режимов
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '1' if BOT_MODE == 'polling' else '0') == '1'
+WEBHOOK_DRAIN_TIMEOUT = 30  # при остановке дообработать уже принятые апдейты
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Отвечает Telegram сразу, апдейт обрабатывается в фоне - но не больше max_updates одновременно.
+    Когда все места заняты, ответ на запрос ждёт свободного места: Telegram придерживает следующие апдейты
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_updates: int = WEBHOOK_MAX_UPDATES, **kwargs: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._slots = asyncio.Semaphore(max_updates)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        except Exception as e:
+            logger.error('Ошибка обработки апдейта %s: %s', update.get('update_id'), e)
+        finally:
+            self._slots.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        try:
+            return await super()._handle_request_background(bot, request)
+        except BaseException:
+            self._slots.release()
+            raise
+
+
+class TelegramWebhook:
+    """POST WEBHOOK_PATH на WEBHOOK_HOST:WEBHOOK_PORT -> dispatcher; запуск/остановка - как у polling"""
+
+    def __init__(self, base_url: str = WEBHOOK_BASE_URL, path: str = WEBHOOK_PATH, host: str = WEBHOOK_HOST,
+                 port: int = WEBHOOK_PORT, secret: str = WEBHOOK_SECRET, max_connections: int = WEBHOOK_MAX_CONNECTIONS,
+                 max_updates: int = WEBHOOK_MAX_UPDATES):
+        self.base_url = base_url
+        self.path = path
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.max_connections = max_connections
+        self.max_updates = max_updates
+        self._runner: Optional[web.AppRunner] = None
+        self._handler: Optional[BoundedRequestHandler] = None
+
+    def app(self, dp: Dispatcher, bot: Bot) -> web.Application:
+        app = web.Application()
+        self._handler = BoundedRequestHandler(dp, bot, max_updates=self.max_updates, secret_token=self.secret)
+        self._handler.register(app, path=self.path)
+        setup_application(app, dp, bot=bot)  # dp.startup/shutdown вместе со стартом/остановкой сервера
+        return app
+
+    async def start(self, dp: Dispatcher, bot: Bot, allowed_updates: Optional[List[str]] = None) -> None:
+        if not self.base_url:
+            raise RuntimeError('BOT_MODE=webhook: не задан WEBHOOK_BASE_URL')
+        self._runner = web.AppRunner(self.app(dp, bot), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        await bot.set_webhook(
+            url=self.base_url.rstrip('/') + self.path,
+            secret_token=self.secret,
+            max_connections=self.max_connections,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+        logger.info('Webhook: %s%s -> http://%s:%d%s', self.base_url, self.path, self.host, self.port, self.path)
+
+    async def stop(self) -> None:
+        # сам webhook не удаляем: пока бот перезапускается, Telegram копит апдейты и доставит их после старта
+        if self._runner is None:
+            return
+        for site in self._runner.sites:
+            await site.stop()  # новые апдейты больше не принимаем
+        pending = self._handler._background_feed_update_tasks
+        if pending:
+            logger.info('Webhook: дообрабатываем %d апдейтов', len(pending))
+            await asyncio.wait(set(pending), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        await self._runner.cleanup()  # dp.shutdown
+        self._runner = None
+
+    async def run(self, dp: Dispatcher, bot: Bot, allowed_updates: Optional[List[str]] = None) -> None:
+        """Аналог dp.start_polling: работает до Ctrl+C / SIGTERM"""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError):  # Windows
+                loop.add_signal_handler(sig, stopped.set)
+        await self.start(dp, bot, allowed_updates)
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop()
+
+
+telegram_webhook = TelegramWebhook()
@@ -0,0 +1,75 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from services.metrics import CACHE_REQUESTS
+
+
+# Кэш горячих записей БД (пользователь, его магазины) для навигации по меню.
+# Записи живут USER_CACHE_TTL секунд и сбрасываются хелперами, которые их меняют (orm_...) - только в своём
+# процессе: при нескольких экземплярах бота изменения с другого экземпляра видны через USER_CACHE_TTL.
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))  # 0 - кэш выключен
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+# БД общая для нескольких экземпляров бота: баланс и генерации читаются мимо кэша (orm_get_user(..., fresh=True)).
+# По умолчанию включается вместе с FSM_STORAGE=db (services/fsm_storage.py) - он нужен именно при нескольких экземплярах
+USER_CACHE_SHARED = os.getenv('USER_CACHE_SHARED', '1' if os.getenv('FSM_STORAGE', 'memory') == 'db' else '0') == '1'
+
+MISSING = object()
+
+
+class TTLCache:
+    """Ограниченный по размеру (вытесняется давно не использованное) кэш с TTL записей"""
+
+    def __init__(self, name: str, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+
+    def get(self, key: Hashable) -> Any:
+        """Значение или MISSING"""
+        item = self._data.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc(self.name, 'hit')
+            return item[1]
+        if item is not None:
+            del self._data[key]
+        self.misses += 1
+        CACHE_REQUESTS.inc(self.name, 'miss')
+        return MISSING
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# по tg_id: User с загруженным selected_store / список Store пользователя.
+# Объекты отвязаны от сессии (expunge) - только для чтения, изменения - через orm_ хелперы
+user_cache = TTLCache('user')
+stores_cache = TTLCache('stores')
+
+
+def invalidate_user(tg_id: int) -> None:
+    """Пользователь и его магазины изменились - следующий запрос пойдёт в БД"""
+    user_cache.invalidate(tg_id)
+    stores_cache.invalidate(tg_id)
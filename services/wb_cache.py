@@ -0,0 +1,199 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from services.logging import logger
+
+
+CACHE_PATH = Path(os.getenv('WB_CACHE_PATH', str(Path('data') / 'cache' / 'wb_cache.sqlite3')))  # рядом с data/reports
+CACHE_TTL = int(os.getenv('WB_CACHE_TTL', 14 * 24 * 3600))
+CACHE_MAX_BYTES = int(os.getenv('WB_CACHE_MAX_MB', 1024)) * 1024 * 1024
+
+
+def hash_token(token: str) -> str:
+    """Токен магазина нигде не храним в открытом виде - только его хэш"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def make_key(namespace: str, token: str, *parts: Any) -> str:
+    """Ключ кэша: хэш токена магазина + параметры запроса (сам токен в кэш не пишется)"""
+    raw = '|'.join([namespace, hash_token(token), *map(str, parts)])
+    return f'{namespace}:{hashlib.sha256(raw.encode()).hexdigest()}'
+
+
+def is_closed_period(date_to: str) -> bool:
+    """Закрытый период (целиком в прошлом) больше не меняется на стороне WB - его можно кэшировать"""
+    return datetime.fromisoformat(date_to[:10]).date() < date.today()
+
+
+class WBCache:
+    """
+    Постраничный кэш ответов WB в SQLite.
+    Запись разбита на страницы, чтобы её можно было писать и читать потоково.
+    Записи устаревают по возрасту (ttl), общий размер ограничен max_bytes - сначала вытесняются
+    давно не использованные записи.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, ttl: int = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    # ------------------ sync part (runs in thread) ------------------
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS entry (
+                    key       TEXT PRIMARY KEY,
+                    created   REAL NOT NULL,
+                    accessed  REAL NOT NULL,
+                    size      INTEGER NOT NULL DEFAULT 0,
+                    complete  INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS page (
+                    key   TEXT NOT NULL REFERENCES entry(key) ON DELETE CASCADE,
+                    seq   INTEGER NOT NULL,
+                    data  BLOB NOT NULL,
+                    PRIMARY KEY (key, seq)
+                );
+                CREATE INDEX IF NOT EXISTS idx_entry_accessed ON entry(accessed);
+            ''')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._conn = conn
+        return self._conn
+
+    def _lookup(self, key: str) -> bool:
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT created, complete FROM entry WHERE key = ?', (key,)).fetchone()
+            if row is None or not row[1]:
+                return False
+            if time.time() - row[0] > self.ttl:
+                conn.execute('DELETE FROM entry WHERE key = ?', (key,))
+                conn.commit()
+                return False
+            conn.execute('UPDATE entry SET accessed = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+            return True
+
+    def _read_page(self, key: str, seq: int) -> Optional[bytes]:
+        with self._lock:
+            row = self._connect().execute('SELECT data FROM page WHERE key = ? AND seq = ?', (key, seq)).fetchone()
+            return row[0] if row else None
+
+    def _begin(self, key: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('DELETE FROM entry WHERE key = ?', (key,))
+            conn.execute('INSERT INTO entry (key, created, accessed) VALUES (?, ?, ?)', (key, now, now))
+            conn.commit()
+
+    def _write_page(self, key: str, seq: int, data: bytes) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO page (key, seq, data) VALUES (?, ?, ?)', (key, seq, data))
+            conn.execute('UPDATE entry SET size = size + ? WHERE key = ?', (len(data), key))
+            conn.commit()
+
+    def _finish(self, key: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute('UPDATE entry SET complete = 1 WHERE key = ?', (key,))
+            self._evict(conn)
+            conn.commit()
+
+    def _discard(self, key: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM entry WHERE key = ?', (key,))
+            conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        conn.execute('DELETE FROM entry WHERE created < ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM entry').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM entry ORDER BY accessed').fetchall():
+            conn.execute('DELETE FROM entry WHERE key = ?', (key,))
+            total -= size
+            logger.info('Кэш WB: вытеснена запись %s (%d байт)', key, size)
+            if total <= self.max_bytes:
+                break
+
+    def _stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._connect().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entry WHERE complete = 1'
+            ).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    # ------------------ async API ------------------
+
+    async def lookup(self, key: str) -> bool:
+        """Есть ли полная и не устаревшая запись. Считает попадания/промахи"""
+        found = await asyncio.to_thread(self._lookup, key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        logger.info('Кэш WB: %s %s (hits=%d, misses=%d)',
+                    'попадание' if found else 'промах', key, self.hits, self.misses)
+        return found
+
+    async def iter_pages(self, key: str) -> AsyncIterator[bytes]:
+        """Читает страницы записи по одной (сырые байты)"""
+        seq = 0
+        while True:
+            data = await asyncio.to_thread(self._read_page, key, seq)
+            if data is None:
+                return
+            yield await asyncio.to_thread(zlib.decompress, data)
+            seq += 1
+
+    async def begin(self, key: str) -> None:
+        await asyncio.to_thread(self._begin, key)
+
+    async def write_page(self, key: str, seq: int, raw: bytes) -> None:
+        await asyncio.to_thread(lambda: self._write_page(key, seq, zlib.compress(raw, 6)))
+
+    async def finish(self, key: str) -> None:
+        await asyncio.to_thread(self._finish, key)
+
+    async def discard(self, key: str) -> None:
+        await asyncio.to_thread(self._discard, key)
+
+    async def get(self, key: str) -> Optional[List[Any]]:
+        """Все страницы записи (разобранный JSON) списком или None при промахе"""
+        if not await self.lookup(key):
+            return None
+        return [json.loads(raw) async for raw in self.iter_pages(key)]
+
+    async def put(self, key: str, pages: List[Any]) -> None:
+        await self.begin(key)
+        for seq, page in enumerate(pages):
+            await self.write_page(key, seq, json.dumps(page, ensure_ascii=False).encode())
+        await self.finish(key)
+
+    async def stats(self) -> Dict[str, int]:
+        return await asyncio.to_thread(self._stats)
+
+
+wb_cache = WBCache()
@@ -0,0 +1,198 @@
+import asyncio
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from services.logging import logger
+from services.metrics import observe_wb_call
+from services.wb_cache import hash_token
+
+
+REQUEST_DEADLINE = float(os.getenv('WB_REQUEST_DEADLINE', 300))
+MAX_ATTEMPTS = int(os.getenv('WB_MAX_ATTEMPTS', 6))
+BACKOFF_BASE = 2.0
+BACKOFF_CAP = 60.0
+
+
+class WBDeadlineExceeded(TimeoutError):
+    pass
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    name: str
+    host: str
+    path: str        # regex по пути запроса
+    rate: float      # запросов в секунду на один токен продавца
+    burst: int = 1
+
+
+# Лимиты WB считаются на продавца (токен) и метод. Первое совпадение побеждает.
+RATE_LIMITS = [
+    RateLimit('sales', 'statistics-api.wildberries.ru', r'/api/v5/supplier/reportDetailByPeriod', 1 / 60),
+    RateLimit('storage_status', 'seller-analytics-api.wildberries.ru', r'/api/v1/paid_storage/tasks/.+/status', 1 / 5),
+    RateLimit('storage', 'seller-analytics-api.wildberries.ru', r'/api/v1/paid_storage', 1 / 60),
+    RateLimit('acceptance_status', 'seller-analytics-api.wildberries.ru', r'/api/v1/acceptance_report/tasks/.+/status', 1 / 5),
+    RateLimit('acceptance', 'seller-analytics-api.wildberries.ru', r'/api/v1/acceptance_report', 1 / 60),
+    RateLimit('cards', 'content-api.wildberries.ru', r'/content/', 100 / 60, 5),
+    RateLimit('adv_upd', 'advert-api.wildberries.ru', r'/adv/v1/upd', 1),
+    RateLimit('adv_fullstats', 'advert-api.wildberries.ru', r'/adv/v2/fullstats', 1 / 20),
+]
+DEFAULT_LIMIT = RateLimit('default', '*', '.*', 1, 1)
+# общий лимит на хост для всех токенов вместе - чтобы бот в целом не долбил WB
+HOST_RATE = float(os.getenv('WB_HOST_RATE', 10))
+HOST_BURST = int(os.getenv('WB_HOST_BURST', 10))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def block(self, seconds: float) -> None:
+        """Не выдавать запросы ближайшие seconds секунд (Retry-After / исчерпанный лимит)"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0.0)
+
+    async def acquire(self, deadline: float) -> None:
+        async with self._lock:  # ожидающие обслуживаются по очереди
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = max(self.blocked_until - now, 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate)
+                if wait <= 0:
+                    self.tokens -= 1
+                    return
+                if now + wait > deadline:
+                    raise WBDeadlineExceeded(f'Лимит запросов WB не позволяет уложиться в срок (ждать {wait:.0f} с)')
+                await asyncio.sleep(wait)
+
+
+def retry_after(resp: httpx.Response) -> Optional[float]:
+    """Сколько ждать по заголовкам ответа WB: X-Ratelimit-Retry, Retry-After"""
+    for header in ('X-Ratelimit-Retry', 'Retry-After'):
+        value = resp.headers.get(header)
+        if not value:
+            continue
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                continue
+    return None
+
+
+def backoff(attempt: int) -> float:
+    """Экспоненциальная задержка с full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class WBClient:
+    """
+    Единая точка доступа к API Wildberries.
+    Лимитирует запросы token bucket'ами на хост и на (метод, токен продавца),
+    учитывает заголовки X-Ratelimit-*, повторяет 429/5xx/сетевые ошибки с jitter
+    и не выходит за дедлайн запроса.
+    """
+
+    def __init__(self, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._client = httpx.AsyncClient(timeout=30.0, transport=transport)
+        self._host_buckets: Dict[str, TokenBucket] = {}
+        self._token_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    @staticmethod
+    def _limit_for(host: str, path: str) -> RateLimit:
+        for limit in RATE_LIMITS:
+            if limit.host == host and re.match(limit.path, path):
+                return limit
+        return DEFAULT_LIMIT
+
+    def _buckets(self, url: str, token: str) -> Tuple[TokenBucket, TokenBucket]:
+        parts = urlsplit(url)
+        limit = self._limit_for(parts.hostname or '', parts.path)
+        host = self._host_buckets.get(parts.hostname)
+        if host is None:
+            host = self._host_buckets[parts.hostname] = TokenBucket(HOST_RATE, HOST_BURST)
+        key = (limit.name if limit is not DEFAULT_LIMIT else parts.hostname, hash_token(token))
+        per_token = self._token_buckets.get(key)
+        if per_token is None:
+            per_token = self._token_buckets[key] = TokenBucket(limit.rate, limit.burst)
+        return host, per_token
+
+    async def request(self, method: str, url: str, token: str, *, headers: Optional[dict] = None,
+                      deadline: Optional[float] = None, **kwargs) -> httpx.Response:
+        """
+        Запрос к WB c лимитами и повторами. deadline - секунды на весь запрос вместе с ожиданиями.
+        Возвращает последний ответ (в т.ч. 429/5xx, если повторы кончились) - raise_for_status на стороне вызывающего.
+        Время, байты, повторы и 429 пишутся в метрики (services/metrics.py) и в текущий этап отчёта.
+        """
+        headers = {"Authorization": token, **(headers or {})}
+        started = time.monotonic()
+        until = started + (deadline or REQUEST_DEADLINE)
+        parts = urlsplit(url)
+        limit = self._limit_for(parts.hostname or '', parts.path)
+        host_bucket, token_bucket = self._buckets(url, token)
+        resp: Optional[httpx.Response] = None
+        retries, throttled = 0, 0
+        try:
+            for attempt in range(MAX_ATTEMPTS):
+                retries = attempt
+                await token_bucket.acquire(until)
+                await host_bucket.acquire(until)
+                timeout = max(min(30.0, until - time.monotonic()), 1.0)
+                try:
+                    resp = await self._client.request(method, url, headers=headers, timeout=timeout, **kwargs)
+                except httpx.TransportError as e:
+                    if attempt == MAX_ATTEMPTS - 1:
+                        raise
+                    delay = backoff(attempt)
+                    logger.warning('WB %s %s: %s, повтор через %.1f с', method, parts.path, e, delay)
+                else:
+                    if resp.status_code == 429:
+                        throttled += 1
+                        delay = (retry_after(resp) or backoff(attempt)) + random.uniform(0, 1)
+                        token_bucket.block(delay)
+                    elif resp.status_code >= 500:
+                        delay = backoff(attempt)
+                    else:
+                        if resp.headers.get('X-Ratelimit-Remaining') == '0':
+                            reset = resp.headers.get('X-Ratelimit-Reset')
+                            if reset and reset.replace('.', '', 1).isdigit():
+                                token_bucket.block(float(reset))
+                        return resp
+                    logger.warning('WB %s %s: %s, повтор через %.1f с', method, parts.path, resp.status_code, delay)
+                if time.monotonic() + delay > until:
+                    break
+                await asyncio.sleep(delay)
+            if resp is None:
+                raise WBDeadlineExceeded(f'WB {method} {parts.path}: дедлайн истёк')
+            return resp
+        finally:
+            observe_wb_call(
+                limit.name if limit is not DEFAULT_LIMIT else parts.hostname or '', token,
+                time.monotonic() - started, resp.status_code if resp is not None else None,
+                len(resp.content) if resp is not None else 0, retries, throttled
+            )
+
+    async def get(self, url: str, token: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, token, **kwargs)
+
+    async def post(self, url: str, token: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, token, **kwargs)
+
+
+wb_client = WBClient()
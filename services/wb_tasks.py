@@ -0,0 +1,137 @@
+import asyncio
+import os
+import random
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from services.logging import logger
+from services.metrics import current_stage
+from services.wb_cache import hash_token
+from services.wb_client import WBDeadlineExceeded, wb_client
+
+
+WB_TASK_DEADLINE = float(os.getenv('WB_TASK_DEADLINE', 300))
+POLL_FIRST = float(os.getenv('WB_POLL_FIRST', 2))      # первая проверка - быстро, маленькие отчёты готовы сразу
+POLL_FACTOR = 2.0
+POLL_MAX = float(os.getenv('WB_POLL_MAX', 30))
+POLL_JITTER = 0.2
+POLL_CONCURRENCY = int(os.getenv('WB_POLL_CONCURRENCY', 10))
+FAILED_STATUSES = ('canceled', 'purged')
+
+
+class _PendingTask:
+    def __init__(self, status_url: str, token: str, headers: dict, until: float):
+        self.status_url = status_url
+        self.token = token
+        self.headers = headers
+        self.until = until
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.interval = POLL_FIRST
+        self.next_check = time.monotonic() + POLL_FIRST
+        self.checking = False
+        self.checks = 0
+        self.waiters = 0
+        self.trace = current_stage.get()  # проверки статуса учитываются в этапе отчёта, который ждёт задачу
+
+
+class WBTaskPoller:
+    """
+    Общий планировщик опроса статусов отчётов-задач WB (хранение, приёмка).
+    Все ожидающие задачи живут в одном цикле: интервал проверки растёт экспоненциально
+    с jitter (POLL_FIRST -> POLL_MAX), у каждой задачи свой дедлайн, ожидающие корутины
+    просыпаются, как только задача готова. Одну и ту же задачу опрашиваем один раз на всех.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[Tuple[str, str], _PendingTask] = {}
+        self._checks: Set[asyncio.Task] = set()
+        self._runner: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.status_calls = 0
+
+    async def wait(self, status_url: str, token: str, headers: dict, deadline: float = WB_TASK_DEADLINE) -> bool:
+        """Ждёт, пока задача перейдёт в статус done. False - если не уложились в deadline или WB её отменил"""
+        key = (status_url, hash_token(token))
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = _PendingTask(status_url, token, headers, time.monotonic() + deadline)
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.create_task(self._run())
+        self._wakeup.set()
+        task.waiters += 1
+        try:
+            return await asyncio.shield(task.future)
+        finally:
+            task.waiters -= 1
+            if not task.waiters and not task.future.done():
+                # все ожидающие отменены - задачу больше не опрашиваем
+                task.future.cancel()
+                self._forget(key, task)
+
+    def _forget(self, key: Tuple[str, str], task: _PendingTask) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def _finish(self, key: Tuple[str, str], task: _PendingTask, result: Optional[bool] = None,
+                error: Optional[BaseException] = None) -> None:
+        self._forget(key, task)
+        self._wakeup.set()
+        if task.future.done():
+            return
+        if error is not None:
+            task.future.set_exception(error)
+        else:
+            task.future.set_result(result)
+        logger.info('Задача WB %s: %s после %d проверок статуса',
+                    task.status_url, 'готова' if result else 'не готова', task.checks)
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(POLL_CONCURRENCY)
+        while self._tasks:
+            now = time.monotonic()
+            for key, task in list(self._tasks.items()):
+                if not task.checking and task.next_check <= now:
+                    task.checking = True
+                    check = asyncio.create_task(self._check(key, task, semaphore))
+                    self._checks.add(check)
+                    check.add_done_callback(self._checks.discard)
+            waiting = [t.next_check for t in self._tasks.values() if not t.checking]
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(min(waiting) - now, 0) if waiting else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, key: Tuple[str, str], task: _PendingTask, semaphore: asyncio.Semaphore) -> None:
+        current_stage.set(task.trace)
+        try:
+            async with semaphore:
+                st = await wb_client.get(task.status_url, task.token, headers=task.headers,
+                                         deadline=max(task.until - time.monotonic(), 1.0))
+            self.status_calls += 1
+            task.checks += 1
+            if st.status_code != 429:
+                st.raise_for_status()
+                status = st.json()["data"]["status"].lower()
+                if status == "done":
+                    return self._finish(key, task, True)
+                if status in FAILED_STATUSES:
+                    logger.warning('Задача WB %s: статус %s', task.status_url, status)
+                    return self._finish(key, task, False)
+        except WBDeadlineExceeded:
+            return self._finish(key, task, False)
+        except Exception as e:
+            return self._finish(key, task, error=e)
+
+        now = time.monotonic()
+        if now >= task.until:
+            return self._finish(key, task, False)
+        delay = task.interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        task.interval = min(task.interval * POLL_FACTOR, POLL_MAX)
+        task.next_check = min(now + delay, task.until)
+        task.checking = False
+        self._wakeup.set()
+
+
+wb_tasks = WBTaskPoller()